@@ -16,10 +16,22 @@ Track this data:
 * refer per post
 
 """
+import os
 import time
+import atexit
+import logging
 import datetime
 import urlparse
+import threading
+import collections
+import Queue
+try:
+    import json
+except ImportError:
+    import simplejson as json
 from django.conf import settings
+import sisyphus.models
+import sisyphus.timeseries
 
 
 ANALYTICS_BACKOFF = "analytics.backoff.%s.%s"
@@ -31,6 +43,21 @@ ANALYTICS_PAGEVIEW_BUCKET = "analytics.pv_bucket"
 ANALYTICS_PAGEVIEW_PAGE_BUCKET = "analytics.pv_bucket.%s"
 HISTORICAL_REFERRER = "imported from Google Analytics"
 
+# compact storage, see ANALYTICS_COMPACT
+ANALYTICS_DAYS = "analytics.days"
+ANALYTICS_DAYS_PAGE = "analytics.days.%s"
+ANALYTICS_WEEKS = "analytics.weeks"
+ANALYTICS_WEEKS_PAGE = "analytics.weeks.%s"
+ANALYTICS_MONTHS = "analytics.months"
+ANALYTICS_MONTHS_PAGE = "analytics.months.%s"
+ANALYTICS_UNIQUES_PAGE = "analytics.uniques.%s"
+ANALYTICS_UNIQUES_DAY = "analytics.uniques_day.%s"
+DAY = 24 * 60 * 60
+
+ANALYTICS_DASHBOARD_SITE = "analytics.dashboard.site"
+ANALYTICS_DASHBOARD_PAGE = "analytics.dashboard.page.%s"
+ANALYTICS_ROLLUP_LOCK = "analytics.dashboard.lock"
+
 FILTERED_REFS = ('www.google.com', 'lethain.com', 'dev.lethain.com','DIRECT', HISTORICAL_REFERRER)
 BOT_AGENTS = ("-",
               "facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)",
@@ -48,7 +75,9 @@ BOT_AGENTS = ("-",
               )
 
 def standardize_refer(request):
-    url = request.META.get('HTTP_REFERER', '')
+    return standardize_refer_url(request.META.get('HTTP_REFERER', ''))
+
+def standardize_refer_url(url):
     parts = urlparse.urlparse(url)
     standard = parts.netloc
     if standard.startswith("www.google"):
@@ -62,37 +91,55 @@ def page_analytics(page, cli=None, now=None, num_refs=None, days_back=None):
     num_refs = num_refs if (num_refs is not None) else settings.MAX_ANALYTICS_RESULTS
     days_back = days_back if (days_back is not None) else settings.ANALYTICS_SITE_DAYS_BACK
 
-    response = { 'views':0, 'avg_daily_views':None, 'recent_days':[], 'referrers':[] }
+    response = { 'views':0, 'avg_daily_views':None, 'recent_days':[], 'referrers':[], 'uniques':None }
+    series = sisyphus.timeseries.page_series(slug)
 
     if days_back > 0:
         pipeline = cli.pipeline()
+        sisyphus.timeseries.queue_read(pipeline, series)
         pipeline.zrevrangebyscore(ANALYTICS_REFER_PAGE % slug, "+inf",
                                   settings.MIN_PAGE_REF_PV,
                                   start=0,
-                                  num=days_back,
+                                  num=num_refs,
                                   withscores=True)
         pipeline.zscore(ANALYTICS_PAGEVIEW, slug)
 
         day_bucket = now / (24 * 60 * 60)
         bucket_keys = range(day_bucket, day_bucket-days_back, -1)
-        pageview_page_bucket_key = ANALYTICS_PAGEVIEW_PAGE_BUCKET % slug
-        for bucket_key in bucket_keys:
-            pipeline.zscore(pageview_page_bucket_key, bucket_key)
+        if compact_analytics():
+            pipeline.hmget(ANALYTICS_DAYS_PAGE % slug, bucket_keys)
+            pipeline.pfcount(ANALYTICS_UNIQUES_PAGE % slug)
+        else:
+            pageview_page_bucket_key = ANALYTICS_PAGEVIEW_PAGE_BUCKET % slug
+            for bucket_key in bucket_keys:
+                pipeline.zscore(pageview_page_bucket_key, bucket_key)
         results = pipeline.execute()
+        response['series'] = sisyphus.timeseries.parse_read(results[:sisyphus.timeseries.KEYS_PER_SERIES], now)
+        results = results[sisyphus.timeseries.KEYS_PER_SERIES:]
         response['views'] = int(results[1] or 0)
         response['referrers'] = [(x,int(y)) for x,y in results[0]]
-        recent_days = [(datetime.datetime.fromtimestamp(x*(60*60*24)), int(y)) for x,y in zip(bucket_keys, results[2:]) if y]
+        if compact_analytics():
+            day_views = results[2]
+            response['uniques'] = results[3]
+        else:
+            day_views = results[2:]
+        recent_days = [(datetime.datetime.fromtimestamp(x*(60*60*24)), int(y)) for x,y in zip(bucket_keys, day_views) if y]
         response['recent_days'] = recent_days
     else:
         response['views'] = int(cli.zscore(ANALYTICS_PAGEVIEW, slug) or 0)
+        response['series'] = sisyphus.timeseries.read(series, now, cli)
+
+    response['avg_daily_views'] = average_daily_views(response['views'], page['pub_date'])
+    return response
 
-    # calculate average daily views
+def average_daily_views(views, pub_date):
+    "Average views per day since publication, or None for pages under a day old."
+    if pub_date is None:
+        return None
     try:
-        response['avg_daily_views'] = response['views'] / (datetime.datetime.today() - page['pub_date']).days
+        return views / (datetime.datetime.today() - pub_date).days
     except ZeroDivisionError:
-        pass
-
-    return response
+        return None
 
 def abbreviated_site_analytics(cli=None, now=None, max_results=None):
     "Get site analytics used for site analytics module."
@@ -112,69 +159,543 @@ def site_analytics(cli=None, now=None, max_results=None):
     max_results = max_results if (max_results is not None) else settings.MAX_ANALYTICS_RESULTS
 
     pipeline = cli.pipeline()
+    sisyphus.timeseries.queue_read(pipeline, sisyphus.timeseries.site_series())
     pipeline.zrevrangebyscore(ANALYTICS_REFER, "+inf", settings.MIN_PAGE_REF_PV, start=0, num=max_results, withscores=True)
     pipeline.zrevrangebyscore(ANALYTICS_PAGEVIEW, "+inf", settings.MIN_PAGE_PV, start=0, num=max_results, withscores=True)
     pipeline.zrevrangebyscore(ANALYTICS_USERAGENT, "+inf", settings.MIN_USERAGENT, start=0, num=max_results, withscores=True)
 
     day_bucket = now / (24 * 60 * 60)
     bucket_keys = range(day_bucket, day_bucket-settings.ANALYTICS_SITE_DAYS_BACK, -1)
-    for bucket_key in bucket_keys:
-        pipeline.zscore(ANALYTICS_PAGEVIEW_BUCKET, bucket_key)
+    if compact_analytics():
+        pipeline.hmget(ANALYTICS_DAYS, bucket_keys)
+        pipeline.pfcount(*[ ANALYTICS_UNIQUES_DAY % x for x in bucket_keys ])
+    else:
+        for bucket_key in bucket_keys:
+            pipeline.zscore(ANALYTICS_PAGEVIEW_BUCKET, bucket_key)
 
     results = pipeline.execute()
+    series = sisyphus.timeseries.parse_read(results[:sisyphus.timeseries.KEYS_PER_SERIES], now)
+    results = results[sisyphus.timeseries.KEYS_PER_SERIES:]
+    if compact_analytics():
+        day_views, uniques = results[3], results[4]
+    else:
+        day_views, uniques = results[3:], None
     return { 'pageviews': [(x, int(y)) for x,y in results[1]],
              'referrers': [(x, int(y)) for x,y in results[0]],
              'useragents': [(x, int(y)) for x,y in results[2]],
-             'recent_days': [(datetime.datetime.fromtimestamp(x*(60*60*24)), int(y)) for x,y in zip(bucket_keys, results[3:]) if y],
+             'recent_days': [(datetime.datetime.fromtimestamp(x*(60*60*24)), int(y)) for x,y in zip(bucket_keys, day_views) if y],
+             'uniques': uniques,
+             'series': series,
              }
 
-def track(request, page, cli, now=None):
+def should_track(slug, useragent):
+    "Filter out images, bots and feed readers."
+    lowered = useragent.lower()
+    return not slug.endswith('.png') and \
+        useragent not in BOT_AGENTS and \
+        'subscribers' not in lowered and \
+        'bot' not in lowered and \
+        not useragent.startswith('Reeder')
+
+def request_event(request, page, now=None):
+    """
+    Reduce a pageview to a compact (timestamp, slug, referrer,
+    user-agent, ip, tag slugs) event, or None if it shouldn't be tracked.
+    """
     now = now or int(time.time())
     slug = page['slug']
-    useragent = request.META['HTTP_USER_AGENT']
-    lowered = useragent.lower()
-    if not slug.endswith('.png') and \
-            useragent not in BOT_AGENTS and \
-            'subscribers' not in lowered and \
-            'bot' not in lowered and \
-            not useragent.startswith('Reeder'):
+    useragent = request.META.get('HTTP_USER_AGENT', '-')
+    if should_track(slug, useragent):
         refer = standardize_refer(request)
         ip = "X-Real-IP" # if proxied
         ip = request.META.get("HTTP_X_REAL_IP", request.META.get("REMOTE_ADDR", "127.0.0.1"))
-        day_bucket = now / (24 * 60 * 60)
-        hour_bucket = now / (60 * 60)
-        min_bucket = now / 60
+        tags = tuple(x[1] for x in page.get('tags') or ())
+        return (now, slug, refer, useragent, ip, tags)
+
+def event_backoff_key(event):
+    "Key recording that an IP was tracked in the event's minute."
+    now, slug, refer, useragent, ip, tags = event
+    return ANALYTICS_BACKOFF % (ip, now / 60)
+
+def counter_updates(event):
+    "List the (key, member, amount) sorted set increments for an event."
+    now, slug, refer, useragent, ip, tags = event
+    day_bucket = now / (24 * 60 * 60)
+    return [
+        # update referer analytics
+        (ANALYTICS_REFER, refer, 1),
+        (ANALYTICS_REFER_PAGE % slug, refer, 1),
+        # update all-time pageview analytics
+        (ANALYTICS_PAGEVIEW, slug, 1),
+        # update user-agents
+        (ANALYTICS_USERAGENT, useragent, 1),
+        # update time bucket analytics
+        (ANALYTICS_PAGEVIEW_BUCKET, day_bucket, 1),
+        (ANALYTICS_PAGEVIEW_PAGE_BUCKET % slug, day_bucket, 1),
+        ]
+
+def event_series(event):
+    "Names of the traffic series an event counts towards."
+    now, slug, refer, useragent, ip, tags = event
+    return [sisyphus.timeseries.site_series(), sisyphus.timeseries.page_series(slug)] + \
+        [ sisyphus.timeseries.tag_series(x) for x in tags ]
+
+# KEYS: backoff key, one sorted set per increment, then the keys of
+#       each traffic series
+# ARGV: backoff ttl, timestamp, number of sorted sets, then
+#       (amount, member) per sorted set
+TRACK_SCRIPT = sisyphus.timeseries.LUA + """
+if not redis.call('SET', KEYS[1], 1, 'EX', ARGV[1], 'NX') then
+    return 0
+end
+local sets = tonumber(ARGV[3])
+for i = 1, sets do
+    redis.call('ZINCRBY', KEYS[i + 1], ARGV[2 + 2 * i], ARGV[3 + 2 * i])
+end
+series_incr_all(sets + 2, (#KEYS - sets - 1) / %s, tonumber(ARGV[2]), 1)
+return 1
+""" % sisyphus.timeseries.KEYS_PER_SERIES
+
+# KEYS: backoff key, pageviews, site days, page days, site referrers,
+#       page referrers, user-agents, page uniques, site uniques for the day,
+#       then the keys of each traffic series
+# ARGV: backoff ttl (0 skips the backoff), slug, day bucket, referrer,
+#       user-agent, ip, per page top-k, site-wide top-k, daily uniques ttl,
+#       timestamp
+COMPACT_TRACK_SCRIPT = sisyphus.timeseries.LUA + """
+local function topk_incr(key, member, k)
+    if redis.call('ZSCORE', key, member) or redis.call('ZCARD', key) < k then
+        redis.call('ZINCRBY', key, 1, member)
+    else
+        -- space-saving: a new member replaces the least counted one,
+        -- inheriting its count as an upper bound on its own
+        local smallest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+        redis.call('ZREM', key, smallest[1])
+        redis.call('ZADD', key, tonumber(smallest[2]) + 1, member)
+    end
+end
+
+local ttl = tonumber(ARGV[1])
+if ttl > 0 and not redis.call('SET', KEYS[1], 1, 'EX', ttl, 'NX') then
+    return 0
+end
+redis.call('ZINCRBY', KEYS[2], 1, ARGV[2])
+redis.call('HINCRBY', KEYS[3], ARGV[3], 1)
+redis.call('HINCRBY', KEYS[4], ARGV[3], 1)
+topk_incr(KEYS[5], ARGV[4], tonumber(ARGV[8]))
+topk_incr(KEYS[6], ARGV[4], tonumber(ARGV[7]))
+topk_incr(KEYS[7], ARGV[5], tonumber(ARGV[8]))
+redis.call('PFADD', KEYS[8], ARGV[6])
+redis.call('PFADD', KEYS[9], ARGV[6])
+redis.call('EXPIRE', KEYS[9], ARGV[9])
+series_incr_all(10, (#KEYS - 9) / %s, tonumber(ARGV[10]), 1)
+return 1
+""" % sisyphus.timeseries.KEYS_PER_SERIES
 
-        backoff_key = ANALYTICS_BACKOFF % (ip, min_bucket)
-        cli.watch(backoff_key)
-        should_track = not cli.exists(backoff_key)
-        if should_track:
-            pipeline = cli.pipeline()
+def compact_analytics():
+    """
+    Whether analytics use compact storage: day counts in hashes folded
+    into weeks and months by ``fold_analytics``, referrers and
+    user-agents capped to the top ``ANALYTICS_TOP_K`` per page and
+    ``ANALYTICS_SITE_TOP_K`` site-wide, and HyperLogLog unique visitors.
+    """
+    return getattr(settings, 'ANALYTICS_COMPACT', False)
 
-            # update referer analytics
-            pipeline.zincrby(ANALYTICS_REFER, refer, 1)
-            pipeline.zincrby(ANALYTICS_REFER_PAGE % slug, refer, 1)
+def compact_track(event, cli, backoff_ttl=60):
+    "Run the compact tracking script for event on cli, which may be a pipeline."
+    now, slug, refer, useragent, ip, tags = event
+    day_bucket = now / DAY
+    keys = [event_backoff_key(event),
+            ANALYTICS_PAGEVIEW,
+            ANALYTICS_DAYS,
+            ANALYTICS_DAYS_PAGE % slug,
+            ANALYTICS_REFER,
+            ANALYTICS_REFER_PAGE % slug,
+            ANALYTICS_USERAGENT,
+            ANALYTICS_UNIQUES_PAGE % slug,
+            ANALYTICS_UNIQUES_DAY % day_bucket,
+            ] + sisyphus.timeseries.series_keys(event_series(event))
+    args = [backoff_ttl, slug, day_bucket, refer, useragent, ip,
+            getattr(settings, 'ANALYTICS_TOP_K', 100),
+            getattr(settings, 'ANALYTICS_SITE_TOP_K', 1000),
+            getattr(settings, 'ANALYTICS_RETENTION_DAYS', 90) * DAY,
+            now,
+            ]
+    return sisyphus.models.lua_script(COMPACT_TRACK_SCRIPT)(keys=keys, args=args, client=cli)
+
+def track(request, page, cli, now=None):
+    """
+    Record a pageview, at most once per IP per minute. The backoff
+    check and the increments run as one script, so tracking is a
+    single round trip and atomic under concurrent requests.
+    """
+    event = request_event(request, page, now)
+    if event:
+        if compact_analytics():
+            return bool(compact_track(event, cli))
+        updates = counter_updates(event)
+        keys = [event_backoff_key(event)] + [ x[0] for x in updates ] + \
+            sisyphus.timeseries.series_keys(event_series(event))
+        args = [60, event[0], len(updates)]
+        for key, member, amount in updates:
+            args.extend((amount, member))
+        return bool(sisyphus.models.lua_script(TRACK_SCRIPT)(keys=keys, args=args, client=cli))
+    return False
+
+def coalesce_updates(events):
+    "Sum the counter updates of events by (key, member)."
+    counts = collections.defaultdict(int)
+    for event in events:
+        for key, member, amount in counter_updates(event):
+            counts[(key, member)] += amount
+    return counts
+
+def write_updates(counts, cli, batch_size=10000):
+    "Apply coalesced counts with ZINCRBY, in pipelines of batch_size commands."
+    items = counts.items()
+    for i in xrange(0, len(items), batch_size):
+        pipeline = cli.pipeline(transaction=False)
+        for (key, member), amount in items[i:i+batch_size]:
+            pipeline.zincrby(key, member, amount)
+        pipeline.execute()
+
+def write_series(events, cli, batch_size=10000):
+    """
+    Count events towards their traffic series, with one increment per
+    series per minute, since a minute falls in one bucket at every
+    resolution.
+    """
+    counts = collections.defaultdict(int)
+    for event in events:
+        for name in event_series(event):
+            counts[(name, event[0] / 60 * 60)] += 1
+    items = counts.items()
+    for i in xrange(0, len(items), batch_size):
+        pipeline = cli.pipeline(transaction=False)
+        for (name, minute), amount in items[i:i+batch_size]:
+            sisyphus.timeseries.incr([name], now=minute, amount=amount, cli=pipeline)
+        pipeline.execute()
+
+def claim_backoffs(events, cli, ttl=60):
+    """
+    Keep the first event per IP per minute whose backoff key
+    isn't already set, setting it with one pipeline of SET NX EX.
+    """
+    firsts = {}
+    for event in events:
+        firsts.setdefault(event_backoff_key(event), event)
+    backoff_keys = firsts.keys()
+    pipeline = cli.pipeline(transaction=False)
+    for backoff_key in backoff_keys:
+        pipeline.set(backoff_key, 1, ex=ttl, nx=True)
+    return [ firsts[x] for x, claimed in zip(backoff_keys, pipeline.execute()) if claimed ]
+
+def record_events(events, cli, batch_size=10000):
+    "Apply the counters of events which have already claimed their backoff keys."
+    if compact_analytics():
+        for i in xrange(0, len(events), batch_size):
+            pipeline = cli.pipeline(transaction=False)
+            for event in events[i:i+batch_size]:
+                compact_track(event, pipeline, backoff_ttl=0)
+            pipeline.execute()
+    else:
+        write_updates(coalesce_updates(events), cli, batch_size)
+        write_series(events, cli, batch_size)
 
-            # update all-time pageview analytics
-            pipeline.zincrby(ANALYTICS_PAGEVIEW, slug, 1)
+def flush_events(events, cli):
+    """
+    Record a batch of buffered events: one pipeline claims the
+    one-per-IP-per-minute backoff keys, and one applies the
+    increments of the events which claimed them, coalesced into
+    a single ZINCRBY per key and member outside compact mode.
+    """
+    accepted = claim_backoffs(events, cli)
+    record_events(accepted, cli)
+    return len(accepted)
 
-            # update user-agents
-            pipeline.zincrby(ANALYTICS_USERAGENT, useragent, 1)
 
-            # update time bucket analytics
-            pipeline.zincrby(ANALYTICS_PAGEVIEW_BUCKET, day_bucket, 1)
-            pipeline.zincrby(ANALYTICS_PAGEVIEW_PAGE_BUCKET % slug, day_bucket, 1)
+class EventBuffer(object):
+    """
+    Bounded in-process queue of events, drained by a background
+    thread which passes everything queued to flush(events, cli)
+    every interval seconds. Events arriving while the queue is
+    full are dropped rather than slowing down requests.
+    """
 
-            # buckets for users
+    def __init__(self, flush, maxsize=10000, interval=0.5):
+        self.flush = flush
+        self.interval = interval
+        self.queue = Queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        # counters are updated from request threads and the flusher
+        self.stats_lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.errors = 0
 
-            # only record one action per IP per minute
-            pipeline.set(backoff_key, 1)
-            pipeline.expire(backoff_key, 60)
+    def ensure_started(self):
+        "Start the flusher thread, restarting it in forked children."
+        if self.thread is None or self.pid != os.getpid():
+            with self.lock:
+                if self.thread is None or self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    self.queue = Queue.Queue(self.queue.maxsize)
+                    self.thread = threading.Thread(target=self.run)
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def put(self, event):
+        "Queue event, returning False if it was dropped."
+        self.ensure_started()
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            with self.stats_lock:
+                self.dropped += 1
+            return False
+        with self.stats_lock:
+            self.enqueued += 1
+        return True
+
+    def drain(self):
+        events = []
+        try:
+            while True:
+                events.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return events
+
+    def flush_now(self):
+        "Flush everything queued so far."
+        events = self.drain()
+        if events:
             try:
-                pipeline.execute()
-            except redis.exceptions.WatchError:
-                # another request already got in
-                # for this timebox for this IP
-                pass
-        else:
-            cli.unwatch()
+                self.flush(events, sisyphus.models.redis_client())
+            except Exception:
+                with self.stats_lock:
+                    self.errors += 1
+                logging.getLogger(__name__).exception("Failed to flush %s events", len(events))
+            else:
+                with self.stats_lock:
+                    self.flushed += len(events)
+                    self.flushes += 1
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush_now()
+
+    def stats(self):
+        with self.stats_lock:
+            return { 'queued': self.queue.qsize(),
+                     'max_queued': self.queue.maxsize,
+                     'enqueued': self.enqueued,
+                     'dropped': self.dropped,
+                     'flushed': self.flushed,
+                     'flushes': self.flushes,
+                     'errors': self.errors,
+                     }
+
+def configured_buffer(flush, prefix='ANALYTICS'):
+    "Create an EventBuffer sized by the <prefix>_BUFFER_SIZE and <prefix>_FLUSH_INTERVAL_MS settings."
+    buf = EventBuffer(flush,
+                      maxsize=getattr(settings, '%s_BUFFER_SIZE' % prefix, 10000),
+                      interval=getattr(settings, '%s_FLUSH_INTERVAL_MS' % prefix, 500) / 1000.0)
+    atexit.register(buf.flush_now)
+    return buf
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def event_buffer():
+    "Return the process-wide buffer of pageview events."
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = configured_buffer(flush_events)
+    return _buffer
+
+def track_buffered(request, page, now=None):
+    "Queue a pageview to be recorded by the background flusher."
+    event = request_event(request, page, now)
+    if event:
+        event_buffer().put(event)
+
+
+# KEYS: source hash, destination hash
+# ARGV: (source field, destination field) pairs
+FOLD_SCRIPT = """
+local folded = 0
+for i = 1, #ARGV, 2 do
+    local count = redis.call('HGET', KEYS[1], ARGV[i])
+    if count then
+        redis.call('HINCRBY', KEYS[2], ARGV[i + 1], count)
+        redis.call('HDEL', KEYS[1], ARGV[i])
+        folded = folded + 1
+    end
+end
+return folded
+"""
+
+def compact_keys(slug=None):
+    "Return the (days, weeks, months) hashes for a page, or the site if slug is None."
+    if slug is None:
+        return ANALYTICS_DAYS, ANALYTICS_WEEKS, ANALYTICS_MONTHS
+    return ANALYTICS_DAYS_PAGE % slug, ANALYTICS_WEEKS_PAGE % slug, ANALYTICS_MONTHS_PAGE % slug
+
+def month_bucket(week_bucket):
+    "Month (as months since year 0) containing the first day of week_bucket."
+    first_day = datetime.datetime.utcfromtimestamp(week_bucket * 7 * DAY)
+    return first_day.year * 12 + first_day.month - 1
+
+def fold_counters(slug=None, cli=None, now=None):
+    """
+    Fold day counts older than ``ANALYTICS_RETENTION_DAYS`` into weeks,
+    and week counts older than ``ANALYTICS_RETENTION_WEEKS`` into months,
+    returning the number of fields folded. Each fold is atomic, so it
+    is safe to run while pageviews are tracked.
+    """
+    cli = cli or sisyphus.models.redis_client()
+    now = now or int(time.time())
+    days_key, weeks_key, months_key = compact_keys(slug)
+    fold = sisyphus.models.lua_script(FOLD_SCRIPT)
+    folded = 0
+
+    oldest_day = now / DAY - getattr(settings, 'ANALYTICS_RETENTION_DAYS', 90)
+    args = []
+    for day in cli.hkeys(days_key):
+        if int(day) < oldest_day:
+            args.extend((day, int(day) / 7))
+    if args:
+        folded += fold(keys=[days_key, weeks_key], args=args, client=cli)
+
+    oldest_week = now / DAY / 7 - getattr(settings, 'ANALYTICS_RETENTION_WEEKS', 52)
+    args = []
+    for week in cli.hkeys(weeks_key):
+        if int(week) < oldest_week:
+            args.extend((week, month_bucket(int(week))))
+    if args:
+        folded += fold(keys=[weeks_key, months_key], args=args, client=cli)
+    return folded
+
+def convert_to_compact(slug=None, cli=None):
+    """
+    Move a page's (or the site's) day buckets from the sorted set used
+    by default into the compact day hash, and trim its referrers (and the
+    site's user-agents) to the top-k kept in compact mode.
+    """
+    cli = cli or sisyphus.models.redis_client()
+    if slug is None:
+        bucket_key, days_key = ANALYTICS_PAGEVIEW_BUCKET, ANALYTICS_DAYS
+        top_k = getattr(settings, 'ANALYTICS_SITE_TOP_K', 1000)
+        trimmed = (ANALYTICS_REFER, ANALYTICS_USERAGENT)
+    else:
+        bucket_key, days_key = ANALYTICS_PAGEVIEW_PAGE_BUCKET % slug, ANALYTICS_DAYS_PAGE % slug
+        top_k = getattr(settings, 'ANALYTICS_TOP_K', 100)
+        trimmed = (ANALYTICS_REFER_PAGE % slug,)
+    buckets = cli.zrange(bucket_key, 0, -1, withscores=True)
+    pipeline = cli.pipeline()
+    for day, count in buckets:
+        pipeline.hincrby(days_key, day, int(count))
+    pipeline.delete(bucket_key)
+    for key in trimmed:
+        pipeline.zremrangebyrank(key, 0, -(top_k + 1))
+    pipeline.execute()
+
+
+def dump_dashboard(data, now):
+    "Serialize analytics for a dashboard, with day buckets in place of datetimes."
+    data = dict(data)
+    data['recent_days'] = [ (int(time.mktime(x.timetuple())) / DAY, y) for x, y in data['recent_days'] ]
+    data['series'] = sisyphus.timeseries.dump(data['series'])
+    data['generated'] = now
+    return json.dumps(data)
+
+def load_dashboard(raw):
+    "Inverse of dump_dashboard."
+    data = json.loads(raw)
+    for key in ('pageviews', 'referrers', 'useragents'):
+        if key in data:
+            data[key] = [ tuple(x) for x in data[key] ]
+    data['recent_days'] = [ (datetime.datetime.fromtimestamp(x * DAY), y) for x, y in data['recent_days'] ]
+    data['series'] = sisyphus.timeseries.load(data['series'])
+    data['generated'] = datetime.datetime.fromtimestamp(data['generated'])
+    return data
+
+def rollup(cli=None, now=None, batch_size=500):
+    """
+    Precompute the site dashboard and the dashboard of every page
+    with pageviews, each into a single key, returning the number of
+    pages rolled up.
+    """
+    cli = cli or sisyphus.models.redis_client()
+    now = now or int(time.time())
+    ttl = getattr(settings, 'ANALYTICS_ROLLUP_MAX_AGE', 3600)
+    cli.setex(ANALYTICS_DASHBOARD_SITE, dump_dashboard(site_analytics(cli=cli, now=now), now), ttl)
+    pages = 0
+    pipeline = cli.pipeline(transaction=False)
+    for slug, views in cli.zscan_iter(ANALYTICS_PAGEVIEW):
+        data = page_analytics({ 'slug': slug, 'pub_date': None }, cli=cli, now=now)
+        pipeline.setex(ANALYTICS_DASHBOARD_PAGE % slug, dump_dashboard(data, now), ttl)
+        pages += 1
+        if pages % batch_size == 0:
+            pipeline.execute()
+    pipeline.execute()
+    return pages
+
+def cached_site_analytics(cli=None):
+    "Site analytics from the last rollup, computed live if there isn't one."
+    cli = cli or sisyphus.models.redis_client()
+    raw = cli.get(ANALYTICS_DASHBOARD_SITE)
+    if raw is None:
+        return site_analytics(cli=cli)
+    return load_dashboard(raw)
+
+def cached_page_analytics(page, cli=None):
+    "Page analytics from the last rollup, computed live if there isn't one."
+    cli = cli or sisyphus.models.redis_client()
+    raw = cli.get(ANALYTICS_DASHBOARD_PAGE % page['slug'])
+    if raw is None:
+        return page_analytics(page, cli=cli)
+    data = load_dashboard(raw)
+    data['avg_daily_views'] = average_daily_views(data['views'], page['pub_date'])
+    return data
+
+_rollup_thread = None
+_rollup_lock = threading.Lock()
+
+def run_rollups(interval):
+    while True:
+        try:
+            cli = sisyphus.models.redis_client()
+            # one process rolls up per interval, however many are running
+            if cli.set(ANALYTICS_ROLLUP_LOCK, os.getpid(), ex=max(int(interval) - 1, 1), nx=True):
+                rollup(cli=cli)
+        except Exception:
+            logging.getLogger(__name__).exception("Failed to roll up analytics")
+        time.sleep(interval)
+
+def ensure_rollup_thread():
+    """
+    Start the background thread rolling up dashboards every
+    ``ANALYTICS_ROLLUP_INTERVAL`` seconds, if that is set, restarting
+    it after a fork.
+    """
+    global _rollup_thread
+    interval = getattr(settings, 'ANALYTICS_ROLLUP_INTERVAL', None)
+    if not interval:
+        return
+    thread = _rollup_thread
+    if thread is None or thread.pid != os.getpid():
+        with _rollup_lock:
+            if _rollup_thread is None or _rollup_thread.pid != os.getpid():
+                _rollup_thread = threading.Thread(target=run_rollups, args=(interval,))
+                _rollup_thread.daemon = True
+                _rollup_thread.pid = os.getpid()
+                _rollup_thread.start()
@@ -0,0 +1,580 @@
+"""
+Benchmarks for Sisyphus' storage paths.
+
+Benchmarks run against a scratch Redis database (``BENCHMARK_REDIS_DB``,
+15 by default) which is flushed before seeding, so it must never be the
+database configured in ``REDIS_DB``, or against an in-process fakeredis
+server if ``BENCHMARK_FAKEREDIS`` is True (which needs lupa for Lua
+scripts). Run them with:
+
+    python manage.py benchmark [--output results.json] [name name ...]
+
+Each benchmark returns a list of result rows (dicts) and is registered
+in ``BENCHMARKS`` by name.
+"""
+import time
+import random
+import shutil
+import tempfile
+import redis
+import whoosh.index
+import whoosh.qparser
+import multiprocessing
+import os.path
+from django.conf import settings
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import sisyphus.models
+import sisyphus.analytics
+import sisyphus.trending
+
+BENCHMARKS = {}
+
+WORDS = ("redis", "django", "python", "search", "index", "cache", "latency",
+         "throughput", "queue", "feed", "markdown", "deploy", "analytics",
+         "trend", "page", "tag", "writer", "reader", "pool", "socket")
+
+
+class CountingMixin(object):
+    "Count the requests a connection writes to Redis in CountingConnection.sent."
+
+    def send_packed_command(self, *args, **kwargs):
+        CountingConnection.sent += 1
+        return super(CountingMixin, self).send_packed_command(*args, **kwargs)
+
+
+class CountingConnection(CountingMixin, redis.Connection):
+    "Connection which counts the requests it writes to Redis."
+    sent = 0
+
+
+_previous_pools = []
+
+def scratch_client():
+    """
+    Return a client for the benchmark database, which is flushed, and
+    make it the database used by the process-wide connection pool until
+    release_scratch_client is called.
+    """
+    if getattr(settings, 'BENCHMARK_FAKEREDIS', False):
+        import fakeredis
+        connection_class = type('CountingFakeConnection', (CountingMixin, fakeredis.FakeConnection), {})
+        pool = sisyphus.models.ConnectionPool(connection_class=connection_class, server=fakeredis.FakeServer())
+    else:
+        db = getattr(settings, 'BENCHMARK_REDIS_DB', 15)
+        if db == getattr(settings, 'REDIS_DB', 0):
+            raise ValueError("BENCHMARK_REDIS_DB must differ from REDIS_DB")
+        pool = sisyphus.models.ConnectionPool(connection_class=CountingConnection,
+                                              host=getattr(settings, 'REDIS_HOST', 'localhost'),
+                                              port=getattr(settings, 'REDIS_PORT', 6379),
+                                              db=db)
+    cli = redis.Redis(connection_pool=pool)
+    cli.flushdb()
+    # point views and anything else using the shared pool at the scratch database
+    with sisyphus.models._pool_lock:
+        _previous_pools.append(sisyphus.models._pool)
+        sisyphus.models._pool = pool
+    return cli
+
+def release_scratch_client(cli):
+    """
+    Flush the benchmark database and restore the connection pool
+    replaced by scratch_client, first writing out anything buffered
+    and dropping anything cached while the scratch database was in use.
+    """
+    import sisyphus.cache
+    try:
+        if sisyphus.models._trend_buffer is not None:
+            sisyphus.models._trend_buffer.flush_now()
+        if sisyphus.analytics._buffer is not None:
+            sisyphus.analytics._buffer.flush_now()
+        sisyphus.cache.module_cache().local.clear()
+        sisyphus.cache.response_cache().clear()
+        cli.flushdb()
+    finally:
+        with sisyphus.models._pool_lock:
+            sisyphus.models._pool = _previous_pools.pop()
+
+def round_trips(func, *args, **kwargs):
+    "Call func, returning (result, round trips made, seconds taken)."
+    before = CountingConnection.sent
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, CountingConnection.sent - before, time.time() - start
+
+def percentile(values, pct):
+    "Return the pct percentile of values."
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(int(round(pct / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+def lorem(num_words, rand=random):
+    return " ".join(rand.choice(WORDS) for x in xrange(num_words))
+
+def seed_corpus(cli, num_pages, num_tags=50, tags_per_page=4, html_words=800, seed=0):
+    "Write a synthetic corpus of published pages into cli."
+    rand = random.Random(seed)
+    tag_slugs = [ "tag-%s" % x for x in xrange(num_tags) ]
+    now = int(time.time())
+    pipeline = cli.pipeline(transaction=False)
+    for i in xrange(num_pages):
+        slug = "page-%s" % i
+        pub_date = now - (num_pages - i) * 3600
+        page = { 'slug': slug,
+                 'title': lorem(6, rand).title(),
+                 'summary': lorem(30, rand),
+                 'html': "<p>%s</p>" % lorem(html_words, rand),
+                 'tags': rand.sample(tag_slugs, min(tags_per_page, num_tags)),
+                 'pub_date': pub_date,
+                 'edit_date': pub_date,
+                 'published': True,
+                 }
+        sisyphus.models.write_page(page, pipeline)
+        pipeline.zadd(sisyphus.models.PAGE_ZSET_BY_TIME, slug, pub_date)
+        pipeline.zadd(sisyphus.models.PAGE_ZSET_BY_TREND, slug, sisyphus.trending.publish_score(pub_date))
+        for tag in page['tags']:
+            pipeline.zadd(sisyphus.models.TAG_PAGES_ZSET_BY_TIME % tag, slug, pub_date)
+            pipeline.zadd(sisyphus.models.TAG_PAGES_ZSET_BY_TREND % tag, slug, sisyphus.trending.publish_score(pub_date))
+            pipeline.zincrby(sisyphus.models.TAG_ZSET_BY_PAGES, tag, 1)
+        if i % 1000 == 999:
+            pipeline.execute()
+    pipeline.execute()
+    return num_pages
+
+
+def bench_hydration(sizes=(10, 100, 1000), repeat=5):
+    """
+    Compare fetching a page list with a per-page round trip for
+    tag counts against batched hydration, of full pages and of
+    the summaries lists render from.
+    """
+    cli = scratch_client()
+    seed_corpus(cli, max(sizes))
+
+    def per_page(slugs):
+        pages = sisyphus.models.hydrate_pages(slugs, cli=cli, with_tag_counts=False)
+        return [ sisyphus.models.add_tag_counts(x, cli=cli) for x in pages ]
+
+    def batched(slugs):
+        return sisyphus.models.hydrate_pages(slugs, cli=cli)
+
+    def summaries(slugs):
+        return sisyphus.models.hydrate_summaries(slugs, cli=cli)
+
+    rows = []
+    try:
+        for size in sizes:
+            slugs = sisyphus.models.get_page_slugs(limit=size, cli=cli)
+            for name, func in (('per_page', per_page), ('batched', batched), ('summaries', summaries)):
+                timings = []
+                for x in xrange(repeat):
+                    pages, trips, secs = round_trips(func, slugs)
+                    timings.append(secs)
+                rows.append({ 'pages': size,
+                              'method': name,
+                              'round_trips': trips,
+                              'p50_ms': percentile(timings, 50) * 1000,
+                              'max_ms': max(timings) * 1000,
+                              })
+    finally:
+        release_scratch_client(cli)
+    return rows
+BENCHMARKS['hydration'] = bench_hydration
+
+
+def bench_search(num_pages=50000, queries=("redis", "cache latency", "python OR django"), repeat=5):
+    """
+    Compare opening the index and materializing every match for each
+    query against the long-lived searcher returning one page of results.
+    """
+    cli = scratch_client()
+    seed_corpus(cli, num_pages, html_words=100)
+    index_dir = tempfile.mkdtemp()
+    old_index_dir = settings.WHOOSH_INDEXDIR
+    settings.WHOOSH_INDEXDIR = index_dir
+    try:
+        start = time.time()
+        sisyphus.models.reindex_pages(cli=cli)
+        rows = [{ 'pages': num_pages, 'method': 'index', 'secs': time.time() - start }]
+
+        def unpaged(raw_query):
+            searcher = whoosh.index.open_dir(index_dir).searcher()
+            try:
+                query = whoosh.qparser.QueryParser('content', sisyphus.models.PAGE_SCHEMA).parse(raw_query)
+                slugs = [ x['slug'] for x in searcher.search(query, limit=None) ]
+                return sisyphus.models.hydrate_pages(slugs, cli=cli)
+            finally:
+                searcher.close()
+
+        def paged(raw_query):
+            return sisyphus.models.search(raw_query, limit=10, cli=cli)[0]
+
+        for raw_query in queries:
+            for name, func in (('unpaged', unpaged), ('paged', paged)):
+                timings = []
+                for x in xrange(repeat):
+                    pages, trips, secs = round_trips(func, raw_query)
+                    timings.append(secs)
+                rows.append({ 'pages': num_pages,
+                              'query': raw_query,
+                              'method': name,
+                              'hydrated': len(pages),
+                              'p50_ms': percentile(timings, 50) * 1000,
+                              'max_ms': max(timings) * 1000,
+                              })
+    finally:
+        settings.WHOOSH_INDEXDIR = old_index_dir
+        shutil.rmtree(index_dir)
+        release_scratch_client(cli)
+    return rows
+BENCHMARKS['search'] = bench_search
+
+
+def bench_tracking(num_requests=2000, num_pages=100):
+    """
+    Compare the latency of cached page views without analytics,
+    with analytics written to Redis during the request, and with
+    analytics queued for the background flusher.
+    """
+    from django.test.client import RequestFactory
+    import sisyphus.views
+    import sisyphus.analytics
+    import sisyphus.cache
+    cli = scratch_client()
+    seed_corpus(cli, num_pages, html_words=100)
+    slugs = [ "page-%s" % x for x in xrange(num_pages) ]
+    factory = RequestFactory()
+    old_settings = (settings.REALTIME_ANALYTICS,
+                    getattr(settings, 'ANALYTICS_BUFFERED', False),
+                    getattr(settings, 'TRENDING_BUFFERED', True))
+    rows = []
+    try:
+        for name, realtime, buffered in (('untracked', False, False), ('sync', True, False), ('buffered', True, True)):
+            settings.REALTIME_ANALYTICS = realtime
+            settings.ANALYTICS_BUFFERED = buffered
+            settings.TRENDING_BUFFERED = buffered
+            sisyphus.cache.response_cache().clear()
+            for slug in slugs:
+                sisyphus.views.page(factory.get("/%s/" % slug), slug)
+            timings = []
+            total_trips = 0
+            for i in xrange(num_requests):
+                request = factory.get("/%s/" % slugs[i % num_pages],
+                                      HTTP_USER_AGENT="Mozilla/5.0 (benchmark)",
+                                      REMOTE_ADDR="10.0.%s.%s" % (i // 250 % 250, i % 250))
+                response, trips, secs = round_trips(sisyphus.views.page, request, slugs[i % num_pages])
+                timings.append(secs)
+                total_trips += trips
+            if buffered:
+                start = time.time()
+                sisyphus.models.trend_buffer().flush_now()
+                sisyphus.analytics.event_buffer().flush_now()
+                flush_secs = time.time() - start
+            else:
+                flush_secs = 0.0
+            rows.append({ 'requests': num_requests,
+                          'method': name,
+                          'round_trips_per_request': float(total_trips) / num_requests,
+                          'p50_ms': percentile(timings, 50) * 1000,
+                          'p99_ms': percentile(timings, 99) * 1000,
+                          'final_flush_ms': flush_secs * 1000,
+                          'views_recorded': int(cli.zscore(sisyphus.analytics.ANALYTICS_PAGEVIEW, slugs[0]) or 0),
+                          })
+            cli.delete(sisyphus.analytics.ANALYTICS_PAGEVIEW)
+    finally:
+        settings.REALTIME_ANALYTICS, settings.ANALYTICS_BUFFERED, settings.TRENDING_BUFFERED = old_settings
+        release_scratch_client(cli)
+    return rows
+BENCHMARKS['tracking'] = bench_tracking
+
+
+MARKDOWN_CODE = """
+    :::python
+    def fib(n):
+        "Return the nth Fibonacci number."
+        a, b = 0, 1
+        for i in xrange(n):
+            a, b = b, a + b
+        return a
+"""
+
+def write_markdown_corpus(directory, num_files, paragraphs=12, seed=0):
+    "Write num_files Markdown pages with code blocks into directory/publish."
+    rand = random.Random(seed)
+    publish_dir = os.path.join(directory, "publish")
+    os.makedirs(publish_dir)
+    for i in xrange(num_files):
+        slug = "markdown-page-%s" % i
+        meta = { 'title': lorem(6, rand).title(),
+                 'slug': slug,
+                 'summary': lorem(30, rand),
+                 'tags': rand.sample([ "tag-%s" % x for x in xrange(30) ], 3),
+                 }
+        sections = []
+        for p in xrange(paragraphs):
+            if p % 4 == 0:
+                sections.append("## %s\n" % lorem(4, rand).title())
+            sections.append(lorem(80, rand) + "\n")
+            if p % 3 == 0:
+                sections.append(MARKDOWN_CODE)
+        with open(os.path.join(publish_dir, "%s.markdown" % slug), 'w') as fout:
+            for key, val in meta.items():
+                fout.write('%s: %s,\n' % (json.dumps(key), json.dumps(val)))
+            fout.write("\n")
+            fout.write("\n".join(sections))
+
+
+def bench_sync(num_files=3000, workers=None):
+    """
+    Compare a full sync of a generated Markdown corpus rendered
+    serially against one rendered in a process pool.
+    """
+    import sisyphus.management.commands.sync_sisyphus
+    import sisyphus.markup
+    workers = workers or multiprocessing.cpu_count()
+    cli = scratch_client()
+    content_dir = tempfile.mkdtemp()
+    index_dir = tempfile.mkdtemp()
+    old_index_dir = settings.WHOOSH_INDEXDIR
+    settings.WHOOSH_INDEXDIR = index_dir
+    rows = []
+    try:
+        write_markdown_corpus(content_dir, num_files)
+        for name, num_workers in (('serial', 1), ('parallel', workers)):
+            # the render cache too, so neither pass reuses the other's renders
+            cli.flushdb()
+            command = sisyphus.management.commands.sync_sisyphus.Command()
+            start = time.time()
+            summary = command.sync(content_dir, full=True, workers=num_workers, cli=cli)
+            secs = time.time() - start
+            rows.append({ 'files': num_files,
+                          'method': name,
+                          'workers': num_workers,
+                          'loaded': len(summary['added']) + len(summary['changed']),
+                          'rendered': cli.hlen(sisyphus.markup.RENDER_CACHE_SIZES),
+                          'secs': secs,
+                          'files_per_sec': num_files / secs,
+                          })
+    finally:
+        settings.WHOOSH_INDEXDIR = old_index_dir
+        shutil.rmtree(content_dir)
+        shutil.rmtree(index_dir)
+        release_scratch_client(cli)
+    return rows
+BENCHMARKS['sync'] = bench_sync
+
+
+def bench_export(num_pages=2000, num_changed=10, workers=None):
+    """
+    Time a full static export of a synthetic corpus, then an
+    incremental export after a few pages change.
+    """
+    import sisyphus.export
+    import sisyphus.sitemap
+    workers = workers or multiprocessing.cpu_count()
+    cli = scratch_client()
+    seed_corpus(cli, num_pages, html_words=400)
+    sisyphus.sitemap.build(cli=cli)
+    root = tempfile.mkdtemp()
+    rows = []
+    try:
+        for name, full in (('full', True), ('incremental', False)):
+            if not full:
+                sisyphus.export.mark_dirty([ "page-%s" % x for x in xrange(0, num_pages, num_pages // num_changed) ], cli)
+            report = sisyphus.export.export(root, full=full, workers=workers, cli=cli)
+            rows.append({ 'pages': num_pages,
+                          'method': name,
+                          'workers': workers,
+                          'rendered': report['pages'] + report['lists'],
+                          'failed': len(report['failed']),
+                          'feeds': report['feeds'],
+                          'secs': report['secs'],
+                          'files_per_sec': (report['pages'] + report['lists']) / report['secs'],
+                          })
+    finally:
+        shutil.rmtree(root)
+        release_scratch_client(cli)
+    return rows
+BENCHMARKS['export'] = bench_export
+
+
+def bench_codecs(num_pages=10000, repeat=3):
+    """
+    Compare the memory used by pages and the time taken to decode
+    them when stored as plain JSON and with each available codec and
+    compression.
+    """
+    import sisyphus.codec
+    cli = scratch_client()
+    seed_corpus(cli, num_pages)
+    slugs = sisyphus.models.get_page_slugs(limit=num_pages, cli=cli)
+    formats = [('legacy', None)]
+    for codec in ('json', 'msgpack'):
+        for compression in ('none', 'zlib', 'lz4'):
+            if sisyphus.codec.AVAILABLE.get(codec, True) and sisyphus.codec.AVAILABLE.get(compression, True):
+                formats.append((codec, compression))
+    rows = []
+    try:
+        for codec, compression in formats:
+            if codec == 'legacy':
+                # pages as stored before codecs: one JSON string with the body
+                pipeline = cli.pipeline(transaction=False)
+                for page in sisyphus.models.hydrate_pages(slugs, cli=cli, with_tag_counts=False):
+                    pipeline.delete(sisyphus.models.PAGE_BODY % page['slug'], sisyphus.models.PAGE_SUMMARY % page['slug'])
+                    pipeline.set(sisyphus.models.PAGE_STRING % page['slug'], json.dumps(page))
+                pipeline.execute()
+            else:
+                sisyphus.models.reencode_pages(codec, compression, cli=cli)
+            used = sum(sisyphus.models.page_memory(slugs, cli=cli))
+            timings = {}
+            for name, func in (('pages', sisyphus.models.hydrate_pages), ('summaries', sisyphus.models.hydrate_summaries)):
+                timings[name] = []
+                for x in xrange(repeat):
+                    start = time.time()
+                    for i in xrange(0, len(slugs), 100):
+                        func(slugs[i:i+100], cli=cli, with_tag_counts=False)
+                    timings[name].append(time.time() - start)
+            rows.append({ 'pages': num_pages,
+                          'codec': codec,
+                          'compression': compression or '-',
+                          'bytes_per_page': float(used) / num_pages,
+                          'read_us_per_page': min(timings['pages']) / num_pages * 1000000,
+                          'summary_us_per_page': min(timings['summaries']) / num_pages * 1000000,
+                          })
+    finally:
+        release_scratch_client(cli)
+    return rows
+BENCHMARKS['codecs'] = bench_codecs
+
+
+def seed_analytics(cli, slugs, days, views_per_day=50, seed=0):
+    "Record days of synthetic pageviews of slugs, ending now."
+    rand = random.Random(seed)
+    refers = [ "http://%s.example.com/" % x for x in WORDS ] + [""]
+    agents = [ "Mozilla/5.0 (%s)" % x for x in WORDS[:5] ]
+    pages = dict((x['slug'], x) for x in sisyphus.models.hydrate_pages(slugs, cli=cli, with_tag_counts=False))
+    now = int(time.time())
+    for day in xrange(days):
+        events = []
+        for i in xrange(views_per_day * len(slugs)):
+            slug = rand.choice(slugs)
+            events.append((now - day * 86400 - rand.randint(0, 86399), slug, rand.choice(refers), rand.choice(agents),
+                           "10.%s.%s.%s" % (rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255)),
+                           tuple(pages[slug]['tags'])))
+        sisyphus.analytics.record_events(events, cli)
+
+def commands_processed(cli):
+    "Commands the Redis server has processed, or None if it doesn't say."
+    try:
+        return int(cli.info().get('total_commands_processed'))
+    except (TypeError, ValueError, redis.exceptions.ResponseError):
+        return None
+
+VIEW_URLS = (('page', "/%(slug)s/"),
+             ('frontpage', "/"),
+             ('recent', "/list/recent/?offset=%(offset)s"),
+             ('trending', "/list/trending/"),
+             ('tags', "/tags/"),
+             ('tag_list', "/tags/%(tag)s/"),
+             ('similar_list', "/similar/%(slug)s/"),
+             ('search', "/search/?q=%(word)s"),
+             ('feed', "/feeds/"),
+             ('atom_feed', "/feeds/atom/"),
+             ('tag_feed', "/feeds/tag/%(tag)s"),
+             ('sitemap_index', "/sitemap.xml"),
+             ('sitemap', "/sitemap-1.xml"),
+             ('analytics', "/analytics/"),
+             ('page_analytics', "/analytics/%(slug)s/"),
+             )
+
+def bench_views(num_pages=1000, num_tags=50, history_days=30, num_requests=200, seed=0):
+    """
+    Drive every view through the Django test client against a synthetic
+    corpus of num_pages pages in num_tags tags, with history_days of
+    analytics, reporting throughput, latency percentiles and Redis round
+    trips (and commands, where the server reports them) per request for
+    each view, after a warm-up request to each URL. Counts include any
+    writes flushed by background threads meanwhile.
+    """
+    from django.test.client import Client
+    import sisyphus.related
+    import sisyphus.sitemap
+    import sisyphus.cache
+    cli = scratch_client()
+    seed_corpus(cli, num_pages, num_tags=num_tags, html_words=400, seed=seed)
+    slugs = sisyphus.models.get_page_slugs(limit=num_pages, cli=cli)
+    tags = [ x for x, y in sisyphus.models.tags(limit=num_tags, cli=cli) ]
+    index_dir = tempfile.mkdtemp()
+    old_index_dir = settings.WHOOSH_INDEXDIR
+    settings.WHOOSH_INDEXDIR = index_dir
+    rand = random.Random(seed)
+    client = Client(HTTP_USER_AGENT="Mozilla/5.0 (benchmark)")
+    rows = []
+    try:
+        sisyphus.models.reindex_pages(cli=cli)
+        seed_analytics(cli, slugs[:100], history_days, seed=seed)
+        sisyphus.related.rebuild(cli=cli, full=True)
+        sisyphus.sitemap.build(cli=cli)
+        sisyphus.analytics.rollup(cli=cli)
+        sisyphus.cache.response_cache().clear()
+
+        totals = { 'requests': 0, 'errors': 0, 'secs': 0.0, 'trips': 0, 'commands': 0, 'timings': [] }
+        for name, template in VIEW_URLS:
+            paths = [ template % { 'slug': rand.choice(slugs),
+                                   'tag': rand.choice(tags),
+                                   'word': rand.choice(WORDS),
+                                   'offset': rand.randrange(0, max(num_pages, 10), 10),
+                                   } for x in xrange(num_requests) ]
+            for path in set(paths):
+                client.get(path)
+            timings = []
+            errors = 0
+            before = commands_processed(cli)
+            trips = CountingConnection.sent
+            start = time.time()
+            for path in paths:
+                request_start = time.time()
+                response = client.get(path)
+                timings.append(time.time() - request_start)
+                if response.status_code not in (200, 304):
+                    errors += 1
+            secs = time.time() - start
+            trips = CountingConnection.sent - trips
+            after = commands_processed(cli)
+            commands = after - before - 1 if before is not None and after is not None else None
+            rows.append({ 'view': name,
+                          'requests': num_requests,
+                          'errors': errors,
+                          'requests_per_sec': num_requests / secs,
+                          'p50_ms': percentile(timings, 50) * 1000,
+                          'p95_ms': percentile(timings, 95) * 1000,
+                          'p99_ms': percentile(timings, 99) * 1000,
+                          'round_trips_per_request': float(trips) / num_requests,
+                          'commands_per_request': float(commands) / num_requests if commands is not None else None,
+                          })
+            totals['requests'] += num_requests
+            totals['errors'] += errors
+            totals['secs'] += secs
+            totals['trips'] += trips
+            totals['commands'] = totals['commands'] + commands if commands is not None and totals['commands'] is not None else None
+            totals['timings'].extend(timings)
+        rows.append({ 'view': 'all',
+                      'requests': totals['requests'],
+                      'errors': totals['errors'],
+                      'requests_per_sec': totals['requests'] / totals['secs'],
+                      'p50_ms': percentile(totals['timings'], 50) * 1000,
+                      'p95_ms': percentile(totals['timings'], 95) * 1000,
+                      'p99_ms': percentile(totals['timings'], 99) * 1000,
+                      'round_trips_per_request': float(totals['trips']) / totals['requests'],
+                      'commands_per_request': float(totals['commands']) / totals['requests'] if totals['commands'] is not None else None,
+                      })
+    finally:
+        settings.WHOOSH_INDEXDIR = old_index_dir
+        shutil.rmtree(index_dir)
+        release_scratch_client(cli)
+    return rows
+BENCHMARKS['views'] = bench_views
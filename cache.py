@@ -0,0 +1,292 @@
+"""
+Caching of data shared across requests.
+
+Sidebar modules render identically for every visitor until content
+is synced or enough traffic arrives to reorder the trending pages, so
+their payloads are kept in a bounded, in-process LRU cache, optionally
+backed by a shared tier in Redis for use across processes.
+
+Entries are keyed on the version counters of the scopes the module
+depends on (see ``sisyphus.models.bump_version``): ``add_page`` and
+``add_page_to_tag`` advance the content version, ``track`` advances the
+traffic version. Since every pageview advances the traffic version, it
+is bucketed by ``MODULE_CACHE_TRAFFIC_GRANULARITY`` views when building
+keys. Stale entries are never looked up again and age out of the LRU.
+
+Whole responses for pages, storylists and feeds are cached the same
+way by ``cache_response``, keyed on the URL, query parameters and
+content version, and stored precompressed alongside their ETag and
+Last-Modified headers so conditional GETs can be answered with a 304.
+"""
+import time
+import zlib
+import hashlib
+import urllib
+import threading
+import functools
+import collections
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import sisyphus.models
+import sisyphus.export
+
+MODULE_CACHE_STRING = "module_cache.%s"
+
+
+class LRUCache(object):
+    "Thread-safe, size-bounded LRU cache whose entries expire after ttl seconds."
+
+    def __init__(self, max_entries=256, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value = entry
+            if expires < now:
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.entries[key] = entry
+            self.hits += 1
+            return value
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry is not None and entry[0] >= time.time()
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (ttl if ttl is not None else self.ttl)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return { 'entries': len(self.entries),
+                     'max_entries': self.max_entries,
+                     'hits': self.hits,
+                     'misses': self.misses,
+                     'evictions': self.evictions,
+                     'expirations': self.expirations,
+                     }
+
+
+class ModuleCache(object):
+    "Cache module payloads by name, arguments and scope versions."
+
+    def __init__(self, local, shared=False, ttl=60):
+        self.local = local
+        self.shared = shared
+        self.ttl = ttl
+        self.shared_hits = 0
+
+    def key(self, name, args, scopes, versions):
+        granularity = getattr(settings, 'MODULE_CACHE_TRAFFIC_GRANULARITY', 100)
+        parts = [name] + [ str(x) for x in args ]
+        for scope in scopes:
+            version = versions.get(scope, 0)
+            if scope == sisyphus.models.TRAFFIC_VERSION:
+                version = version // granularity
+            parts.append("%s%s" % (scope, version))
+        return ".".join(parts)
+
+    def __contains__(self, key):
+        return key in self.local
+
+    def get_or_build(self, key, builder, cli=None):
+        "Return the payload for key, calling builder() to create it on a miss."
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        if self.shared:
+            cli = cli or sisyphus.models.redis_client()
+            raw = cli.get(MODULE_CACHE_STRING % key)
+            if raw is not None:
+                self.shared_hits += 1
+                value = json.loads(raw)
+                self.local.set(key, value)
+                return value
+        value = builder()
+        if value is not None:
+            self.local.set(key, value)
+            if self.shared:
+                cli.setex(MODULE_CACHE_STRING % key, json.dumps(value), self.ttl)
+        return value
+
+    def stats(self):
+        stats = self.local.stats()
+        stats['shared'] = self.shared
+        stats['shared_hits'] = self.shared_hits
+        return stats
+
+_module_cache = None
+_module_cache_lock = threading.Lock()
+
+def module_cache():
+    "Return the process-wide module cache."
+    global _module_cache
+    if _module_cache is None:
+        with _module_cache_lock:
+            if _module_cache is None:
+                ttl = getattr(settings, 'MODULE_CACHE_TTL', 60)
+                local = LRUCache(max_entries=getattr(settings, 'MODULE_CACHE_MAX_ENTRIES', 256), ttl=ttl)
+                _module_cache = ModuleCache(local,
+                                            shared=getattr(settings, 'MODULE_CACHE_SHARED', False),
+                                            ttl=ttl)
+    return _module_cache
+
+
+def gzip_compress(body):
+    "Compress body in gzip format."
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+def compress(body):
+    "Return body in each content encoding available here."
+    encodings = { 'gzip': gzip_compress(body) }
+    if brotli is not None:
+        encodings['br'] = brotli.compress(body)
+    return encodings
+
+def choose_encoding(request, encodings):
+    "Pick the best encoding of those available which the client accepts."
+    accepted = [ x.split(';')[0].strip() for x in request.META.get('HTTP_ACCEPT_ENCODING', '').split(',') ]
+    for encoding in ('br', 'gzip'):
+        if encoding in accepted and encoding in encodings:
+            return encoding
+    return None
+
+def not_modified(request, etag, last_modified):
+    "Whether a conditional GET can be answered with a 304."
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return etag in [ x.strip() for x in if_none_match.split(',') ] or if_none_match.strip() == '*'
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return bool(if_modified_since and last_modified and last_modified <= if_modified_since)
+
+def cache_entry(response):
+    """
+    Convert a rendered response into a cache entry. Views describe
+    their responses with two optional attributes: ``last_modified``,
+    the timestamp the content last changed, and ``track_page``, the
+    page whose views should be tracked whenever the response is served.
+    """
+    body = response.content
+    return { 'body': body,
+             'encodings': compress(body),
+             'content_type': response['Content-Type'],
+             'etag': '"%s"' % hashlib.md5(body).hexdigest(),
+             'last_modified': getattr(response, 'last_modified', None),
+             'track_page': getattr(response, 'track_page', None),
+             }
+
+def entry_response(request, entry):
+    "Build the response for a cache entry."
+    if not_modified(request, entry['etag'], entry['last_modified']):
+        response = HttpResponseNotModified()
+    else:
+        encoding = choose_encoding(request, entry['encodings'])
+        if encoding:
+            response = HttpResponse(entry['encodings'][encoding], content_type=entry['content_type'])
+            response['Content-Encoding'] = encoding
+        else:
+            response = HttpResponse(entry['body'], content_type=entry['content_type'])
+        response['Content-Length'] = str(len(response.content))
+    response['ETag'] = entry['etag']
+    if entry['last_modified']:
+        response['Last-Modified'] = http_date(entry['last_modified'])
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+def stored_response(request, stored, content_type):
+    """
+    Build the response for a document precomputed and stored gzipped
+    along with its ETag and Last-Modified, such as sitemaps and feeds.
+    """
+    entry = { 'encodings': { 'gzip': stored['gzip'] },
+              'content_type': content_type,
+              'etag': stored['etag'],
+              'last_modified': stored['last_modified'],
+              }
+    if choose_encoding(request, entry['encodings']) is None:
+        entry['body'] = zlib.decompress(stored['gzip'], 16 + zlib.MAX_WBITS)
+    return entry_response(request, entry)
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def response_cache():
+    "Return the process-wide full response cache."
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = LRUCache(max_entries=getattr(settings, 'PAGE_CACHE_MAX_ENTRIES', 512),
+                                           ttl=getattr(settings, 'PAGE_CACHE_TTL', 300))
+    return _response_cache
+
+def cache_response(view):
+    """
+    Serve a view's successful GET responses from the response cache.
+
+    Since content only changes when pages are added, entries are keyed
+    on the content version along with the path and query parameters.
+    Pageviews are tracked here rather than in the view, so they are
+    still counted when a response is served from cache. Responses
+    rendered for the static export are neither cached nor tracked.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or sisyphus.export.is_export(request):
+            return view(request, *args, **kwargs)
+        cli = sisyphus.models.redis_client()
+        # views build their module keys from these too, rather than read them again
+        request.cache_versions = sisyphus.models.get_versions(cli=cli)
+        version = request.cache_versions[sisyphus.models.CONTENT_VERSION]
+        query = urllib.urlencode(sorted((x, request.GET.get(x)) for x in request.GET))
+        key = "%s?%s#%s" % (request.path, query, version)
+        cache = response_cache()
+        entry = cache.get(key)
+        if entry is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            entry = cache_entry(response)
+            cache.set(key, entry)
+        if entry['track_page']:
+            sisyphus.models.track(request, entry['track_page'], cli=cli)
+        return entry_response(request, entry)
+    return wrapper
@@ -0,0 +1,110 @@
+"""
+Encoding of pages stored in Redis.
+
+A page is stored as two values: its metadata (everything but the
+``html`` body) serialized by ``PAGE_CODEC``, and its body compressed by
+``PAGE_COMPRESSION``, so lists and links never read or decode bodies.
+
+Codecs are ``json`` and, if the msgpack package is installed,
+``msgpack``, which is the default when available. Compression is
+``zlib`` (the default), ``lz4`` if the lz4 package is installed, or
+``none``. Each value starts with a byte naming its format, so values
+written with any codec can be read whatever the current settings, as
+can pages stored as plain JSON before codecs existed.
+"""
+import zlib
+from django.conf import settings
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+def json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+def msgpack_dumps(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+def msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False)
+
+def identity(data):
+    return data
+
+def zlib_compress(data):
+    return zlib.compress(data, 6)
+
+# format byte: (name, encode, decode)
+CODECS = { 'j': ('json', json_dumps, json.loads),
+           'm': ('msgpack', msgpack_dumps, msgpack_loads),
+           }
+COMPRESSIONS = { 'r': ('none', identity, identity),
+                 'z': ('zlib', zlib_compress, zlib.decompress),
+                 '4': ('lz4', lambda x: lz4.frame.compress(x), lambda x: lz4.frame.decompress(x)),
+                 }
+AVAILABLE = { 'msgpack': msgpack is not None, 'lz4': lz4 is not None }
+
+def lookup(table, name):
+    "Find the format byte and functions for a codec or compression by name."
+    for tag, (x, encode, decode) in table.items():
+        if x == name:
+            if not AVAILABLE.get(name, True):
+                raise ValueError("%s is not installed" % name)
+            return tag, encode, decode
+    raise ValueError("Unknown format %s, choose from: %s" % (name, ", ".join(sorted(x[0] for x in table.values()))))
+
+def codec_name():
+    return getattr(settings, 'PAGE_CODEC', None) or ('msgpack' if msgpack is not None else 'json')
+
+def compression_name():
+    return getattr(settings, 'PAGE_COMPRESSION', 'zlib')
+
+def dumps(obj, codec=None):
+    "Serialize obj with codec, or PAGE_CODEC."
+    tag, encode, decode = lookup(CODECS, codec or codec_name())
+    return tag + encode(obj)
+
+def loads(data):
+    "Deserialize a value written by dumps, or plain JSON."
+    if data[0] == '{':
+        return json.loads(data)
+    name, encode, decode = CODECS[data[0]]
+    if not AVAILABLE.get(name, True):
+        raise ValueError("Reading a %s value requires %s to be installed" % (name, name))
+    return decode(data[1:])
+
+def compress(text, compression=None):
+    "Compress unicode text with compression, or PAGE_COMPRESSION."
+    tag, encode, decode = lookup(COMPRESSIONS, compression or compression_name())
+    return tag + encode(text.encode('utf-8'))
+
+def decompress(data):
+    "Inverse of compress."
+    name, encode, decode = COMPRESSIONS[data[0]]
+    if not AVAILABLE.get(name, True):
+        raise ValueError("Reading a %s value requires %s to be installed" % (name, name))
+    return decode(data[1:]).decode('utf-8')
+
+def encode_page(page, codec=None, compression=None):
+    "Split page into its serialized metadata and compressed body."
+    meta = dict((k, v) for k, v in page.items() if k != 'html')
+    return dumps(meta, codec), compress(page.get('html', u''), compression)
+
+def decode_page(meta, body):
+    """
+    Rebuild a page from its metadata and body. Pages stored as plain
+    JSON include their body, and have no separate one.
+    """
+    page = loads(meta)
+    if body is not None:
+        page['html'] = decompress(body)
+    return page
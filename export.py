@@ -0,0 +1,222 @@
+"""
+Static export of the site.
+
+Content only changes when pages are synced, so every page, tag list,
+paginated storylist, feed and sitemap can be rendered to files once and
+served by the web server without running Python. ``export_static``
+renders them into a directory tree through the usual middleware and
+views, in a pool of worker processes:
+
+* a URL ``/<path>/`` is written to ``<path>/index.html``, and the
+  page of a storylist at ``?offset=N`` to ``<path>/offset-N.html``,
+* feeds are written to ``index.xml`` under their URL, and sitemaps
+  to ``sitemap.xml`` and ``sitemap-N.xml``,
+* each file is written alongside a gzipped copy, for ``gzip_static``.
+
+Pages written or unpublished since the last export are recorded in
+``EXPORT_DIRTY``, and an incremental export renders only them, their
+neighbours, their tags, the storylists, feeds and sitemaps. Sidebars
+elsewhere, such as the popular pages, are refreshed by a full export.
+
+Exported pages report views to ``/_track/<slug>/``, so search and this
+beacon are all that needs to stay dynamic.
+"""
+import os
+import time
+import zlib
+import multiprocessing
+from django.core.handlers.base import BaseHandler
+import sisyphus.models
+import sisyphus.cache
+import sisyphus.feeds
+import sisyphus.sitemap
+import sisyphus.markup
+
+EXPORT_DIRTY = "export_dirty"
+EXPORT_META = "sisyphus.export"
+PER_PAGE = 10
+CHUNK_SIZE = 50
+
+def mark_dirty(slugs, cli):
+    "Record that slugs' exported pages need rendering; cli may be a pipeline."
+    if slugs:
+        cli.sadd(EXPORT_DIRTY, *slugs)
+
+def is_export(request):
+    "Whether request is rendering the static export."
+    return bool(request.META.get(EXPORT_META))
+
+
+class ExportHandler(BaseHandler):
+    "Render URLs through the middleware and views without a server."
+
+    def __init__(self):
+        from django.test.client import RequestFactory
+        super(ExportHandler, self).__init__()
+        self.load_middleware()
+        self.factory = RequestFactory()
+
+    def render(self, path, offset=0):
+        query = { 'offset': offset } if offset else {}
+        return self.get_response(self.factory.get(path, query, **{ EXPORT_META: True }))
+
+
+def output_path(path, offset=0, filename="index.html"):
+    "Relative file a URL is exported to."
+    if offset:
+        filename = "offset-%s.html" % offset
+    return os.path.join(path.strip("/"), filename)
+
+def write_file(root, relpath, body, gzipped=None):
+    "Write body and a gzipped copy of it under root, replacing any previous version atomically."
+    path = os.path.join(root, relpath)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created by another worker in the meantime
+            pass
+    for filepath, data in ((path, body), (path + ".gz", gzipped or sisyphus.cache.gzip_compress(body))):
+        with open(filepath + ".tmp", 'wb') as fout:
+            fout.write(data)
+        os.rename(filepath + ".tmp", filepath)
+
+def remove_file(root, relpath):
+    for path in (os.path.join(root, relpath), os.path.join(root, relpath) + ".gz"):
+        if os.path.exists(path):
+            os.remove(path)
+
+_handler = None
+
+def export_urls(args):
+    """
+    Render and write a chunk of (path, offset) URLs, returning the
+    number written and the URLs which failed as (path, offset, status).
+    """
+    global _handler
+    root, urls = args
+    if _handler is None:
+        _handler = ExportHandler()
+    written = 0
+    failed = []
+    for path, offset in urls:
+        response = _handler.render(path, offset)
+        if response.status_code == 200:
+            write_file(root, output_path(path, offset), response.content)
+            written += 1
+        else:
+            failed.append((path, offset, response.status_code))
+    return written, failed
+
+def list_urls(path, total):
+    "Every page of a storylist of total pages."
+    return [ (path, x) for x in xrange(0, max(total, 1), PER_PAGE) ]
+
+def full_urls(cli):
+    "Every exported URL, as {kind: [(path, offset), ...]}, and the tags whose feeds to write."
+    slugs = cli.zrange(sisyphus.models.PAGE_ZSET_BY_TIME, 0, -1)
+    tags = cli.zrange(sisyphus.models.TAG_ZSET_BY_PAGES, 0, -1)
+    pipeline = cli.pipeline(transaction=False)
+    for tag in tags:
+        pipeline.zcard(sisyphus.models.TAG_PAGES_ZSET_BY_TREND % tag)
+    lists = [("/tags/", 0)]
+    for tag, total in zip(tags, pipeline.execute()):
+        lists.extend(list_urls("/tags/%s/" % tag, total))
+    return { 'pages': [ ("/%s/" % x, 0) for x in slugs ], 'lists': lists }, tags
+
+def incremental_urls(dirty, cli):
+    """
+    URLs affected by writing or unpublishing the dirty pages, the tags
+    whose feeds to write, and the unpublished pages to remove.
+    """
+    summaries = sisyphus.models.hydrate_summaries(list(dirty), cli=cli, with_tag_counts=False)
+    published = [ x for x in summaries if x.get('published') ]
+    removed = [ x['slug'] for x in summaries if not x.get('published') ]
+    slugs = set(x['slug'] for x in published)
+    for page in published:
+        before, after = sisyphus.models.get_nearby_pages(page, limit=2, cli=cli)
+        slugs.update(x['slug'] for x in before + after)
+    tags = sorted(set(tag for page in summaries for tag in page['tags']))
+    pipeline = cli.pipeline(transaction=False)
+    for tag in tags:
+        pipeline.zcard(sisyphus.models.TAG_PAGES_ZSET_BY_TREND % tag)
+    lists = [("/tags/", 0)]
+    for tag, total in zip(tags, pipeline.execute()):
+        lists.extend(list_urls("/tags/%s/" % tag, total))
+    return { 'pages': [ ("/%s/" % x, 0) for x in sorted(slugs) ], 'lists': lists }, tags, removed
+
+def write_feeds(root, tags, cli):
+    "Write the site feed and tags' feeds from their stored versions, returning the number written."
+    written = 0
+    for name in [sisyphus.feeds.SITE_FEED] + [ sisyphus.feeds.tag_feed(x) for x in tags ]:
+        path = "/feeds/" if name == sisyphus.feeds.SITE_FEED else "/feeds/tag/%s/" % name[len("tag."):]
+        for kind in sisyphus.feeds.FEED_CLASSES:
+            stored = sisyphus.feeds.get_feed(kind, name, cli=cli)
+            if stored is None:
+                continue
+            kind_path = path + "atom/" if kind == 'atom' else path
+            write_file(root, output_path(kind_path, filename="index.xml"),
+                       zlib.decompress(stored['gzip'], 16 + zlib.MAX_WBITS), stored['gzip'])
+            written += 1
+    return written
+
+def write_sitemaps(root, cli):
+    "Write the stored sitemaps, returning the number written."
+    names = cli.smembers(sisyphus.sitemap.SITEMAP_FILES) or [sisyphus.sitemap.SITEMAP_INDEX]
+    written = 0
+    for name in names:
+        stored = sisyphus.sitemap.get_sitemap(name, cli=cli)
+        if stored is not None:
+            write_file(root, sisyphus.sitemap.sitemap_path(name)[1:],
+                       zlib.decompress(stored['gzip'], 16 + zlib.MAX_WBITS), stored['gzip'])
+            written += 1
+    return written
+
+def export(root, full=False, workers=None, cli=None):
+    """
+    Export the site into root, every URL if full or else those affected
+    by pages written since the last export. Returns counts of files
+    written and seconds taken by kind, along with the failed URLs.
+    """
+    cli = cli or sisyphus.models.redis_client()
+    workers = workers if workers is not None else sisyphus.markup.default_workers()
+    start = time.time()
+    dirty = cli.smembers(EXPORT_DIRTY)
+    if full:
+        urls, tags = full_urls(cli)
+        exported = set(x.strip("/") for x, y in urls['pages'])
+        removed = [ x for x in dirty if x not in exported ]
+    else:
+        urls, tags, removed = incremental_urls(dirty, cli)
+    total = sisyphus.models.num_pages(cli=cli)
+    urls['lists'] = list_urls("/", total) + list_urls("/list/recent/", total) + \
+        list_urls("/list/trending/", total) + urls['lists']
+    report = { 'removed': len(removed), 'failed': [] }
+    for slug in removed:
+        remove_file(root, output_path("/%s/" % slug))
+
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        for kind in ('pages', 'lists'):
+            kind_start = time.time()
+            chunks = [ (root, urls[kind][i:i+CHUNK_SIZE]) for i in xrange(0, len(urls[kind]), CHUNK_SIZE) ]
+            results = pool.imap_unordered(export_urls, chunks) if pool else map(export_urls, chunks)
+            report[kind] = 0
+            for written, failed in results:
+                report[kind] += written
+                report['failed'].extend(failed)
+            report['%s_secs' % kind] = time.time() - kind_start
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    kind_start = time.time()
+    report['feeds'] = write_feeds(root, tags, cli)
+    report['sitemaps'] = write_sitemaps(root, cli)
+    report['feeds_secs'] = time.time() - kind_start
+    if dirty:
+        cli.srem(EXPORT_DIRTY, *dirty)
+    report['secs'] = time.time() - start
+    return report
@@ -0,0 +1,124 @@
+"""
+RSS and Atom feeds, precomputed when pages are written.
+
+The site feed lists the ``FEED_LENGTH`` most recently published pages,
+and each tag's feed those most recently added to the tag, rather than
+its trending pages as it once did: trending order changes with every
+view, so it can't be precomputed when pages are written. Each is
+rendered as RSS and as Atom when ``add_pages`` writes a page which
+appears in it, and stored gzipped in Redis along with its ETag and
+Last-Modified, so serving a feed is a single read.
+"""
+import time
+import hashlib
+import django.utils.feedgenerator
+from django.conf import settings
+import sisyphus.models
+import sisyphus.cache
+
+FEED = "feed.%s.%s"
+SITE_FEED = "site"
+FEED_CLASSES = { 'rss': django.utils.feedgenerator.Rss201rev2Feed,
+                 'atom': django.utils.feedgenerator.Atom1Feed,
+                 }
+
+def feed_length():
+    return getattr(settings, 'FEED_LENGTH', 25)
+
+def tag_feed(tag_slug):
+    return "tag.%s" % tag_slug
+
+def feed_key(name):
+    "The sorted set feed name lists pages from."
+    if name == SITE_FEED:
+        return sisyphus.models.PAGE_ZSET_BY_TIME
+    return sisyphus.models.TAG_PAGES_ZSET_BY_TIME % name[len("tag."):]
+
+def feed_url(kind, name):
+    if kind == 'rss' and name == SITE_FEED:
+        return settings.RSS_FEED_URL
+    path = "/feeds/" if name == SITE_FEED else "/feeds/tag/%s/" % name[len("tag."):]
+    return "http://%s%s%s" % (settings.DOMAIN, path, "atom/" if kind == 'atom' else "")
+
+def render(kind, name, pages):
+    "Render pages, newest first, as a feed."
+    f = FEED_CLASSES[kind](
+        title=settings.RSS_TITLE,
+        link=settings.RSS_LINK,
+        description=settings.RSS_DESC,
+        language=settings.RSS_LANG,
+        author_name=settings.RSS_AUTHOR,
+        feed_url=feed_url(kind, name),
+        )
+    for page in pages:
+        f.add_item(title=page['title'],
+                   link="http://%s/%s/" % (settings.DOMAIN, page['slug']),
+                   pubdate=page['pub_date'],
+                   description=page['html'],
+                   )
+    return f.writeString('UTF-8')
+
+def regenerate(names, cli=None):
+    "Render and store the RSS and Atom versions of each feed in names."
+    cli = cli or sisyphus.models.redis_client()
+    names = list(names)
+    if not names:
+        return
+    pipeline = cli.pipeline(transaction=False)
+    for name in names:
+        pipeline.zrevrange(feed_key(name), 0, feed_length() - 1)
+    slug_lists = pipeline.execute()
+    pages = dict((x['slug'], x) for x in sisyphus.models.hydrate_pages(list(set(x for slugs in slug_lists for x in slugs)),
+                                                                     cli=cli, with_tag_counts=False))
+    pipeline = cli.pipeline(transaction=False)
+    for name, slugs in zip(names, slug_lists):
+        feed_pages = [ pages[x] for x in slugs if x in pages ]
+        modified = max([ x.get('edit_date', x['pub_date']) for x in feed_pages ] or [int(time.time())])
+        feed_pages = [ sisyphus.models.convert_pub_date_to_datetime(dict(x)) for x in feed_pages ]
+        for kind in FEED_CLASSES:
+            body = render(kind, name, feed_pages)
+            pipeline.hmset(FEED % (kind, name), { 'gzip': sisyphus.cache.gzip_compress(body),
+                                                  'etag': '"%s"' % hashlib.md5(body).hexdigest(),
+                                                  'last_modified': modified,
+                                                  })
+    pipeline.execute()
+
+def affected_feeds(pages, cli):
+    """
+    Names of the feeds which written pages appear in: those with fewer
+    than ``FEED_LENGTH`` pages, or whose oldest page is no newer.
+    """
+    candidates = {}
+    for page in pages:
+        for name in [SITE_FEED] + [ tag_feed(x) for x in page['tags'] ]:
+            candidates[name] = max(page['pub_date'], candidates.get(name, page['pub_date']))
+    names = candidates.keys()
+    pipeline = cli.pipeline(transaction=False)
+    for name in names:
+        pipeline.zrevrange(feed_key(name), feed_length() - 1, feed_length() - 1, withscores=True)
+    return [ name for name, oldest in zip(names, pipeline.execute())
+             if not oldest or candidates[name] >= oldest[0][1] ]
+
+def pages_written(pages, cli=None):
+    "Regenerate the feeds written pages appear in."
+    cli = cli or sisyphus.models.redis_client()
+    regenerate(affected_feeds(pages, cli), cli=cli)
+
+def page_removed(page, cli=None):
+    "Regenerate every feed a page was listed in."
+    regenerate([SITE_FEED] + [ tag_feed(x) for x in page['tags'] ], cli=cli)
+
+def get_feed(kind, name, cli=None):
+    """
+    Retrieve a stored feed, generating it first if it hasn't been.
+    Returns None for unknown tags.
+    """
+    cli = cli or sisyphus.models.redis_client()
+    stored = cli.hgetall(FEED % (kind, name))
+    if not stored:
+        if name != SITE_FEED and cli.zscore(sisyphus.models.TAG_ZSET_BY_PAGES, name[len("tag."):]) is None:
+            return None
+        regenerate([name], cli=cli)
+        stored = cli.hgetall(FEED % (kind, name))
+    stored['last_modified'] = int(stored['last_modified'])
+    return stored
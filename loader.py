@@ -0,0 +1,190 @@
+"""
+Request-scoped data loading for views.
+
+A request renders the nav bar and several sidebar modules, which
+tend to read the same keys (``pages_by_trend``, ``pages_by_time``,
+``tags_by_pages``). Rather than each module querying Redis on its
+own, a view creates one RequestLoader, declares everything it will
+need with the ``want_*`` methods, and calls ``load()``, which fetches
+it in a fixed number of round trips:
+
+1. one pipeline for every storylist, tag list, nearby window,
+   similar pages list and pageview count, and
+2. one MGET for the summaries of the distinct pages across all of
+   them, since modules only link to pages and never show their bodies.
+
+The exception is a page whose related pages haven't been built yet:
+its similar pages fall back to ``similar_pages_key``, which costs a
+few more round trips for that page alone.
+
+The cache version counters are fetched in the first pipeline too,
+unless the view was given them already by ``cache_response``.
+
+Results are memoized for the rest of the request. Accessors such as
+``pages()`` load anything which wasn't declared up front, so modules
+remain correct when used without a prefetch, just slower.
+"""
+import time
+import sisyphus.models
+import sisyphus.analytics
+import sisyphus.related
+
+
+class RequestLoader(object):
+    "Batch and memoize the Redis reads of a single request."
+
+    def __init__(self, cli=None, versions=None):
+        self.cli = cli or sisyphus.models.redis_client()
+        self.wanted_lists = {}
+        self.wanted_tags = 0
+        self.wanted_nearby = {}
+        self.wanted_similar = {}
+        self.wanted_views = set()
+        self.wanted_versions = False
+        self.lists = {}
+        self.tag_list = (0, [])
+        self.nearby_slugs = {}
+        self.similar_slugs = {}
+        self.views = {}
+        self.cache_versions = versions
+        self.page_cache = {}
+
+    def want_list(self, key, limit):
+        "Declare the first limit pages of a sorted set will be needed."
+        self.wanted_lists[key] = max(limit, self.wanted_lists.get(key, 0))
+
+    def want_tags(self, limit):
+        "Declare the top limit tags (with counts) will be needed."
+        self.wanted_tags = max(limit, self.wanted_tags)
+
+    def want_nearby(self, page, limit):
+        "Declare the pages published around page will be needed."
+        pub_date = self.timestamp(page['pub_date'])
+        old_limit = self.wanted_nearby.get(page['slug'], (0, None))[0]
+        self.wanted_nearby[page['slug']] = (max(limit, old_limit), pub_date)
+
+    def want_similar(self, page, limit):
+        "Declare the pages most similar to page will be needed."
+        old_limit = self.wanted_similar.get(page['slug'], (0, None))[0]
+        self.wanted_similar[page['slug']] = (max(limit, old_limit), page)
+
+    def want_views(self, slug):
+        "Declare the all-time pageviews for slug will be needed."
+        self.wanted_views.add(slug)
+
+    def want_versions(self):
+        "Declare the cache version counters will be needed."
+        self.wanted_versions = True
+
+    def timestamp(self, value):
+        "Pages may have had their dates converted to datetimes already."
+        if hasattr(value, 'timetuple'):
+            return int(time.mktime(value.timetuple()))
+        return value
+
+    def load(self):
+        "Fetch everything declared but not yet loaded."
+        pipeline = self.cli.pipeline(transaction=False)
+        pending = []
+        for key, limit in self.wanted_lists.items():
+            if limit > self.lists.get(key, (0, None))[0]:
+                pipeline.zrevrange(key, 0, limit - 1)
+                pending.append(('list', key, limit))
+        if self.wanted_tags > self.tag_list[0]:
+            pipeline.zrevrange(sisyphus.models.TAG_ZSET_BY_PAGES, 0, self.wanted_tags - 1, withscores=True)
+            pending.append(('tags', None, self.wanted_tags))
+        for slug, (limit, pub_date) in self.wanted_nearby.items():
+            if limit > self.nearby_slugs.get(slug, (0, None, None))[0]:
+                key = sisyphus.models.PAGE_ZSET_BY_TIME
+                pipeline.zrevrangebyscore(key, "(%s" % pub_date, "-inf", start=0, num=limit)
+                pipeline.zrangebyscore(key, "(%s" % pub_date, "+inf", start=0, num=limit)
+                pending.append(('nearby', slug, limit))
+        for slug, (limit, page) in self.wanted_similar.items():
+            if limit > self.similar_slugs.get(slug, (0, None))[0]:
+                pipeline.zrevrange(sisyphus.related.RELATED % slug, 0, limit - 1)
+                pending.append(('similar', slug, limit))
+        for slug in self.wanted_views - set(self.views):
+            pipeline.zscore(sisyphus.analytics.ANALYTICS_PAGEVIEW, slug)
+            pending.append(('views', slug, None))
+        if self.wanted_versions and self.cache_versions is None:
+            pipeline.mget([ sisyphus.models.CACHE_VERSION % x for x in sisyphus.models.CACHE_VERSION_SCOPES ])
+            pending.append(('versions', None, None))
+        if not pending:
+            return
+
+        results = iter(pipeline.execute())
+        for kind, name, limit in pending:
+            if kind == 'list':
+                self.lists[name] = (limit, next(results))
+            elif kind == 'tags':
+                self.tag_list = (limit, [ (x, int(y)) for x, y in next(results) ])
+            elif kind == 'nearby':
+                self.nearby_slugs[name] = (limit, next(results), next(results))
+            elif kind == 'similar':
+                slugs = next(results)
+                if not slugs:
+                    # fall back to tag unions for pages without related pages yet
+                    page = self.wanted_similar[name][1]
+                    sim_key = sisyphus.models.similar_pages_key(page, cli=self.cli)
+                    if sim_key:
+                        slugs = self.cli.zrevrange(sim_key, 0, limit - 1)
+                self.similar_slugs[name] = (limit, slugs)
+            elif kind == 'views':
+                self.views[name] = int(next(results) or 0)
+            elif kind == 'versions':
+                self.cache_versions = dict((scope, int(version or 0)) for scope, version
+                                           in zip(sisyphus.models.CACHE_VERSION_SCOPES, next(results)))
+
+        slugs = set()
+        for limit, list_slugs in self.lists.values():
+            slugs.update(list_slugs)
+        for limit, before, after in self.nearby_slugs.values():
+            slugs.update(before)
+            slugs.update(after)
+        for limit, similar in self.similar_slugs.values():
+            slugs.update(similar)
+        missing = [ x for x in slugs if x not in self.page_cache ]
+        for page in sisyphus.models.hydrate_summaries(missing, cli=self.cli, with_tag_counts=False):
+            self.page_cache[page['slug']] = page
+
+    def cached_pages(self, slugs):
+        return [ self.page_cache[x] for x in slugs if x in self.page_cache ]
+
+    def pages(self, key, limit):
+        "Return the first limit pages in a sorted set."
+        self.want_list(key, limit)
+        self.load()
+        return self.cached_pages(self.lists[key][1][:limit])
+
+    def tags(self, limit):
+        "Return the top limit tags as (slug, count) pairs."
+        self.want_tags(limit)
+        self.load()
+        return self.tag_list[1][:limit]
+
+    def nearby(self, page, limit):
+        "Return (preceding, following) pages, nearest first."
+        self.want_nearby(page, limit)
+        self.load()
+        fetched, before, after = self.nearby_slugs[page['slug']]
+        return self.cached_pages(before[:limit]), self.cached_pages(after[:limit])
+
+    def similar(self, page, limit):
+        "Return the top limit pages similar to page."
+        self.want_similar(page, limit)
+        self.load()
+        return self.cached_pages(self.similar_slugs[page['slug']][1][:limit])
+
+    def page_views(self, slug):
+        "Return all-time pageviews for slug."
+        self.want_views(slug)
+        self.load()
+        return self.views[slug]
+
+    def versions(self):
+        "Return the cache version counter of each scope."
+        if self.cache_versions is None:
+            # loads anything else declared so far along with them
+            self.want_versions()
+            self.load()
+        return self.cache_versions
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import sisyphus.models
+import sisyphus.analytics
+import sisyphus.timeseries
+
+SITE_KEYS = (sisyphus.analytics.ANALYTICS_PAGEVIEW,
+             sisyphus.analytics.ANALYTICS_REFER,
+             sisyphus.analytics.ANALYTICS_USERAGENT,
+             sisyphus.analytics.ANALYTICS_PAGEVIEW_BUCKET,
+             sisyphus.analytics.ANALYTICS_DAYS,
+             sisyphus.analytics.ANALYTICS_WEEKS,
+             sisyphus.analytics.ANALYTICS_MONTHS,
+             ) + tuple(sisyphus.timeseries.series_keys([sisyphus.timeseries.site_series()]))
+
+PAGE_KEYS = (sisyphus.analytics.ANALYTICS_REFER_PAGE,
+             sisyphus.analytics.ANALYTICS_PAGEVIEW_PAGE_BUCKET,
+             sisyphus.analytics.ANALYTICS_DAYS_PAGE,
+             sisyphus.analytics.ANALYTICS_WEEKS_PAGE,
+             sisyphus.analytics.ANALYTICS_MONTHS_PAGE,
+             sisyphus.analytics.ANALYTICS_UNIQUES_PAGE,
+             ) + tuple(sisyphus.timeseries.series_keys([sisyphus.timeseries.page_series("%s")]))
+
+TAG_KEYS = tuple(sisyphus.timeseries.series_keys([sisyphus.timeseries.tag_series("%s")]))
+
+class Command(BaseCommand):
+    help = "Report the Redis memory used by analytics, in total and for the largest pages."
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', dest='limit', type='int', default=20,
+                    help="Pages to list, largest first."),
+        )
+
+    def memory_usage(self, keys, cli):
+        "Bytes used by each of keys, per MEMORY USAGE, with 0 for missing keys."
+        pipeline = cli.pipeline(transaction=False)
+        for key in keys:
+            pipeline.execute_command('MEMORY', 'USAGE', key)
+        return [ int(x or 0) for x in pipeline.execute() ]
+
+    def handle(self, *args, **options):
+        cli = sisyphus.models.redis_client()
+        site = self.memory_usage(SITE_KEYS, cli)
+        for key, used in zip(SITE_KEYS, site):
+            if used:
+                print "%10d  %s" % (used, key)
+
+        slugs = [ x for x, y in cli.zscan_iter(sisyphus.analytics.ANALYTICS_PAGEVIEW) ]
+        by_page = []
+        for i in xrange(0, len(slugs), 500):
+            batch = slugs[i:i+500]
+            used = self.memory_usage([ key % slug for slug in batch for key in PAGE_KEYS ], cli)
+            for j, slug in enumerate(batch):
+                by_page.append((sum(used[j*len(PAGE_KEYS):(j+1)*len(PAGE_KEYS)]), slug))
+        by_page.sort(reverse=True)
+        print
+        print "Largest pages:"
+        for used, slug in by_page[:options.get('limit', 20)]:
+            print "%10d  %s" % (used, slug)
+
+        tags = [ x for x, y in cli.zscan_iter(sisyphus.models.TAG_ZSET_BY_PAGES) ]
+        tag_total = 0
+        for i in xrange(0, len(tags), 500):
+            tag_total += sum(self.memory_usage([ key % tag for tag in tags[i:i+500] for key in TAG_KEYS ], cli))
+
+        page_total = sum(x[0] for x in by_page)
+        print
+        print "Site-wide keys: %s bytes" % (sum(site),)
+        print "Per page keys: %s bytes over %s pages (%.0f bytes/page)" % (page_total, len(by_page), page_total / float(max(len(by_page), 1)))
+        print "Per tag keys: %s bytes over %s tags (%.0f bytes/tag)" % (tag_total, len(tags), tag_total / float(max(len(tags), 1)))
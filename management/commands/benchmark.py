@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import sisyphus.benchmarks
+import inspect
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# command options passed to the benchmarks which take them
+PARAMETERS = (('pages', 'num_pages'), ('tags', 'num_tags'), ('history_days', 'history_days'), ('requests', 'num_requests'))
+
+class Command(BaseCommand):
+    args = "<benchmark benchmark ...>"
+    help = "Run Sisyphus benchmarks against the scratch Redis database in BENCHMARK_REDIS_DB."
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+                    help="Also save results as JSON to this file, for comparison between runs."),
+        make_option('--pages', dest='pages', type='int', default=None,
+                    help="Pages in the synthetic corpus."),
+        make_option('--tags', dest='tags', type='int', default=None,
+                    help="Tags in the synthetic corpus."),
+        make_option('--history-days', dest='history_days', type='int', default=None,
+                    help="Days of synthetic analytics history."),
+        make_option('--requests', dest='requests', type='int', default=None,
+                    help="Requests to make per view or benchmark."),
+        )
+
+    def format_row(self, row):
+        cells = []
+        for key, val in sorted(row.items()):
+            if isinstance(val, float):
+                val = "%.2f" % val
+            cells.append("%s=%s" % (key, val))
+        return "  ".join(cells)
+
+    def handle(self, *args, **options):
+        names = args or sorted(sisyphus.benchmarks.BENCHMARKS.keys())
+        for name in names:
+            if name not in sisyphus.benchmarks.BENCHMARKS:
+                raise CommandError("Unknown benchmark '%s', choose from: %s" % (name, ", ".join(sorted(sisyphus.benchmarks.BENCHMARKS))))
+        results = { 'started': int(time.time()), 'benchmarks': {} }
+        for name in names:
+            benchmark = sisyphus.benchmarks.BENCHMARKS[name]
+            accepted = inspect.getargspec(benchmark).args
+            kwargs = dict((arg, options[option]) for option, arg in PARAMETERS
+                          if options.get(option) is not None and arg in accepted)
+            print "Running %s..." % (name,)
+            rows = benchmark(**kwargs)
+            for row in rows:
+                print "  %s" % (self.format_row(row),)
+            results['benchmarks'][name] = { 'parameters': kwargs, 'rows': rows }
+        if options.get('output'):
+            with open(options['output'], 'w') as fout:
+                json.dump(results, fout, indent=2, sort_keys=True)
+            print "Saved results to %s" % (options['output'],)
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import sisyphus.models
+import sisyphus.export
+import os.path
+
+class Command(BaseCommand):
+    args = "<output_dir>"
+    help = "Render the site into a directory of static files, only what changed since the last export unless --full."
+    option_list = BaseCommand.option_list + (
+        make_option('--full', dest='full', action='store_true', default=False,
+                    help="Render every URL, rather than those affected by pages synced since the last export."),
+        make_option('--workers', dest='workers', type='int', default=None,
+                    help="Processes to render with (defaults to SYNC_WORKERS or one per CPU)."),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Specify the directory to export into.")
+        root = args[0]
+        if not os.path.isdir(root):
+            raise CommandError("%s is not a directory." % root)
+        report = sisyphus.export.export(root,
+                                        full=options.get('full', False),
+                                        workers=options.get('workers'),
+                                        cli=sisyphus.models.redis_client())
+        for path, offset, status in report['failed']:
+            print "  failed %s%s (%s)" % (path, "?offset=%s" % offset if offset else "", status)
+        print "Rendered %s pages in %.2f seconds (%.0f/sec)" % \
+            (report['pages'], report['pages_secs'], report['pages'] / max(report['pages_secs'], 0.001))
+        print "Rendered %s storylist pages in %.2f seconds (%.0f/sec)" % \
+            (report['lists'], report['lists_secs'], report['lists'] / max(report['lists_secs'], 0.001))
+        print "Wrote %s feeds and %s sitemaps in %.2f seconds" % (report['feeds'], report['sitemaps'], report['feeds_secs'])
+        print "Removed %s unpublished pages" % (report['removed'],)
+        print "Exported %s in %.2f seconds" % ("everything" if options.get('full') else "changes", report['secs'])
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import sisyphus.models
+import sisyphus.analytics
+import time
+
+class Command(BaseCommand):
+    help = "Fold old daily analytics into weekly and monthly counts (compact analytics only)."
+    option_list = BaseCommand.option_list + (
+        make_option('--convert', dest='convert', action='store_true', default=False,
+                    help="First move existing day buckets into compact storage and trim referrers to the top-k."),
+        )
+
+    def handle(self, *args, **options):
+        cli = sisyphus.models.redis_client()
+        start = time.time()
+        slugs = [None] + [ x for x, y in cli.zscan_iter(sisyphus.analytics.ANALYTICS_PAGEVIEW) ]
+        if options.get('convert'):
+            for slug in slugs:
+                sisyphus.analytics.convert_to_compact(slug, cli=cli)
+            print "Converted %s pages to compact analytics" % (len(slugs) - 1,)
+        folded = 0
+        for slug in slugs:
+            folded += sisyphus.analytics.fold_counters(slug, cli=cli)
+        print "Folded %s buckets for %s pages in %.2f seconds" % (folded, len(slugs) - 1, time.time() - start)
@@ -1,69 +1,157 @@
 from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
 import sisyphus.models
 import sisyphus.analytics
-import django.http
-import json
+import sisyphus.timeseries
+import multiprocessing
+import gzip
+import glob
 import time
 import re
+import os.path
+
+# remote_addr - user [time_local] "request" status bytes "referer" "user_agent"
+LOG_PATTERN = re.compile(r'(\S+) \S+ \S+ \[([^ \]]+)[^\]]*\] "([A-Z]+) (\S+)[^"]*" \d+ \S+ "([^"]*)" "([^"]*)"')
+DATE_FORMAT = "%d/%b/%Y:%H:%M"
+IGNORE = ('/','/tags/','/favicon.ico/', '/feeds/')
+
+# backoff keys claimed at chunk edges must outlive the whole import
+IMPORT_BACKOFF_TTL = 6 * 60 * 60
+
+_minutes = {}
+
+def timestamp(datetime):
+    "Convert nginx's 10/Oct/2010:13:55:36 to a timestamp, parsing each minute once."
+    minute = datetime[:-3]
+    ts = _minutes.get(minute)
+    if ts is None:
+        ts = _minutes[minute] = int(time.mktime(time.strptime(minute, DATE_FORMAT)))
+    return ts + int(datetime[-2:])
+
+def parse_event(line):
+    "Parse a log line into an analytics event, or None if it isn't a tracked pageview."
+    matches = LOG_PATTERN.match(line)
+    if matches is None:
+        return None
+    ip, datetime, method, path, refer, agent = matches.groups()
+    if method != 'GET' or not path.endswith('/') or path in IGNORE or path.count('/') != 2:
+        return None
+    slug = path[1:-1]
+    if not sisyphus.analytics.should_track(slug, agent):
+        return None
+    refer = sisyphus.analytics.standardize_refer_url(refer if refer != '-' else "")
+    return (timestamp(datetime), slug, refer, agent, ip, ())
+
+def import_lines(lines):
+    """
+    Record the pageviews in a chunk of log lines, returning
+    (lines, valid records, recorded pageviews).
+
+    Views are deduplicated per IP per minute in memory. Since logs are
+    in time order, only the minutes at either edge of the chunk can be
+    shared with other chunks, so only those claim backoff keys in Redis.
+    """
+    events = {}
+    valid = 0
+    for line in lines:
+        event = parse_event(line)
+        if event is not None:
+            valid += 1
+            events.setdefault(sisyphus.analytics.event_backoff_key(event), event)
+    if not events:
+        return len(lines), valid, 0
+    cli = sisyphus.models.redis_client()
+    minutes = [ x[0] / 60 for x in events.values() ]
+    first, last = min(minutes), max(minutes)
+    interior = [ x for x in events.values() if first + 1 < x[0] / 60 < last - 1 ]
+    edges = [ x for x in events.values() if not first + 1 < x[0] / 60 < last - 1 ]
+    accepted = interior + sisyphus.analytics.claim_backoffs(edges, cli, ttl=IMPORT_BACKOFF_TTL)
+    sisyphus.analytics.record_events(accepted, cli)
+    return len(lines), valid, len(accepted)
+
+def expand_logs(paths):
+    "Expand each log into its rotated set (access.log.2.gz, access.log.1, access.log), oldest first."
+    found = []
+    for path in paths:
+        rotated = [ x for x in glob.glob(path + ".*") if re.match(r'^\.\d+(\.gz)?$', x[len(path):]) ]
+        rotated.sort(key=lambda x: -int(x[len(path):].split('.')[1]))
+        for x in rotated + [path]:
+            if os.path.exists(x) and x not in found:
+                found.append(x)
+    return found
+
+def open_log(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+def read_chunks(path, chunk_lines):
+    "Stream lists of chunk_lines lines from path."
+    with open_log(path) as fin:
+        chunk = []
+        for line in fin:
+            chunk.append(line)
+            if len(chunk) >= chunk_lines:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
 
 class Command(BaseCommand):
     args = "<file_to_load file_to_load ...>"
-    help = "Load analytics from Nginx server data."
-    log_pattern = re.compile(r"""(?P<ip>\d{0,3}\.\d{0,3}.\d{0,3}\.\d{0,3}).+?
-\[(?P<datetime>[0-9]{2}\/[A-Za-z]+\/[0-9]{4}:[0-9]{2}:[0-9]{2}:[0-9]{2})
-.{9}
-(?P<method>GET|POST|CONNECT|HEAD) (?P<path>.*?) HTTP\/1.[0-9]{1}"
-.{5}
-\d+
-.{1}
-"(?P<refer>.*?)"
-(?P<agent>.*)""", re.VERBOSE)
-    date_format = "%d/%b/%Y:%H:%M:%S"
-    ignore = ('/','/tags/','/favicon.ico/', '/feeds/')
-    clean_keys = True #False
+    help = "Load analytics from Nginx server data, including gzipped and rotated logs."
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=None,
+                    help="Processes to parse logs with (defaults to one per CPU)."),
+        make_option('--chunk-lines', dest='chunk_lines', type='int', default=50000,
+                    help="Lines per chunk handed to a worker."),
+        make_option('--keep', dest='clean_keys', action='store_false', default=True,
+                    help="Add to existing analytics instead of clearing them first."),
+        )
 
-    def extract(self, line):
-        matches = self.log_pattern.match(line)
-        try:
-            return {
-                'ip':matches.group('ip'),
-                'method': matches.group('method'),
-                'ts': int(time.mktime(time.strptime(matches.group('datetime'), self.date_format))),
-                'path': matches.group('path').strip(),
-                'agent':matches.group('agent').strip()[1:-1],
-                'refer': matches.group('refer').strip(),
-                }
-        except AttributeError:
-            pass
+    def clean(self, cli):
+        "Delete existing analytics and traffic series keys, scanning rather than blocking Redis with KEYS."
+        pipeline = cli.pipeline(transaction=False)
+        deleted = 0
+        for pattern in ("analytics.*", sisyphus.timeseries.SERIES_PATTERN):
+            for key in cli.scan_iter(pattern, count=1000):
+                pipeline.delete(key)
+                deleted += 1
+                if deleted % 1000 == 0:
+                    pipeline.execute()
+        pipeline.execute()
 
-    def handle(self, *args, **kwargs):
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Specify at least one log file.")
         cli = sisyphus.models.redis_client()
-        if self.clean_keys:
-            keys = cli.keys("analytics.*")
-            if keys:
-                cli.delete(*keys)
-
-        for file in args:
-            print "Loading data from %s..." % (file,)
-            start = time.time()
-            i = 0
-            valid = 0
-            with open(file, 'r') as fin:
-                for line in fin:
-                    extracted = self.extract(line)
-                    if extracted:
-                        method = extracted['method']
-                        if method == 'GET':
-                            path = extracted['path']
-                            if path.endswith('/') and path not in self.ignore and len(path.split('/')) == 3:
-                                req = django.http.HttpRequest()
-                                req.META['HTTP_REFERER'] = extracted['refer'] if extracted['refer'] != '-' else ""
-                                req.META['REMOTE_ADDR'] = extracted['ip']
-                                req.META['HTTP_USER_AGENT'] = extracted['agent']
-                                page = { 'slug': path[1:-1] }
-                                sisyphus.analytics.track(req, page, cli, extracted['ts'])
-                                valid += 1
+        if options.get('clean_keys', True):
+            self.clean(cli)
 
-                    i += 1
-            end = time.time()
-            print "Loading %s valid records of %s total records took %.2f seconds" % (valid, i, end-start)
+        workers = options.get('workers') or multiprocessing.cpu_count()
+        chunk_lines = options.get('chunk_lines') or 50000
+        pool = multiprocessing.Pool(workers)
+        totals = [0, 0, 0]
+        start = time.time()
+        try:
+            for file in expand_logs(args):
+                print "Loading data from %s..." % (file,)
+                file_start = time.time()
+                counts = [0, 0, 0]
+                pending = []
+                for chunk in read_chunks(file, chunk_lines):
+                    pending.append(pool.apply_async(import_lines, (chunk,)))
+                    # keep a bounded number of chunks in flight
+                    while len(pending) >= workers * 2:
+                        counts = [ x + y for x, y in zip(counts, pending.pop(0).get()) ]
+                for result in pending:
+                    counts = [ x + y for x, y in zip(counts, result.get()) ]
+                elapsed = time.time() - file_start
+                print "Loading %s valid records (%s pageviews) of %s total records took %.2f seconds (%.0f lines/sec)" % \
+                    (counts[1], counts[2], counts[0], elapsed, counts[0] / max(elapsed, 0.001))
+                totals = [ x + y for x, y in zip(totals, counts) ]
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+        print "Imported %s pageviews from %s lines in %.2f seconds (%.0f lines/sec)" % \
+            (totals[2], totals[0], elapsed, totals[0] / max(elapsed, 0.001))
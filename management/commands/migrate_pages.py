@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import sisyphus.models
+import sisyphus.codec
+import time
+
+class Command(BaseCommand):
+    help = "Rewrite every stored page with the configured codec and compression, reporting the memory saved."
+    option_list = BaseCommand.option_list + (
+        make_option('--codec', dest='codec', default=None,
+                    help="json or msgpack (defaults to PAGE_CODEC)."),
+        make_option('--compression', dest='compression', default=None,
+                    help="none, zlib or lz4 (defaults to PAGE_COMPRESSION)."),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+                    help="Pages to rewrite per round trip."),
+        )
+
+    def handle(self, *args, **options):
+        cli = sisyphus.models.redis_client()
+        codec = options.get('codec') or sisyphus.codec.codec_name()
+        compression = options.get('compression') or sisyphus.codec.compression_name()
+        try:
+            sisyphus.codec.lookup(sisyphus.codec.CODECS, codec)
+            sisyphus.codec.lookup(sisyphus.codec.COMPRESSIONS, compression)
+        except ValueError, e:
+            raise CommandError(str(e))
+
+        slugs = list(sisyphus.models.stored_slugs(cli))
+        before = sum(sisyphus.models.page_memory(slugs, cli=cli))
+        start = time.time()
+        rewritten = sisyphus.models.reencode_pages(codec, compression, batch_size=options.get('batch_size') or 500, cli=cli)
+        elapsed = time.time() - start
+        after = sum(sisyphus.models.page_memory(slugs, cli=cli))
+        print "Rewrote %s pages with %s and %s compression in %.2f seconds" % (rewritten, codec, compression, elapsed)
+        print "Page memory: %s bytes before, %s bytes after (%.0f%%)" % (before, after, 100.0 * after / max(before, 1))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import sisyphus.models
+import sisyphus.related
+import time
+
+class Command(BaseCommand):
+    help = "Rebuild the precomputed related pages of every page, or with --dirty only those affected by changes."
+    option_list = BaseCommand.option_list + (
+        make_option('--dirty', dest='full', action='store_false', default=True,
+                    help="Only rebuild pages affected by changes since the last rebuild."),
+        )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        rebuilt = sisyphus.related.rebuild(cli=sisyphus.models.redis_client(), full=options.get('full', True))
+        print "Rebuilt related pages for %s pages in %.2f seconds" % (rebuilt, time.time() - start)
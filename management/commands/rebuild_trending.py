@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+import sisyphus.models
+import sisyphus.trending
+import time
+
+class Command(BaseCommand):
+    help = "Recompute trending scores from publication dates and daily pageviews."
+
+    def handle(self, *args, **options):
+        start = time.time()
+        pages = sisyphus.trending.rebuild(cli=sisyphus.models.redis_client())
+        print "Ranked %s pages in %.2f seconds" % (pages, time.time() - start)
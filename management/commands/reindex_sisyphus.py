@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import sisyphus.models
+import time
+
+class Command(BaseCommand):
+    help = "Rebuild the Whoosh search index from the pages stored in Redis."
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+                    help="Pages to read from Redis at a time."),
+        make_option('--procs', dest='procs', type='int', default=1,
+                    help="Processes to index with."),
+        make_option('--multisegment', dest='multisegment', action='store_true', default=False,
+                    help="With --procs, have each process write its own segment."),
+        make_option('--limitmb', dest='limitmb', type='int', default=128,
+                    help="Memory per indexing process, in megabytes."),
+        make_option('--no-optimize', dest='optimize', action='store_false', default=True,
+                    help="Skip merging the index into one segment after committing."),
+        )
+
+    def handle(self, *args, **options):
+        start = time.time()
+
+        def progress(indexed, total):
+            elapsed = time.time() - start
+            print "Indexed %s of %s pages (%.1f pages/sec)" % (indexed, total, indexed / max(elapsed, 0.001))
+
+        indexed = sisyphus.models.reindex_pages(chunk_size=options['chunk_size'],
+                                                procs=options['procs'],
+                                                multisegment=options['multisegment'],
+                                                limitmb=options['limitmb'],
+                                                optimize=options['optimize'],
+                                                progress=progress)
+        elapsed = time.time() - start
+        print "Reindexed %s pages in %.2f seconds (%.1f pages/sec)" % (indexed, elapsed, indexed / max(elapsed, 0.001))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+import sisyphus.models
+import sisyphus.trending
+import time
+
+class Command(BaseCommand):
+    help = "Shift trending scores to be relative to the current time, keeping them small."
+
+    def handle(self, *args, **options):
+        start = time.time()
+        shifted = sisyphus.trending.renormalize(cli=sisyphus.models.redis_client())
+        print "Shifted %s scores in %.2f seconds" % (shifted, time.time() - start)
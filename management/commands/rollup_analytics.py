@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+import sisyphus.models
+import sisyphus.analytics
+import time
+
+class Command(BaseCommand):
+    help = "Precompute the site and page analytics dashboards."
+
+    def handle(self, *args, **options):
+        start = time.time()
+        pages = sisyphus.analytics.rollup(cli=sisyphus.models.redis_client())
+        print "Rolled up site and %s page dashboards in %.2f seconds" % (pages, time.time() - start)
@@ -1,46 +1,153 @@
 from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
 import sisyphus.models
+import sisyphus.markup
+import sisyphus.related
+import sisyphus.sitemap
 import sisyphus.management.commands.update_page
 import sisyphus.management.commands.update_markdown_page
+import hashlib
 import json
 import time
 import os.path
 import os
 
+SYNC_MANIFEST = "sync_manifest"
+
 class Command(BaseCommand):
     args = "<root_sisyphus_content_dir>"
     help = "Synchronize a Sisyphus deployment with the contents of a Sisyphus content repository."
+    option_list = BaseCommand.option_list + (
+        make_option('--full', dest='full', action='store_true', default=False,
+                    help="Reload every file, even those unchanged since the last sync."),
+        make_option('--workers', dest='workers', type='int', default=None,
+                    help="Processes to render Markdown with (defaults to SYNC_WORKERS or one per CPU)."),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+                    help="Pages to render and write to Redis at a time."),
+        )
 
-    def load_page(self, path, index=True):
-        "Load a file."
+    def loader_for(self, path):
+        "Return the command which loads path, or None for unknown files."
         if path.endswith('.html'):
-            sisyphus.management.commands.update_page.Command().handle(path, index=index)
+            return sisyphus.management.commands.update_page.Command()
         elif path.endswith('.markdown') or path.endswith('.md'):
-            sisyphus.management.commands.update_markdown_page.Command().handle(path, index=index)
+            return sisyphus.management.commands.update_markdown_page.Command()
         else:
             print "Unknown extension: %s" % (path.split(".")[-1],)
-    
-    def handle(self, git_dir, **options):
-        """
-        for file in args:
-            with open(file, 'r') as fin:
-                pass
-        """
-        edit_dir = os.path.join(git_dir, "edit")
-        print "Update edit pages in '%s'" % (edit_dir,)
-        try:
-            for file in os.listdir(edit_dir):
-                filepath = os.path.join(edit_dir, file)
-                self.load_page(filepath, index=False)
-        except OSError:
-            print "Missing %s" % edit_dir
 
-        publish_dir = os.path.join(git_dir, "publish")
-        print "Update publish pages in '%s'" % (publish_dir,)
+    def list_files(self, git_dir, subdir):
+        "List (relative path, absolute path) of files in subdir."
+        dirpath = os.path.join(git_dir, subdir)
         try:
-            for file in os.listdir(publish_dir):
-                filepath = os.path.join(publish_dir, file)
-                self.load_page(filepath, index=True)
+            return [ (os.path.join(subdir, x), os.path.join(dirpath, x)) for x in sorted(os.listdir(dirpath)) ]
         except OSError:
-            print "Missing %s" % publish_dir
+            print "Missing %s" % dirpath
+            return []
 
+    def check_file(self, relpath, filepath, manifest, full=False):
+        """
+        Compare filepath against its manifest entry, returning 'added',
+        'changed' or 'unchanged' along with its new manifest entry.
+        """
+        stat = os.stat(filepath)
+        entry = manifest.get(relpath)
+        if not full and entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            return 'unchanged', entry
+        with open(filepath, 'rb') as fin:
+            digest = hashlib.sha1(fin.read()).hexdigest()
+        new_entry = { 'mtime': stat.st_mtime,
+                      'size': stat.st_size,
+                      'hash': digest,
+                      'slug': entry and entry.get('slug'),
+                      }
+        if not full and entry and entry['hash'] == digest:
+            return 'unchanged', new_entry
+        return ('changed' if entry else 'added'), new_entry
+
+    def load_files(self, files, index, workers, batch_size, cli):
+        """
+        Load (relpath, filepath) pairs in batches, grouped by the command
+        which loads them, returning {relpath: slug}.
+        """
+        by_loader = {}
+        for relpath, filepath in files:
+            loader = self.loader_for(filepath)
+            if loader is not None:
+                by_loader.setdefault(loader.__class__, (loader, []))[1].append((relpath, filepath))
+        slugs = {}
+        for loader, loader_files in by_loader.values():
+            for i in xrange(0, len(loader_files), batch_size):
+                batch = loader_files[i:i+batch_size]
+                pages = loader.load_many([ x[1] for x in batch ], index=index, workers=workers, cli=cli)
+                for (relpath, filepath), page in zip(batch, pages):
+                    slugs[relpath] = page['slug']
+        return slugs
+
+    def sync(self, git_dir, full=False, workers=None, batch_size=500, cli=None):
+        """
+        Load pages whose files were added or changed since the last
+        sync, as recorded in a manifest of (mtime, size, content hash)
+        per file, and unpublish pages whose files were removed, then
+        rebuild the related pages they affect and the sitemaps. Returns
+        lists of relative paths by status, the number of related page
+        lists rebuilt, and (URLs, sitemaps) written, or None when no
+        file changed and the sitemaps were left as they were.
+        """
+        cli = cli or sisyphus.models.redis_client()
+        workers = workers if workers is not None else sisyphus.markup.default_workers()
+        manifest = dict((k, json.loads(v)) for k, v in cli.hgetall(SYNC_MANIFEST).items())
+        summary = { 'added': [], 'changed': [], 'unchanged': [], 'removed': [] }
+        seen = {}
+        published_slugs = set()
+
+        for subdir, index in (("edit", False), ("publish", True)):
+            print "Update %s pages in '%s'" % (subdir, os.path.join(git_dir, subdir))
+            to_load = []
+            for relpath, filepath in self.list_files(git_dir, subdir):
+                status, entry = self.check_file(relpath, filepath, manifest, full)
+                summary[status].append(relpath)
+                seen[relpath] = entry
+                if status != 'unchanged':
+                    to_load.append((relpath, filepath))
+            for relpath, slug in self.load_files(to_load, index, workers, batch_size, cli).items():
+                seen[relpath]['slug'] = slug
+            if index:
+                published_slugs.update(seen[x]['slug'] for x in seen if x.startswith(subdir) and seen[x]['slug'])
+
+        for relpath, entry in manifest.items():
+            if relpath not in seen:
+                summary['removed'].append(relpath)
+                slug = entry.get('slug')
+                if relpath.startswith("publish") and slug and slug not in published_slugs:
+                    sisyphus.models.unpublish_page(slug, cli=cli)
+
+        pipeline = cli.pipeline()
+        pipeline.delete(SYNC_MANIFEST)
+        if seen:
+            pipeline.hmset(SYNC_MANIFEST, dict((k, json.dumps(v)) for k, v in seen.items()))
+        pipeline.execute()
+        summary['related'] = sisyphus.related.rebuild(cli=cli)
+        # sitemaps are rebuilt from scratch, so skip them when nothing moved
+        if full or summary['added'] or summary['changed'] or summary['removed']:
+            summary['sitemaps'] = sisyphus.sitemap.build(cli=cli)
+        else:
+            summary['sitemaps'] = None
+        return summary
+
+    def handle(self, git_dir, **options):
+        start = time.time()
+        summary = self.sync(git_dir,
+                            full=options.get('full', False),
+                            workers=options.get('workers'),
+                            batch_size=options.get('batch_size') or 500)
+        for status in ('added', 'changed', 'removed'):
+            for relpath in summary[status]:
+                print "  %s %s" % (status, relpath)
+        counts = tuple(len(summary[x]) for x in ('added', 'changed', 'removed', 'unchanged'))
+        print "%s added, %s changed, %s removed, %s unchanged" % counts
+        print "Rebuilt related pages for %s pages" % (summary['related'],)
+        if summary['sitemaps']:
+            print "Wrote %s URLs to %s sitemaps" % summary['sitemaps']
+        else:
+            print "Sitemaps unchanged"
+        print "Synced in %.2f seconds" % (time.time() - start,)
@@ -1,5 +1,5 @@
 import sisyphus.management.commands.update_page
-import markdown
+import sisyphus.markup
 import json
 import time
 
@@ -9,5 +9,12 @@ class Command(sisyphus.management.commands.update_page.Command):
 
     def _override_page(self, page):
         "Override in subclasses for easy extension."
-        page['html'] = markdown.markdown(page['html'], ['codehilite(css_class=highlight)', 'headerid','toc'])
+        page['html'] = sisyphus.markup.render_cached(page['html'])
         return page
+
+    def _override_pages(self, pages, workers=None, cli=None):
+        "Render the pages' Markdown in a pool of worker processes."
+        htmls = sisyphus.markup.render_many([ x['html'] for x in pages ], workers=workers, cli=cli)
+        for page, html in zip(pages, htmls):
+            page['html'] = html
+        return pages
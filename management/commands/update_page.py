@@ -11,34 +11,49 @@ class Command(BaseCommand):
         "Override in subclasses for easy extension."
         return page
 
-    def handle(self, *args, **kwargs):
-        index = kwargs.get('index', True)
-        for file in args:
-            with open(file, 'r') as fin:
-                meta = ["{"]
-                html = []
-                ended = False
-                for line in fin.readlines():
-                    if not ended and len(line.strip()) == 0:
-                        ended = True
-                    elif ended:
-                        html.append(line.rstrip().decode('utf-8'))
-                    else:
-                        meta.append(line.rstrip())
-                meta[-1] = meta[-1].rstrip(',')
-                meta.append("}")
-                try:
-                    page = json.loads(u"\n".join(meta))
-                except Exception, e:
-                    print meta
-                    raise
-
-                if 'pub_date' not in page:
-                    page['pub_date'] = int(time.time())
-                if 'tags' not in page:
-                    page['tags'] = []
-
-                page['html'] = u"\n".join(html)
-                sisyphus.models.add_page(self._override_page(page), index=index)
+    def parse(self, file):
+        "Read a page from file, without overrides applied."
+        with open(file, 'r') as fin:
+            meta = ["{"]
+            html = []
+            ended = False
+            for line in fin.readlines():
+                if not ended and len(line.strip()) == 0:
+                    ended = True
+                elif ended:
+                    html.append(line.rstrip().decode('utf-8'))
+                else:
+                    meta.append(line.rstrip())
+            meta[-1] = meta[-1].rstrip(',')
+            meta.append("}")
+            try:
+                page = json.loads(u"\n".join(meta))
+            except Exception, e:
+                print meta
+                raise
+
+            if 'pub_date' not in page:
+                page['pub_date'] = int(time.time())
+            if 'tags' not in page:
+                page['tags'] = []
+
+            page['html'] = u"\n".join(html)
+            return page
 
+    def _override_pages(self, pages, workers=None, cli=None):
+        "Apply _override_page to several pages, which subclasses may parallelize."
+        return [ self._override_page(x) for x in pages ]
 
+    def load_many(self, files, index=True, workers=None, cli=None):
+        "Load or update the pages in files with one batched write, returning them."
+        pages = self._override_pages([ self.parse(x) for x in files ], workers=workers, cli=cli)
+        sisyphus.models.add_pages(pages, index=index, cli=cli)
+        return pages
+
+    def load(self, file, index=True):
+        "Load or update the page in file, returning it."
+        return self.load_many([file], index=index)[0]
+
+    def handle(self, *args, **kwargs):
+        index = kwargs.get('index', True)
+        self.load_many(args, index=index)
@@ -0,0 +1,129 @@
+"""
+Rendering of page sources into HTML.
+
+Markdown rendering, with Pygments highlighting code blocks, is the
+most expensive step of loading pages, so it is avoided where possible
+and parallelized where not:
+
+* rendered HTML is cached in Redis by a hash of the source and the
+  Markdown configuration, so unchanged pages and drafts are never
+  rendered twice. The cache is bounded to ``RENDER_CACHE_MAX_BYTES``
+  of HTML (64MB by default, 0 disables it), evicting the least
+  recently used entries first.
+* ``render_many`` spreads cache misses across a pool of processes,
+  ``SYNC_WORKERS`` of them, or one per CPU by default.
+"""
+import hashlib
+import multiprocessing
+import time
+import markdown
+from django.conf import settings
+import sisyphus.models
+
+MARKDOWN_EXTENSIONS = ['codehilite(css_class=highlight)', 'headerid', 'toc']
+
+RENDER_CACHE = "render_cache.%s"
+RENDER_CACHE_LRU = "render_cache_lru"
+RENDER_CACHE_SIZES = "render_cache_sizes"
+RENDER_CACHE_BYTES = "render_cache_bytes"
+RENDER_CACHE_EVICT_BATCH = 100
+
+# KEYS: entry, sizes, total bytes; ARGV: digest, html. A digest's size
+# is only counted by whichever of several concurrent renders stores it first.
+STORE_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[2])
+local size = string.len(ARGV[2])
+if redis.call('HSETNX', KEYS[2], ARGV[1], size) == 1 then
+    redis.call('INCRBY', KEYS[3], size)
+end
+return size
+"""
+
+def render_markdown(text):
+    "Render Markdown text into HTML."
+    return markdown.markdown(text, MARKDOWN_EXTENSIONS)
+
+def default_workers():
+    return getattr(settings, 'SYNC_WORKERS', None) or multiprocessing.cpu_count()
+
+def source_digest(text):
+    "Identify text along with the configuration it is rendered with."
+    digest = hashlib.sha1()
+    digest.update(getattr(markdown, 'version', ''))
+    digest.update(repr(MARKDOWN_EXTENSIONS))
+    digest.update(text.encode('utf-8'))
+    return digest.hexdigest()
+
+def render_uncached(texts, workers):
+    "Render a list of Markdown texts, in parallel if workers > 1."
+    if workers <= 1 or len(texts) < 2:
+        return [ render_markdown(x) for x in texts ]
+    pool = multiprocessing.Pool(min(workers, len(texts)))
+    try:
+        return pool.map(render_markdown, texts, chunksize=max(len(texts) // (workers * 4), 1))
+    finally:
+        pool.close()
+        pool.join()
+
+def evict(max_bytes, cli):
+    """
+    Drop least recently used renders until the cache fits in max_bytes,
+    reading candidates a batch at a time but dropping only as many as
+    are needed.
+    """
+    excess = int(cli.get(RENDER_CACHE_BYTES) or 0) - max_bytes
+    while excess > 0:
+        digests = cli.zrange(RENDER_CACHE_LRU, 0, RENDER_CACHE_EVICT_BATCH - 1)
+        if not digests:
+            cli.delete(RENDER_CACHE_BYTES)
+            break
+        victims = []
+        freed = 0
+        for digest, size in zip(digests, cli.hmget(RENDER_CACHE_SIZES, digests)):
+            if freed >= excess:
+                break
+            victims.append(digest)
+            freed += int(size or 0)
+        pipeline = cli.pipeline()
+        pipeline.delete(*[ RENDER_CACHE % x for x in victims ])
+        pipeline.zrem(RENDER_CACHE_LRU, *victims)
+        pipeline.hdel(RENDER_CACHE_SIZES, *victims)
+        pipeline.decr(RENDER_CACHE_BYTES, freed)
+        excess = int(pipeline.execute()[-1]) - max_bytes
+
+def render_many(texts, workers=None, cli=None):
+    """
+    Render a list of Markdown texts, reusing cached renders and
+    rendering the rest in a pool of worker processes.
+    """
+    workers = workers if workers is not None else default_workers()
+    max_bytes = getattr(settings, 'RENDER_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+    if not texts or not max_bytes:
+        return render_uncached(texts, workers)
+
+    cli = cli or sisyphus.models.redis_client()
+    digests = [ source_digest(x) for x in texts ]
+    rendered = dict((d, h.decode('utf-8')) for d, h in zip(digests, cli.mget([ RENDER_CACHE % x for x in digests ])) if h is not None)
+    misses = {}
+    for digest, text in zip(digests, texts):
+        if digest not in rendered:
+            misses[digest] = text
+    new_htmls = dict(zip(misses.keys(), render_uncached(misses.values(), workers)))
+    rendered.update(new_htmls)
+
+    now = time.time()
+    store = sisyphus.models.lua_script(STORE_SCRIPT)
+    pipeline = cli.pipeline()
+    for digest, html in new_htmls.items():
+        store(keys=[RENDER_CACHE % digest, RENDER_CACHE_SIZES, RENDER_CACHE_BYTES],
+              args=[digest, html.encode('utf-8')], client=pipeline)
+    for digest in set(digests):
+        pipeline.zadd(RENDER_CACHE_LRU, digest, now)
+    pipeline.execute()
+    if new_htmls:
+        evict(max_bytes, cli)
+    return [ rendered[x] for x in digests ]
+
+def render_cached(text, cli=None):
+    "Render Markdown text, using the render cache."
+    return render_many([text], workers=1, cli=cli)[0]
@@ -8,7 +8,9 @@ by both the date a Page was added to a Tag as well
 as their popularity within that Tag (accomplished
 via two sorted-sets in Redis).
 
-Pages are JSON blobs stored as strings.
+Pages are stored as two strings, their metadata and their body,
+encoded by ``sisyphus.codec``, alongside a summary of each for
+rendering lists and links.
 
 Traffic is per Tag, per Page and overall site traffic,
 bucketed for the last 60 minutes, the last 24 hours,
@@ -18,17 +20,23 @@ the last 7 days, last 4 weeks and lifespan.
 
 from django.conf import settings
 
+import os
+import math
 import redis
 import time
+import random
+import threading
 import datetime
 import whoosh.index
 import whoosh.fields
 import whoosh.qparser
-try:
-    import json
-except ImportError:
-    import simplejson as json
+import whoosh.writing
 import sisyphus.analytics
+import sisyphus.trending
+import sisyphus.related
+import sisyphus.feeds
+import sisyphus.export
+import sisyphus.codec
 
 EMPTY_ZSET = "empty_zset"
 TAG_ZSET_BY_TIME = "tags_by_times"
@@ -38,10 +46,17 @@ TAG_PAGES_ZSET_BY_TREND = "tag_pages_by_trend.%s"
 PAGE_ZSET_BY_TIME = "pages_by_time"
 PAGE_ZSET_BY_TREND = "pages_by_trend"
 PAGE_STRING = "page.%s"
+PAGE_BODY = "page_body.%s"
+PAGE_SUMMARY = "page_summary.%s"
+SUMMARY_FIELDS = ('slug', 'title', 'summary', 'pub_date', 'edit_date', 'tags', 'published')
 SIMILAR_PAGES_BY_TREND = "similar_pages.%s"
 SIMILAR_PAGES_EXPIRE = 60 * 5
-
-PAGEVIEW_BONUS = 60 * 60 * 24
+DERIVED_META = "derived_meta.%s"
+DERIVED_LOCK = "derived_lock.%s"
+CACHE_VERSION = "cache_version.%s"
+CONTENT_VERSION = "content"
+TRAFFIC_VERSION = "traffic"
+CACHE_VERSION_SCOPES = (CONTENT_VERSION, TRAFFIC_VERSION)
 
 PAGE_SCHEMA = whoosh.fields.Schema(title=whoosh.fields.TEXT(),
                                    summary=whoosh.fields.TEXT(),
@@ -49,60 +64,300 @@ PAGE_SCHEMA = whoosh.fields.Schema(title=whoosh.fields.TEXT(),
                                    slug=whoosh.fields.ID(unique=True, stored=True),
                                    )
 
-
-
-def timebucket(period=3600):
-    "Return current time bucket."
-    return int(time.time()) / period
+def flush_trend_updates(batches, cli):
+    "Apply buffered trending updates, coalesced per page and key, in one round trip."
+    pipeline = cli.pipeline(transaction=False)
+    sisyphus.trending.apply_updates(sisyphus.trending.coalesce([ x for updates in batches for x in updates ]), pipeline)
+    pipeline.incrby(CACHE_VERSION % TRAFFIC_VERSION, len(batches))
+    pipeline.execute()
+
+_trend_buffer = None
+_trend_buffer_lock = threading.Lock()
+
+def trend_buffer():
+    "Return the process-wide buffer of trending increments."
+    global _trend_buffer
+    if _trend_buffer is None:
+        with _trend_buffer_lock:
+            if _trend_buffer is None:
+                _trend_buffer = sisyphus.analytics.configured_buffer(flush_trend_updates, 'TRENDING')
+    return _trend_buffer
 
 def track(request, page, cli=None):
-    "Log pageview into analytics."
-    slug = page['slug']
-    # update trending data
-    cli.zincrby(PAGE_ZSET_BY_TREND, slug, PAGEVIEW_BONUS)
-    for tag_slug in page['tags']:
-        cli.zincrby(TAG_PAGES_ZSET_BY_TREND % tag_slug[1], slug, PAGEVIEW_BONUS)
+    """
+    Log pageview into trending scores and analytics. Trending updates
+    are queued and written to Redis in batches by a background thread
+    unless ``TRENDING_BUFFERED`` is False, and analytics likewise if
+    ``ANALYTICS_BUFFERED`` is True.
+    """
+    sisyphus.analytics.ensure_rollup_thread()
+    if getattr(settings, 'TRENDING_BUFFERED', True):
+        trend_buffer().put(sisyphus.trending.view_updates(page))
+    else:
+        cli = cli or redis_client()
+        sisyphus.trending.record_view(page, cli=cli)
+        bump_version(TRAFFIC_VERSION, cli=cli)
     if settings.REALTIME_ANALYTICS:
-        sisyphus.analytics.track(request, page, cli)
+        if getattr(settings, 'ANALYTICS_BUFFERED', False):
+            sisyphus.analytics.track_buffered(request, page)
+        else:
+            sisyphus.analytics.track(request, page, cli or redis_client())
 
-def search(raw_query, cli=None):
-    whoosh_index = whoosh.index.open_dir(settings.WHOOSH_INDEXDIR)
-    pages = []
-    searcher = None
-    try:
-        searcher = whoosh_index.searcher()
-        query = whoosh.qparser.QueryParser('content', PAGE_SCHEMA).parse(raw_query)
-        search_resp = searcher.search(query, limit=None)
-        slugs = [ x['slug'] for x in search_resp ]
-        if slugs:
-            cli = cli or redis_client()
-            pages = [ add_tag_counts(json.loads(y)) for y in cli.mget([ PAGE_STRING % x for x in slugs]) ]
-    finally:
-        if searcher is not None:
+_searchers = threading.local()
+
+def get_searcher():
+    """
+    Return this thread's long-lived searcher, reopening it after a fork
+    or a change of index directory, and refreshing it when the index
+    has new commits.
+    """
+    owner = (os.getpid(), settings.WHOOSH_INDEXDIR)
+    searcher = getattr(_searchers, 'searcher', None)
+    if searcher is None or _searchers.owner != owner:
+        searcher = whoosh.index.open_dir(settings.WHOOSH_INDEXDIR).searcher()
+        _searchers.owner = owner
+    elif not searcher.up_to_date():
+        refreshed = searcher.refresh()
+        if refreshed is not searcher:
             searcher.close()
-    return pages
+        searcher = refreshed
+    _searchers.searcher = searcher
+    return searcher
 
+def search(raw_query, offset=0, limit=10, cli=None):
+    """
+    Search pages, returning (page summaries, total matches).
 
-def redis_client(host="localhost", port=6379, db=0):
-    return redis.Redis(host, port, db=db)
+    Only the requested window of results is scored and hydrated.
+    """
+    searcher = get_searcher()
+    query = whoosh.qparser.QueryParser('content', PAGE_SCHEMA).parse(raw_query)
+    results = searcher.search(query, limit=offset+limit)
+    slugs = [ x['slug'] for x in results[offset:offset+limit] ]
+    return hydrate_summaries(slugs, cli=cli), len(results)
+
+
+class ConnectionPool(redis.BlockingConnectionPool):
+    "Blocking connection pool which records usage for monitoring."
+
+    def __init__(self, **kwargs):
+        self.stats_lock = threading.Lock()
+        self.in_use = 0
+        self.waits = 0
+        self.created = 0
+        super(ConnectionPool, self).__init__(**kwargs)
+
+    def make_connection(self):
+        with self.stats_lock:
+            self.created += 1
+        return super(ConnectionPool, self).make_connection()
+
+    def get_connection(self, command_name, *keys, **options):
+        if self.pool.empty():
+            with self.stats_lock:
+                self.waits += 1
+        connection = super(ConnectionPool, self).get_connection(command_name, *keys, **options)
+        with self.stats_lock:
+            self.in_use += 1
+        return connection
+
+    def release(self, connection):
+        with self.stats_lock:
+            self.in_use = max(self.in_use - 1, 0)
+        super(ConnectionPool, self).release(connection)
+
+    def stats(self):
+        "Return a snapshot of pool usage."
+        with self.stats_lock:
+            return { 'pid': self.pid,
+                     'max_connections': self.max_connections,
+                     'created': self.created,
+                     'in_use': self.in_use,
+                     'idle': max(len(self._connections) - self.in_use, 0),
+                     'waits': self.waits,
+                     }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def connection_pool():
+    """
+    Return the process-wide connection pool, creating it on first
+    use or after a fork, since connections can't be shared with
+    the parent process.
+    """
+    global _pool
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(
+                    host=getattr(settings, 'REDIS_HOST', 'localhost'),
+                    port=getattr(settings, 'REDIS_PORT', 6379),
+                    db=getattr(settings, 'REDIS_DB', 0),
+                    max_connections=getattr(settings, 'REDIS_MAX_CONNECTIONS', 50),
+                    timeout=getattr(settings, 'REDIS_POOL_TIMEOUT', 20),
+                    socket_timeout=getattr(settings, 'REDIS_SOCKET_TIMEOUT', None),
+                    socket_connect_timeout=getattr(settings, 'REDIS_SOCKET_CONNECT_TIMEOUT', None),
+                    )
+            pool = _pool
+    return pool
+
+def pool_stats():
+    "Usage statistics for this process's connection pool."
+    return connection_pool().stats()
+
+def redis_client():
+    "Return a client backed by the shared connection pool."
+    return redis.Redis(connection_pool=connection_pool())
+
+_scripts = {}
+
+def lua_script(source):
+    """
+    Return a callable for a Lua script, run with EVALSHA and loaded
+    into Redis the first time it is missing there.
+    """
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = redis_client().register_script(source)
+    return script
 
-def add_tag_counts(page, cli=None):
-    "Extend page with tag counts."
+def bump_version(scope, cli=None):
+    """
+    Advance the version counter for scope, invalidating anything
+    cached against its previous version.
+    """
+    cli = cli or redis_client()
+    return cli.incr(CACHE_VERSION % scope)
+
+def get_versions(cli=None):
+    "Retrieve the current version counter of each scope."
     cli = cli or redis_client()
+    versions = cli.mget([ CACHE_VERSION % x for x in CACHE_VERSION_SCOPES ])
+    return dict((scope, int(version or 0)) for scope, version in zip(CACHE_VERSION_SCOPES, versions))
+
+def tag_counts(tag_slugs, cli=None):
+    "Retrieve the number of pages in each tag, in one round trip."
+    tag_slugs = list(set(tag_slugs))
+    if not tag_slugs:
+        return {}
+    cli = cli or redis_client()
+    pipeline = cli.pipeline(transaction=False)
+    for tag in tag_slugs:
+        pipeline.zscore(TAG_ZSET_BY_PAGES, tag)
+    return dict((tag, int(score or 0)) for tag, score in zip(tag_slugs, pipeline.execute()))
+
+def decorate_tags(page, counts):
+    "Replace page's tag slugs with (count, slug) pairs."
     tags = page['tags']
     if tags:
-        pipeline = cli.pipeline()
-        for tag in tags:
-            pipeline.zscore(TAG_ZSET_BY_PAGES, tag)
-        scores = [ x or 0 for x in pipeline.execute() ]
-        page['tags'] = sorted(zip([ int(x) for x in scores], tags), reverse=True)
+        page['tags'] = sorted([ (counts.get(x, 0), x) for x in tags ], reverse=True)
     return page
 
+def add_tag_counts(page, cli=None):
+    "Extend page with tag counts."
+    return decorate_tags(page, tag_counts(page['tags'], cli=cli))
+
+def hydrate_pages(page_slugs, cli=None, with_tag_counts=True):
+    """
+    Retrieve pages with their tag counts.
+
+    Costs two round trips however many pages are requested:
+    one pipeline of MGETs for the pages' metadata and bodies, and
+    one pipeline of ZSCOREs for the distinct tags across all of
+    them. Missing pages are skipped.
+    """
+    if not page_slugs:
+        return []
+    cli = cli or redis_client()
+    pipeline = cli.pipeline(transaction=False)
+    pipeline.mget([ PAGE_STRING % x for x in page_slugs ])
+    pipeline.mget([ PAGE_BODY % x for x in page_slugs ])
+    metas, bodies = pipeline.execute()
+    pages = [ sisyphus.codec.decode_page(meta, body) for meta, body in zip(metas, bodies) if meta ]
+    if not with_tag_counts:
+        return pages
+    counts = tag_counts([ tag for page in pages for tag in page['tags'] ], cli=cli)
+    return [ decorate_tags(page, counts) for page in pages ]
+
+def page_summary(page):
+    "Project page onto the fields needed to list and link to it."
+    return dict((x, page[x]) for x in SUMMARY_FIELDS if x in page)
+
+def write_page(page, cli, codec=None, compression=None):
+    "Store page's metadata, body and summary; cli may be a pipeline."
+    meta, body = sisyphus.codec.encode_page(page, codec, compression)
+    cli.set(PAGE_STRING % page['slug'], meta)
+    cli.set(PAGE_BODY % page['slug'], body)
+    cli.set(PAGE_SUMMARY % page['slug'], sisyphus.codec.dumps(page_summary(page), codec))
+
+def stored_slugs(cli=None):
+    "Stream the slugs of every stored page, published or not."
+    cli = cli or redis_client()
+    prefix = PAGE_STRING % ""
+    for key in cli.scan_iter(PAGE_STRING % "*", count=1000):
+        yield key[len(prefix):]
+
+def reencode_pages(codec=None, compression=None, batch_size=500, cli=None):
+    """
+    Rewrite every stored page and its summary with codec and compression
+    (by default ``PAGE_CODEC`` and ``PAGE_COMPRESSION``), including pages
+    stored as plain JSON. Returns the number of pages rewritten.
+    """
+    cli = cli or redis_client()
+    rewritten = 0
+    slugs = list(stored_slugs(cli))
+    for i in xrange(0, len(slugs), batch_size):
+        pipeline = cli.pipeline(transaction=False)
+        for page in hydrate_pages(slugs[i:i+batch_size], cli=cli, with_tag_counts=False):
+            write_page(page, pipeline, codec, compression)
+            rewritten += 1
+        pipeline.execute()
+    return rewritten
+
+def page_memory(page_slugs, cli=None):
+    "Bytes used by each page's metadata, body and summary, per MEMORY USAGE."
+    cli = cli or redis_client()
+    pipeline = cli.pipeline(transaction=False)
+    for slug in page_slugs:
+        for key in (PAGE_STRING, PAGE_BODY, PAGE_SUMMARY):
+            pipeline.execute_command('MEMORY', 'USAGE', key % slug)
+    used = [ int(x or 0) for x in pipeline.execute() ]
+    return [ sum(used[i:i+3]) for i in xrange(0, len(used), 3) ]
+
+def hydrate_summaries(page_slugs, cli=None, with_tag_counts=True):
+    """
+    Retrieve page summaries, like hydrate_pages but without reading
+    page bodies. Pages written before summaries existed are read in
+    full once, and their summaries stored.
+    """
+    if not page_slugs:
+        return []
+    cli = cli or redis_client()
+    found = dict((slug, sisyphus.codec.loads(x)) for slug, x in zip(page_slugs, cli.mget([ PAGE_SUMMARY % x for x in page_slugs ])) if x)
+    missing = [ x for x in page_slugs if x not in found ]
+    if missing:
+        pipeline = cli.pipeline(transaction=False)
+        for page in hydrate_pages(missing, cli=cli, with_tag_counts=False):
+            found[page['slug']] = page_summary(page)
+            pipeline.set(PAGE_SUMMARY % page['slug'], sisyphus.codec.dumps(found[page['slug']]))
+        pipeline.execute()
+    summaries = [ found[x] for x in page_slugs if x in found ]
+    if not with_tag_counts:
+        return summaries
+    counts = tag_counts([ tag for page in summaries for tag in page['tags'] ], cli=cli)
+    return [ decorate_tags(page, counts) for page in summaries ]
+
+def get_page_summary(page_slug, cli=None):
+    "Retrieve a page's summary."
+    summaries = hydrate_summaries([page_slug], cli=cli)
+    return summaries[0] if summaries else None
+
 def get_page(page_slug, cli=None):
     "Retrieve a page."
-    cli = cli or redis_client()
-    resp = cli.get(PAGE_STRING % page_slug)
-    return resp and add_tag_counts(json.loads(resp)) or resp
+    pages = hydrate_pages([page_slug], cli=cli)
+    return pages[0] if pages else None
 
 def add_tag(slug, created=None, cli=None):
     "Idempotently create a new tag."
@@ -117,27 +372,73 @@ def add_page_to_tag(tag_slug, page_slug, created=None, cli=None):
     if cli.zrank(TAG_PAGES_ZSET_BY_TIME % tag_slug, page_slug) is None:
         created = created or int(time.time())
         cli.zadd(TAG_PAGES_ZSET_BY_TIME % tag_slug, page_slug, created)
-        cli.zadd(TAG_PAGES_ZSET_BY_TREND % tag_slug, page_slug, created)
+        sisyphus.trending.apply_updates([(TAG_PAGES_ZSET_BY_TREND % tag_slug, page_slug, created,
+                                          sisyphus.trending.publish_weight())], cli, mode='publish')
         cli.zincrby(TAG_ZSET_BY_PAGES, tag_slug, 1)
+        bump_version(CONTENT_VERSION, cli=cli)
+
+def index_fields(page):
+    "Fields of page to store in the search index."
+    return {'title': page['title'], 'summary':page['summary'], 'content':page['html'], 'slug':page['slug']}
 
 def index_page(page):
     """
-    Create a search index for this page. Mostly useful if recreating
-    Sisyphus from a Redis snapshot but missing Whoosh index, e.g:
-
-        [index_page(x) for x in get_pages(0, 100000)]
-
-    Would reindex the 100k most recent posts.
+    Create a search index for this page. To rebuild the index for
+    every page, e.g. when recreating Sisyphus from a Redis snapshot
+    but missing the Whoosh index, use reindex_pages instead.
     """
+    index_pages([page])
+
+def index_pages(pages):
+    "Add or update pages in the search index with a single commit."
     try:
         whoosh_index = whoosh.index.open_dir(settings.WHOOSH_INDEXDIR)
     except Exception, e:
         whoosh_index = whoosh.index.create_in(settings.WHOOSH_INDEXDIR, PAGE_SCHEMA)
     writer = whoosh_index.writer()
-    to_index = {'title': page['title'], 'summary':page['summary'], 'content':page['html'], 'slug':page['slug']}
-    writer.update_document(**to_index)
+    for page in pages:
+        writer.update_document(**index_fields(page))
     writer.commit()
 
+def reindex_pages(chunk_size=1000, procs=1, multisegment=False, limitmb=128, optimize=True, progress=None, cli=None):
+    """
+    Rebuild the search index from every published page.
+
+    Pages are streamed from Redis chunk_size at a time into a single
+    writer (using procs processes) whose commit replaces the existing
+    segments, so searches use the old index until the new one is
+    complete, and keep using it if the rebuild fails. If given,
+    progress(indexed, total) is called after each chunk. Returns the
+    number of pages indexed.
+    """
+    cli = cli or redis_client()
+    try:
+        whoosh_index = whoosh.index.open_dir(settings.WHOOSH_INDEXDIR)
+    except whoosh.index.EmptyIndexError:
+        whoosh_index = whoosh.index.create_in(settings.WHOOSH_INDEXDIR, PAGE_SCHEMA)
+    if procs > 1:
+        writer = whoosh_index.writer(procs=procs, multisegment=multisegment, limitmb=limitmb)
+    else:
+        writer = whoosh_index.writer(limitmb=limitmb)
+    total = num_pages(cli=cli)
+    indexed = 0
+    try:
+        for offset in xrange(0, total, chunk_size):
+            page_slugs = cli.zrange(PAGE_ZSET_BY_TIME, offset, offset+chunk_size-1)
+            for page in hydrate_pages(page_slugs, cli=cli, with_tag_counts=False):
+                writer.add_document(**index_fields(page))
+                indexed += 1
+            if progress:
+                progress(indexed, total)
+    except:
+        writer.cancel()
+        raise
+    writer.commit(mergetype=whoosh.writing.CLEAR)
+    if optimize and procs > 1 and multisegment:
+        # each process wrote a segment of its own
+        whoosh_index.optimize()
+    return indexed
+
 
 def add_page(page, index=True, cli=None):
     """
@@ -146,32 +447,97 @@ def add_page(page, index=True, cli=None):
     Set index parameter to False if you want to load a page
     but don't want to associate it with any of the existing storylists.
     """
-    cli = cli or redis_client()
-    slug = page['slug']
-    old_page = get_page(slug)
+    add_pages([page], index=index, cli=cli)
 
-    if index and old_page and not old_page.get('published', False):
-        page['pub_date'] = int(time.time())
+def add_pages(pages, index=True, cli=None):
+    """
+    Create or update several pages at once.
 
-    if old_page and old_page['html'] != page['html']:
-        page['edit_date'] = int(time.time())
-    elif old_page and 'edit_date' in old_page:
-        page['edit_date'] = old_page['edit_date']
-    else:
-        page['edit_date'] = page['pub_date']
+    Costs two round trips however many pages are written, one to read
+    the existing pages and their tag memberships and one pipeline for
+    every write, plus a single commit to the search index.
+    """
+    if not pages:
+        return
+    cli = cli or redis_client()
+    now = int(time.time())
+
+    pipeline = cli.pipeline(transaction=False)
+    pipeline.mget([ PAGE_STRING % x['slug'] for x in pages ])
+    pipeline.mget([ PAGE_BODY % x['slug'] for x in pages ])
+    memberships = [ (page['slug'], tag) for page in pages for tag in page['tags'] ] if index else []
+    for slug, tag in memberships:
+        pipeline.zscore(TAG_PAGES_ZSET_BY_TIME % tag, slug)
+    results = pipeline.execute()
+    old_pages = [ meta and sisyphus.codec.decode_page(meta, body) for meta, body in zip(results[0], results[1]) ]
+    tagged = set(membership for membership, score in zip(memberships, results[2:]) if score is not None)
+
+    pipeline = cli.pipeline(transaction=False)
+    for page, old_page in zip(pages, old_pages):
+        slug = page['slug']
+        if index and old_page and not old_page.get('published', False):
+            page['pub_date'] = now
+
+        if old_page and old_page['html'] != page['html']:
+            page['edit_date'] = now
+        elif old_page and 'edit_date' in old_page:
+            page['edit_date'] = old_page['edit_date']
+        else:
+            page['edit_date'] = page['pub_date']
+
+        page['published'] = False
+        if index:
+            page['published'] = True
+            pipeline.zadd(PAGE_ZSET_BY_TIME, slug, page['pub_date'])
+            # ranks new pages and tag memberships, keeping existing scores
+            sisyphus.trending.publish(page, pipeline)
+            sisyphus.related.mark_dirty([slug], pipeline)
+            sisyphus.export.mark_dirty([slug], pipeline)
+
+            for tag in page['tags']:
+                if (slug, tag) not in tagged:
+                    tagged.add((slug, tag))
+                    pipeline.zadd(TAG_PAGES_ZSET_BY_TIME % tag, slug, page['pub_date'])
+                    pipeline.zincrby(TAG_ZSET_BY_PAGES, tag, 1)
+
+        write_page(page, pipeline)
+    pipeline.incr(CACHE_VERSION % CONTENT_VERSION)
+    pipeline.execute()
 
-    page['published'] = False
     if index:
-        page['published'] = True
-        cli.zadd(PAGE_ZSET_BY_TIME, slug, page['pub_date'])
-        cli.zadd(PAGE_ZSET_BY_TREND, slug, page['pub_date'])
+        sisyphus.feeds.pages_written(pages, cli=cli)
+        index_pages(pages)
 
-        for tag in page['tags']:
-            add_page_to_tag(tag, slug, created=page['pub_date'], cli=cli)
-
-        index_page(page)
+def unpublish_page(slug, cli=None):
+    """
+    Remove a page from the storylists, its tags and the search index,
+    keeping it as a draft. Returns the page, or None if missing.
+    """
+    cli = cli or redis_client()
+    pages = hydrate_pages([slug], cli=cli, with_tag_counts=False)
+    if not pages:
+        return None
+    page = pages[0]
+    cli.zrem(PAGE_ZSET_BY_TIME, slug)
+    cli.zrem(PAGE_ZSET_BY_TREND, slug)
+    for tag in page['tags']:
+        cli.zrem(TAG_PAGES_ZSET_BY_TREND % tag, slug)
+        if cli.zrem(TAG_PAGES_ZSET_BY_TIME % tag, slug):
+            cli.zincrby(TAG_ZSET_BY_PAGES, tag, -1)
+    page['published'] = False
+    write_page(page, cli)
+    sisyphus.related.mark_dirty([slug], cli)
+    sisyphus.export.mark_dirty([slug], cli)
+    sisyphus.feeds.page_removed(page, cli=cli)
+    bump_version(CONTENT_VERSION, cli=cli)
 
-    cli.set(PAGE_STRING % slug, json.dumps(page))
+    try:
+        writer = whoosh.index.open_dir(settings.WHOOSH_INDEXDIR).writer()
+        writer.delete_by_term('slug', slug)
+        writer.commit()
+    except whoosh.index.EmptyIndexError:
+        pass
+    return page
 
 def get_page_slugs(offset=0, limit=10, key=PAGE_ZSET_BY_TIME, reverse=True, cli=None, withscores=False):
     "Retrieve pages from global zsets."
@@ -185,50 +551,185 @@ def get_pages(offset=0, limit=10, key=PAGE_ZSET_BY_TIME, reverse=True, cli=None)
     "Retrieve pages data."
     cli = cli or redis_client()
     page_slugs = get_page_slugs(offset, limit, key, reverse, cli)
-    if page_slugs:
-        return [ add_tag_counts(json.loads(y)) for y in cli.mget([ PAGE_STRING % x for x in page_slugs]) ]
-    else:
-        return []
+    return hydrate_pages(page_slugs, cli=cli)
+
+def get_summaries(offset=0, limit=10, key=PAGE_ZSET_BY_TIME, reverse=True, cli=None):
+    "Retrieve page summaries, for lists which don't show page bodies."
+    cli = cli or redis_client()
+    page_slugs = get_page_slugs(offset, limit, key, reverse, cli)
+    return hydrate_summaries(page_slugs, cli=cli)
 
 def get_nearby_pages(page, limit=3, cli=None):
-    "Retrieve preceeding and following articles."
-    slug = page['slug']
-    pub_date = page['pub_date']
+    """
+    Retrieve summaries of the limit pages published before and after
+    page, as (preceding, following), nearest first.
+    """
     cli = cli or redis_client()
-    key = PAGE_ZSET_BY_TIME
-    rank = cli.zrank(key, slug)
-    start = max(rank-limit, 0)
-    end = max(limit, rank+limit)
-    page_slugs = cli.zrange(key, start, end)
+    pub_date = page['pub_date']
+    if hasattr(pub_date, 'timetuple'):
+        pub_date = int(time.mktime(pub_date.timetuple()))
+    pipeline = cli.pipeline(transaction=False)
+    pipeline.zrevrangebyscore(PAGE_ZSET_BY_TIME, "(%s" % pub_date, "-inf", start=0, num=limit)
+    pipeline.zrangebyscore(PAGE_ZSET_BY_TIME, "(%s" % pub_date, "+inf", start=0, num=limit)
+    before, after = pipeline.execute()
+    summaries = dict((x['slug'], x) for x in hydrate_summaries(before + after, cli=cli))
+    return [ summaries[x] for x in before if x in summaries ], [ summaries[x] for x in after if x in summaries ]
+
+# KEYS: lock; ARGV: token. Only the holder may release a lock.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
-    if page_slugs:
-        return [ json.loads(y) for y in cli.mget([ PAGE_STRING % x for x in page_slugs]) ]
-    else:
-        return []
+_derived_stats = { 'hits': 0,
+                   'recomputes': 0,
+                   'early_recomputes': 0,
+                   'recompute_seconds': 0.0,
+                   'recompute_errors': 0,
+                   'stale_served': 0,
+                   'lock_waits': 0,
+                   'lock_wait_seconds': 0.0,
+                   'lock_retries': 0,
+                   'lock_timeouts': 0,
+                   }
+_derived_stats_lock = threading.Lock()
+
+def count_derived(**amounts):
+    with _derived_stats_lock:
+        for name, amount in amounts.items():
+            _derived_stats[name] += amount
+
+def derived_stats():
+    "Snapshot of this process's derived key recomputes and lock waits."
+    with _derived_stats_lock:
+        return dict(_derived_stats)
+
+def recompute_derived(key, build, ttl, cli, expiry=None):
+    "Run build(key, cli), recording how long it took alongside the key's new expiry."
+    start = time.time()
+    try:
+        build(key, cli)
+    except Exception:
+        count_derived(recompute_errors=1)
+        raise
+    delta = time.time() - start
+    stale_ttl = ttl + getattr(settings, 'DERIVED_KEY_STALE_TTL', 5 * 60)
+    pipeline = cli.pipeline(transaction=False)
+    pipeline.expire(key, stale_ttl)
+    pipeline.setex(DERIVED_META % key, "%f:%f" % (start + delta + ttl, delta), stale_ttl)
+    pipeline.execute()
+    early = expiry is not None and start < expiry
+    count_derived(recomputes=1, early_recomputes=int(early), recompute_seconds=delta)
+
+def locked_recompute(key, build, ttl, cli, expiry=None):
+    "Recompute key unless another worker holds its lock, returning whether this one did."
+    lock = DERIVED_LOCK % key
+    token = os.urandom(8).encode('hex')
+    if not cli.set(lock, token, px=getattr(settings, 'DERIVED_KEY_LOCK_MS', 5000), nx=True):
+        return False
+    try:
+        recompute_derived(key, build, ttl, cli, expiry)
+    finally:
+        lua_script(RELEASE_SCRIPT)(keys=[lock], args=[token], client=cli)
+    return True
+
+def derived_key(key, build, ttl, cli=None):
+    """
+    Return key, recomputing it with build(key, cli) once it is due.
+
+    Keys are kept for ``DERIVED_KEY_STALE_TTL`` seconds past their ttl,
+    and only the worker holding a short lock recomputes an expired key
+    while others serve the stale value. Requests may also refresh a key
+    early, increasingly likely as expiry nears and the longer it took to
+    compute, so popular keys are usually recomputed before they expire.
+    Requests finding no value at all wait for the lock's holder, and
+    retry the build themselves if it gives up without one.
+
+    A build leaving no key, such as a union of empty sets, still records
+    its expiry, so the missing key is served as a fresh empty result
+    rather than rebuilt by every request.
+    """
+    cli = cli or redis_client()
+    pipeline = cli.pipeline(transaction=False)
+    pipeline.exists(key)
+    pipeline.get(DERIVED_META % key)
+    exists, meta = pipeline.execute()
+    expiry = None
+    if meta:
+        expiry, delta = [ float(x) for x in meta.split(':') ]
+        beta = getattr(settings, 'DERIVED_KEY_BETA', 1.0)
+        if time.time() - delta * beta * math.log(random.random() or 1e-12) < expiry:
+            count_derived(hits=1)
+            return key
+
+    if locked_recompute(key, build, ttl, cli, expiry):
+        return key
+    if exists or meta:
+        count_derived(stale_served=1)
+        return key
+
+    lock = DERIVED_LOCK % key
+    start = time.time()
+    deadline = start + getattr(settings, 'DERIVED_KEY_LOCK_MS', 5000) / 1000.0
+    while time.time() < deadline:
+        time.sleep(0.01)
+        pipeline = cli.pipeline(transaction=False)
+        pipeline.exists(DERIVED_META % key)
+        pipeline.exists(lock)
+        built, locked = pipeline.execute()
+        if built:
+            count_derived(lock_waits=1, lock_wait_seconds=time.time() - start)
+            return key
+        # the holder released its lock without a result, so try again here
+        if not locked and locked_recompute(key, build, ttl, cli):
+            count_derived(lock_waits=1, lock_wait_seconds=time.time() - start, lock_retries=1)
+            return key
+    # the holder is stuck or gone, so don't wait on it any longer
+    count_derived(lock_waits=1, lock_wait_seconds=time.time() - start, lock_timeouts=1)
+    recompute_derived(key, build, ttl, cli, expiry)
+    return key
 
 def ensure_similar_pages_key(page, cli=None):
-    "Make sure the data exists."
-    cli = cli or redis_client()
-    sim_key = SIMILAR_PAGES_BY_TREND % page['slug']
-    if not cli.exists(sim_key):
-        tag_keys = [ TAG_PAGES_ZSET_BY_TREND % x[1] for x in page.get('tags',[])]
-        if tag_keys:
-            cli.zunionstore(sim_key, tag_keys)
-            cli.zrem(sim_key, page['slug'])
-            cli.expire(sim_key, SIMILAR_PAGES_EXPIRE)
-        else:
-            return None
-    return sim_key
+    "Make sure the union of page's tags' trending pages exists, without stampeding on expiry."
+    cli = cli or redis_client()
+    tag_keys = [ TAG_PAGES_ZSET_BY_TREND % x[1] for x in page.get('tags',[])]
+    if not tag_keys:
+        return None
+
+    def build(key, cli):
+        pipeline = cli.pipeline()
+        pipeline.zunionstore(key, tag_keys)
+        pipeline.zrem(key, page['slug'])
+        pipeline.execute()
+    return derived_key(SIMILAR_PAGES_BY_TREND % page['slug'], build, SIMILAR_PAGES_EXPIRE, cli=cli)
+
+def similar_pages_key(page, cli=None):
+    """
+    Return the key of the sorted set of pages similar to page: its
+    precomputed related pages, or if they haven't been built yet the
+    union of its tags' trending pages.
+    """
+    cli = cli or redis_client()
+    if cli.exists(sisyphus.related.RELATED % page['slug']):
+        return sisyphus.related.RELATED % page['slug']
+    return ensure_similar_pages_key(page, cli=cli)
 
 def similar_pages(page, offset=0, limit=3, withscores=False, cli=None):
-    "Find top performing stories in similar tags."
-    cli = cli or redis_client()
-    sim_key = ensure_similar_pages_key(page, cli=cli)
-    if sim_key:
-        page_slugs = cli.zrevrange(sim_key, offset, offset+limit-1, withscores=withscores)
-        if page_slugs:
-            return [ json.loads(y) for y in cli.mget([ PAGE_STRING % x for x in page_slugs]) ]
-    return []
+    """
+    Find summaries of the pages most similar to page, as (summary,
+    score) pairs if withscores.
+    """
+    cli = cli or redis_client()
+    sim_key = similar_pages_key(page, cli=cli)
+    if not sim_key:
+        return []
+    resp = cli.zrevrange(sim_key, offset, offset+limit-1, withscores=True)
+    summaries = dict((x['slug'], x) for x in hydrate_summaries([ x for x, y in resp ], cli=cli))
+    if withscores:
+        return [ (summaries[x], y) for x, y in resp if x in summaries ]
+    return [ summaries[x] for x, y in resp if x in summaries ]
 
 def tags(offset=0, limit=10, withscores=True, cli=None):
     cli = cli or redis_client()
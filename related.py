@@ -0,0 +1,163 @@
+"""
+Precomputed related pages.
+
+Each published page keeps its ``RELATED_TOP_K`` most related pages in a
+small sorted set, ``related.<slug>``, so similar pages are read in O(K)
+rather than unioning the trending sets of each of its tags per request.
+
+Relatedness is the IDF-weighted Jaccard similarity of two pages' tags,
+so sharing a rare tag counts for more than sharing a common one, blended
+with the candidate's trending score by ``RELATED_TREND_WEIGHT``.
+
+Writing or unpublishing a page marks it dirty, and ``rebuild`` rescores
+the lists of dirty pages in full, then merges the dirty pages' new
+scores into the stored lists of every page sharing a tag with them. A
+rebuild therefore costs O(dirty pages x their neighbours) plus reading
+K entries per neighbour, rather than rescoring each neighbour against
+every page of its tags. A neighbour is only rescored in full when a
+page it listed scores lower or leaves while its list is full, since a
+page it didn't list might then belong. Merged lists keep the IDF
+weights and trending scores they were built with. ``rebuild`` runs at
+the end of each sync, and ``rebuild_related`` rebuilds every list,
+which refreshes both.
+"""
+import math
+from django.conf import settings
+import sisyphus.models
+
+RELATED = "related.%s"
+RELATED_DIRTY = "related_dirty"
+
+def top_k():
+    return getattr(settings, 'RELATED_TOP_K', 20)
+
+def mark_dirty(slugs, cli):
+    "Record that slugs' related pages need rebuilding; cli may be a pipeline."
+    if slugs:
+        cli.sadd(RELATED_DIRTY, *slugs)
+
+def tag_index(cli):
+    "Map each published page to its set of tags, from the tags' page lists."
+    tags = cli.zrange(sisyphus.models.TAG_ZSET_BY_PAGES, 0, -1)
+    pipeline = cli.pipeline(transaction=False)
+    for tag in tags:
+        pipeline.zrange(sisyphus.models.TAG_PAGES_ZSET_BY_TIME % tag, 0, -1)
+    page_tags = {}
+    for tag, slugs in zip(tags, pipeline.execute()):
+        for slug in slugs:
+            page_tags.setdefault(slug, set()).add(tag)
+    return page_tags
+
+def trend_weights(cli):
+    "Map each page to its trending score relative to the top page's, in (0, 1]."
+    scores = cli.zrange(sisyphus.models.PAGE_ZSET_BY_TREND, 0, -1, withscores=True)
+    if not scores:
+        return {}
+    top = max(x[1] for x in scores)
+    return dict((slug, math.exp(score - top)) for slug, score in scores)
+
+def related_score(tags, other, candidate, idf, trends):
+    "Score a candidate with tags other as related to a page with tags."
+    trend_weight = getattr(settings, 'RELATED_TREND_WEIGHT', 0.2)
+    similarity = sum(idf[x] for x in tags & other) / sum(idf[x] for x in tags | other)
+    return (1 - trend_weight) * similarity + trend_weight * trends.get(candidate, 0)
+
+def best(scores):
+    "The top k of {slug: score}."
+    ranked = sorted(((y, x) for x, y in scores.items()), reverse=True)
+    return dict((x, y) for y, x in ranked[:top_k()])
+
+def related_scores(slug, page_tags, tag_pages, idf, trends):
+    "Score every page sharing a tag with slug, returning the top k as {slug: score}."
+    tags = page_tags[slug]
+    candidates = set()
+    for tag in tags:
+        candidates.update(tag_pages[tag])
+    candidates.discard(slug)
+    return best(dict((x, related_score(tags, page_tags[x], x, idf, trends)) for x in candidates))
+
+def merge_scores(slug, current, dirty, page_tags, idf, trends):
+    """
+    Merge the dirty pages' new scores into slug's current top k, as
+    {slug: score}. Returns None if slug needs rescoring in full: when a
+    page it listed scores lower or left while the list was full.
+    """
+    tags = page_tags[slug]
+    full = len(current) >= top_k()
+    merged = dict(current)
+    for other in dirty:
+        if other == slug:
+            continue
+        old = merged.pop(other, None)
+        if other in page_tags and tags & page_tags[other]:
+            merged[other] = related_score(tags, page_tags[other], other, idf, trends)
+            if full and old is not None and merged[other] < old:
+                return None
+        elif full and old is not None:
+            return None
+    return best(merged)
+
+def rebuild(cli=None, full=False, batch_size=500):
+    """
+    Rebuild the related pages of dirty pages, merging their new scores
+    into their neighbours' lists, or rebuild every page's if full.
+    Returns the number of lists written.
+    """
+    cli = cli or sisyphus.models.redis_client()
+    dirty = cli.smembers(RELATED_DIRTY)
+    if not dirty and not full:
+        return 0
+    page_tags = tag_index(cli)
+    tag_pages = {}
+    for slug, tags in page_tags.items():
+        for tag in tags:
+            tag_pages.setdefault(tag, set()).add(slug)
+    idf = dict((tag, math.log(1.0 + float(len(page_tags)) / len(slugs))) for tag, slugs in tag_pages.items())
+    trends = trend_weights(cli)
+
+    merged = {}
+    if full:
+        targets = set(page_tags)
+    else:
+        # unpublished pages have left the tag index, so use their stored tags
+        affected_tags = set()
+        for page in sisyphus.models.hydrate_summaries(list(dirty), cli=cli, with_tag_counts=False):
+            affected_tags.update(page['tags'])
+        for slug in dirty:
+            affected_tags.update(page_tags.get(slug, ()))
+        targets = set(x for x in dirty if x in page_tags)
+        neighbours = set()
+        for tag in affected_tags:
+            neighbours.update(tag_pages.get(tag, ()))
+        neighbours = list(neighbours - targets)
+        for i in xrange(0, len(neighbours), batch_size):
+            pipeline = cli.pipeline(transaction=False)
+            for slug in neighbours[i:i+batch_size]:
+                pipeline.zrange(RELATED % slug, 0, -1, withscores=True)
+            for slug, current in zip(neighbours[i:i+batch_size], pipeline.execute()):
+                scores = merge_scores(slug, dict(current), dirty, page_tags, idf, trends) if current else None
+                if scores is None:
+                    targets.add(slug)
+                else:
+                    merged[slug] = scores
+    stale = set(dirty) - targets - set(merged)
+
+    def rescored():
+        for slug in targets:
+            yield slug, related_scores(slug, page_tags, tag_pages, idf, trends)
+        for item in merged.items():
+            yield item
+
+    pipeline = cli.pipeline()
+    for slug in stale:
+        pipeline.delete(RELATED % slug)
+    for i, (slug, scores) in enumerate(rescored()):
+        pipeline.delete(RELATED % slug)
+        if scores:
+            pipeline.zadd(RELATED % slug, *[ x for item in scores.items() for x in item ])
+        if i % batch_size == batch_size - 1:
+            pipeline.execute()
+    if dirty:
+        pipeline.srem(RELATED_DIRTY, *dirty)
+    pipeline.execute()
+    return len(targets) + len(merged)
@@ -1,35 +1,168 @@
-from django.contrib.sitemaps import Sitemap
+"""
+Sitemaps, precomputed at sync time.
+
+Every published page and tag is listed, streamed from ``pages_by_time``
+and ``tags_by_pages`` in batches rather than loading every page at once.
+URLs are split into sitemaps of at most ``SITEMAP_MAX_URLS`` (the 50,000
+allowed by the protocol), listed by a sitemap index at ``/sitemap.xml``,
+and each file is stored gzipped in Redis along with its ETag and
+Last-Modified, so serving one is a single read. If ``SITEMAP_DIR`` is
+set they are also written there, as ``sitemap.xml.gz``,
+``sitemap-1.xml.gz`` and so on, for the web server to serve directly.
+"""
+import os
+import time
+import zlib
+import hashlib
+from xml.sax.saxutils import escape
+from django.conf import settings
 import sisyphus.models
-import datetime
+import sisyphus.codec
+
+SITEMAP = "sitemap.%s"
+SITEMAP_INDEX = "index"
+SITEMAP_FILES = "sitemap_files"
+SITEMAP_CONTENT_TYPE = "application/xml"
+
+URLSET_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+URLSET_FOOTER = '</urlset>\n'
+INDEX_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+INDEX_FOOTER = '</sitemapindex>\n'
+
+def max_urls():
+    return getattr(settings, 'SITEMAP_MAX_URLS', 50000)
+
+def absolute(path):
+    return "http://%s%s" % (settings.DOMAIN, path)
+
+def w3c_date(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+def page_urls(cli, batch_size=1000):
+    "Stream (path, last modified) for each published page, newest first."
+    for offset in xrange(0, sisyphus.models.num_pages(cli=cli), batch_size):
+        slugs = cli.zrevrange(sisyphus.models.PAGE_ZSET_BY_TIME, offset, offset + batch_size - 1, withscores=True)
+        # pages may have been edited since they were published
+        summaries = cli.mget([ sisyphus.models.PAGE_SUMMARY % x for x, y in slugs ])
+        for (slug, pub_date), summary in zip(slugs, summaries):
+            edit_date = sisyphus.codec.loads(summary).get('edit_date') if summary else None
+            yield "/%s/" % slug, int(edit_date or pub_date)
+
+def tag_urls(cli, batch_size=1000):
+    "Stream (path, last modified) for each tag, the latest time a page was added to it."
+    tags = cli.zrevrange(sisyphus.models.TAG_ZSET_BY_PAGES, 0, -1)
+    for i in xrange(0, len(tags), batch_size):
+        pipeline = cli.pipeline(transaction=False)
+        for tag in tags[i:i+batch_size]:
+            pipeline.zrevrange(sisyphus.models.TAG_PAGES_ZSET_BY_TIME % tag, 0, 0, withscores=True)
+        for tag, latest in zip(tags[i:i+batch_size], pipeline.execute()):
+            if latest:
+                yield "/tags/%s/" % tag, int(latest[0][1])
+
+def url_entry(path, lastmod):
+    return "<url><loc>%s</loc><lastmod>%s</lastmod></url>\n" % (escape(absolute(path)), w3c_date(lastmod))
+
+def index_entry(path, lastmod):
+    return "<sitemap><loc>%s</loc><lastmod>%s</lastmod></sitemap>\n" % (escape(absolute(path)), w3c_date(lastmod))
+
+
+class SitemapWriter(object):
+    "Gzip a sitemap as it is written, tracking its digest and latest modification."
+
+    def __init__(self, header, footer):
+        self.compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.digest = hashlib.md5()
+        self.chunks = []
+        self.footer = footer
+        self.count = 0
+        self.last_modified = 0
+        self.write(header)
+
+    def write(self, data):
+        self.digest.update(data)
+        self.chunks.append(self.compressor.compress(data))
+
+    def add(self, entry, lastmod):
+        self.write(entry)
+        self.count += 1
+        self.last_modified = max(self.last_modified, lastmod)
 
-SITEMAPS = {}
+    def close(self):
+        "Finish the sitemap, returning its stored form."
+        self.write(self.footer)
+        self.chunks.append(self.compressor.flush())
+        return { 'gzip': "".join(self.chunks),
+                 'etag': '"%s"' % self.digest.hexdigest(),
+                 'last_modified': self.last_modified,
+                 }
 
-class PageSitemap(Sitemap):
-    changefreq = "daily"
-    priority = 0.5
 
-    def items(self):
-        cli = sisyphus.models.redis_client()
-        pages =  sisyphus.models.get_pages(limit=10000, cli=cli)
-        return [ sisyphus.models.convert_pub_date_to_datetime(x) for x in pages ]
+def sitemap_path(name):
+    return "/sitemap.xml" if name == SITEMAP_INDEX else "/sitemap-%s.xml" % name
 
-    def location(self, obj):
-        return "/%s/" % (obj['slug'])
+def write_file(directory, name, sitemap):
+    "Write a gzipped sitemap into directory, replacing any previous version atomically."
+    path = os.path.join(directory, sitemap_path(name)[1:] + ".gz")
+    with open(path + ".tmp", 'wb') as fout:
+        fout.write(sitemap['gzip'])
+    os.utime(path + ".tmp", (sitemap['last_modified'], sitemap['last_modified']))
+    os.rename(path + ".tmp", path)
 
-    def lastmod(self, obj):
-        return obj.get('edit_date', obj.get('pub_date', datetime.datetime.now()))
-SITEMAPS['pages'] = PageSitemap
+def build(cli=None, batch_size=1000):
+    """
+    Regenerate the sitemap index and sitemaps, returning
+    (number of URLs, number of sitemaps).
+    """
+    cli = cli or sisyphus.models.redis_client()
+    sitemaps = []
+    writer = None
+    urls = 0
+    for urls_iter in (page_urls(cli, batch_size), tag_urls(cli, batch_size)):
+        for path, lastmod in urls_iter:
+            if writer is None or writer.count >= max_urls():
+                if writer is not None:
+                    sitemaps.append(writer.close())
+                writer = SitemapWriter(URLSET_HEADER, URLSET_FOOTER)
+            writer.add(url_entry(path, lastmod), lastmod)
+            urls += 1
+    if writer is not None:
+        sitemaps.append(writer.close())
 
-class TagSitemap(Sitemap):
-    changefreq = "daily"
-    priority = 0.5
-    lastmod = datetime.datetime.now()
+    index = SitemapWriter(INDEX_HEADER, INDEX_FOOTER)
+    for number, sitemap in enumerate(sitemaps, 1):
+        index.add(index_entry(sitemap_path(number), sitemap['last_modified']), sitemap['last_modified'])
+    stored = dict((str(number), sitemap) for number, sitemap in enumerate(sitemaps, 1))
+    stored[SITEMAP_INDEX] = index.close()
 
-    def items(self):
-        cli = sisyphus.models.redis_client()
-        return sisyphus.models.tags(limit=1000, withscores=False, cli=cli)
+    old_names = cli.smembers(SITEMAP_FILES)
+    pipeline = cli.pipeline()
+    for name, sitemap in stored.items():
+        pipeline.delete(SITEMAP % name)
+        pipeline.hmset(SITEMAP % name, sitemap)
+    for name in set(old_names) - set(stored):
+        pipeline.delete(SITEMAP % name)
+    pipeline.delete(SITEMAP_FILES)
+    pipeline.sadd(SITEMAP_FILES, *stored.keys())
+    pipeline.execute()
 
-    def location(self, obj):
-        return "/tags/%s/" % (obj,)
+    directory = getattr(settings, 'SITEMAP_DIR', None)
+    if directory:
+        for name, sitemap in stored.items():
+            write_file(directory, name, sitemap)
+        for name in set(old_names) - set(stored):
+            path = os.path.join(directory, sitemap_path(name)[1:] + ".gz")
+            if os.path.exists(path):
+                os.remove(path)
+    return urls, len(sitemaps)
 
-SITEMAPS['tags'] = TagSitemap
+def get_sitemap(name, cli=None):
+    "Retrieve a stored sitemap, building them all first if none have been."
+    cli = cli or sisyphus.models.redis_client()
+    sitemap = cli.hgetall(SITEMAP % name)
+    if not sitemap and name == SITEMAP_INDEX and not cli.exists(SITEMAP_FILES):
+        build(cli=cli)
+        sitemap = cli.hgetall(SITEMAP % name)
+    if not sitemap:
+        return None
+    sitemap['last_modified'] = int(sitemap['last_modified'])
+    return sitemap
@@ -5,7 +5,23 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import os
+import math
+import zlib
+import shutil
+import tempfile
+import threading
+import redis
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from django.conf import settings
+from django.http import HttpRequest
+from django.test.client import RequestFactory
+from django.utils.http import http_date, parse_http_date
 from django.test import TestCase
+import sisyphus.analytics
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,6 +30,1069 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+
+class UrlsTest(TestCase):
+    "Routes and the views they name."
+
+    def test_views_exist(self):
+        "Every route names a view which exists."
+        import sisyphus.urls
+        for pattern in sisyphus.urls.urlpatterns:
+            self.assertTrue(callable(pattern.callback), pattern.regex.pattern)
+
+    def test_stats(self):
+        "Internal monitoring can read /_stats/."
+        from django.test.client import RequestFactory
+        import sisyphus.views
+        request = RequestFactory().get("/_stats/", REMOTE_ADDR="127.0.0.1")
+        old_ips = getattr(settings, 'INTERNAL_IPS', ())
+        settings.INTERNAL_IPS = ("127.0.0.1",)
+        try:
+            response = sisyphus.views.stats(request)
+        finally:
+            settings.INTERNAL_IPS = old_ips
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('redis_pool' in json.loads(response.content))
+
+
+class ScratchTestCase(TestCase):
+    """
+    Tests against the scratch database in BENCHMARK_REDIS_DB, which is
+    used by the process-wide connection pool for the test's duration.
+    """
+
+    def setUp(self):
+        import sisyphus.benchmarks
+        try:
+            self.cli = sisyphus.benchmarks.scratch_client()
+        except ValueError, e:
+            self.skipTest(str(e))
+        except redis.exceptions.ConnectionError:
+            self.skipTest("Redis is unreachable")
+
+    def tearDown(self):
+        import sisyphus.benchmarks
+        sisyphus.benchmarks.release_scratch_client(self.cli)
+
+
+class TrackTest(ScratchTestCase):
+    "Analytics tracking."
+
+    def make_request(self, ip):
+        request = HttpRequest()
+        request.META = { 'HTTP_USER_AGENT': "Mozilla/5.0",
+                         'HTTP_REFERER': "http://example.com/",
+                         'REMOTE_ADDR': ip,
+                         }
+        return request
+
+    def test_concurrent_views_from_one_ip(self):
+        "Many simultaneous views from one IP in one minute count once."
+        page = { 'slug': "concurrent", 'tags': [] }
+        now = 1300000000
+        tracked = []
+        start = threading.Event()
+
+        def hammer():
+            start.wait()
+            for i in xrange(25):
+                if sisyphus.analytics.track(self.make_request("10.0.0.1"), page, self.cli, now=now):
+                    tracked.append(1)
+
+        threads = [ threading.Thread(target=hammer) for x in xrange(20) ]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(tracked), 1)
+        self.assertEqual(self.cli.zscore(sisyphus.analytics.ANALYTICS_PAGEVIEW, "concurrent"), 1)
+        self.assertEqual(self.cli.zscore(sisyphus.analytics.ANALYTICS_REFER_PAGE % "concurrent", "example.com"), 1)
+        self.assertEqual(self.cli.zscore(sisyphus.analytics.ANALYTICS_PAGEVIEW_BUCKET, now / (24 * 60 * 60)), 1)
+        self.assertTrue(0 < self.cli.ttl(sisyphus.analytics.ANALYTICS_BACKOFF % ("10.0.0.1", now / 60)) <= 60)
+
+    def test_views_from_other_ips_and_minutes(self):
+        "Backoff is per IP and per minute."
+        page = { 'slug': "backoff", 'tags': [] }
+        now = 1300000000
+        sisyphus.analytics.track(self.make_request("10.0.0.1"), page, self.cli, now=now)
+        sisyphus.analytics.track(self.make_request("10.0.0.2"), page, self.cli, now=now)
+        sisyphus.analytics.track(self.make_request("10.0.0.1"), page, self.cli, now=now + 60)
+        self.assertEqual(self.cli.zscore(sisyphus.analytics.ANALYTICS_PAGEVIEW, "backoff"), 3)
+
+
+class EventBufferTest(TestCase):
+    "The in-process buffer of pageview events."
+
+    def test_concurrent_puts(self):
+        "Counters stay exact under concurrent puts and flushes."
+        flushed = []
+        def flush(events, cli):
+            if not events[0]:
+                raise ValueError("unflushable")
+            flushed.extend(events)
+        buf = sisyphus.analytics.EventBuffer(flush, maxsize=1000, interval=3600)
+        start = threading.Event()
+
+        def hammer():
+            start.wait()
+            for i in xrange(500):
+                buf.put(i + 1)
+
+        threads = [ threading.Thread(target=hammer) for x in xrange(20) ]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        buf.flush_now()
+        buf.put(0)
+        buf.flush_now()
+
+        stats = buf.stats()
+        self.assertEqual((stats['enqueued'], stats['dropped']), (1001, 9000))
+        self.assertEqual((stats['flushed'], stats['flushes'], stats['errors']), (1000, 1, 1))
+        self.assertEqual(len(flushed), 1000)
+        self.assertEqual(stats['queued'], 0)
+
+
+class ImportNginxTest(ScratchTestCase):
+    "Importing analytics from nginx logs."
+
+    AGENT = "Mozilla/5.0"
+    LINES = [
+        # recorded
+        '10.0.0.1 - - [10/Oct/2010:13:55:36 -0700] "GET /alpha/ HTTP/1.1" 200 512 "http://www.google.co.uk/search" "%s"\n' % AGENT,
+        # same IP in the same minute
+        '10.0.0.1 - - [10/Oct/2010:13:55:50 -0700] "GET /beta/ HTTP/1.1" 200 512 "-" "%s"\n' % AGENT,
+        # recorded
+        '10.0.0.2 - - [10/Oct/2010:13:55:40 -0700] "GET /alpha/ HTTP/1.1" 200 512 "-" "%s"\n' % AGENT,
+        # malformed
+        '10.0.0.3 - - [10/Oct/2010:13:56:00 -0700] "GET /alpha/\n',
+        # not pageviews
+        '10.0.0.3 - - [10/Oct/2010:13:56:10 -0700] "GET /tags/ HTTP/1.1" 200 512 "-" "%s"\n' % AGENT,
+        '10.0.0.3 - - [10/Oct/2010:13:56:20 -0700] "GET /alpha/ HTTP/1.1" 200 512 "-" "Googlebot/2.1"\n',
+        '10.0.0.3 - - [10/Oct/2010:13:56:30 -0700] "POST /alpha/ HTTP/1.1" 200 512 "-" "%s"\n' % AGENT,
+        # same IP in the next minute, recorded
+        '10.0.0.1 - - [10/Oct/2010:13:57:01 -0700] "GET /beta/ HTTP/1.1" 200 512 "-" "%s"\n' % AGENT,
+        ]
+
+    def setUp(self):
+        super(ImportNginxTest, self).setUp()
+        self.log_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+        super(ImportNginxTest, self).tearDown()
+
+    def test_timestamp(self):
+        "Timestamps match strptime, parsing each minute once."
+        import time
+        import sisyphus.management.commands.import_nginx_analytics as importer
+        expected = int(time.mktime(time.strptime("10/Oct/2010:13:55:36", "%d/%b/%Y:%H:%M:%S")))
+        self.assertEqual(importer.timestamp("10/Oct/2010:13:55:36"), expected)
+        self.assertEqual(importer.timestamp("10/Oct/2010:13:55:59"), expected + 23)
+        self.assertTrue("10/Oct/2010:13:55" in importer._minutes)
+
+    def test_parse_event(self):
+        "Tracked pageviews parse to events, anything else to None."
+        import sisyphus.management.commands.import_nginx_analytics as importer
+        event = importer.parse_event(self.LINES[0])
+        self.assertEqual(event[1:], ("alpha", "www.google.com", self.AGENT, "10.0.0.1", ()))
+        self.assertEqual(event[0], importer.timestamp("10/Oct/2010:13:55:36"))
+        self.assertEqual(importer.parse_event(self.LINES[1])[2], "DIRECT")
+        self.assertEqual([ importer.parse_event(x) for x in self.LINES[3:7] ], [None] * 4)
+
+    def test_import_lines(self):
+        "Views are deduplicated per IP per minute, and again across chunks."
+        import sisyphus.management.commands.import_nginx_analytics as importer
+        self.assertEqual(importer.import_lines(self.LINES), (8, 4, 3))
+        self.assertEqual(self.cli.zscore(sisyphus.analytics.ANALYTICS_PAGEVIEW, "alpha"), 2)
+        self.assertEqual(self.cli.zscore(sisyphus.analytics.ANALYTICS_PAGEVIEW, "beta"), 1)
+        self.assertEqual(self.cli.zscore(sisyphus.analytics.ANALYTICS_REFER_PAGE % "alpha", "www.google.com"), 1)
+        backoff = sisyphus.analytics.event_backoff_key(importer.parse_event(self.LINES[0]))
+        self.assertTrue(importer.IMPORT_BACKOFF_TTL - 60 < self.cli.ttl(backoff) <= importer.IMPORT_BACKOFF_TTL)
+        # the same minutes seen again by another chunk
+        self.assertEqual(importer.import_lines(self.LINES), (8, 4, 0))
+        self.assertEqual(self.cli.zscore(sisyphus.analytics.ANALYTICS_PAGEVIEW, "alpha"), 2)
+
+    def test_expand_logs(self):
+        "Rotated logs are found oldest first and read whether gzipped or not."
+        import gzip
+        import sisyphus.management.commands.import_nginx_analytics as importer
+        path = os.path.join(self.log_dir, "access.log")
+        for suffix in ("", ".1", ".bak"):
+            with open(path + suffix, 'w') as fout:
+                fout.writelines(self.LINES)
+        for suffix in (".2.gz", ".10.gz"):
+            fout = gzip.open(path + suffix, 'wb')
+            fout.writelines(self.LINES)
+            fout.close()
+        self.assertEqual(importer.expand_logs([path, path]),
+                         [path + ".10.gz", path + ".2.gz", path + ".1", path])
+        for name in importer.expand_logs([path]):
+            chunks = list(importer.read_chunks(name, 3))
+            self.assertEqual([ len(x) for x in chunks ], [3, 3, 2])
+            self.assertEqual(sum(chunks, []), self.LINES)
+
+
+class CompactAnalyticsTest(ScratchTestCase):
+    "Compact analytics storage."
+
+    # name: (value for these tests, default)
+    SETTINGS = { 'ANALYTICS_TOP_K': (2, 100),
+                 'ANALYTICS_SITE_TOP_K': (3, 1000),
+                 'ANALYTICS_RETENTION_DAYS': (90, 90),
+                 'ANALYTICS_RETENTION_WEEKS': (52, 52),
+                 }
+
+    def setUp(self):
+        super(CompactAnalyticsTest, self).setUp()
+        self.old_settings = dict((x, getattr(settings, x, y[1])) for x, y in self.SETTINGS.items())
+        for name, (value, default) in self.SETTINGS.items():
+            setattr(settings, name, value)
+
+    def tearDown(self):
+        for name, value in self.old_settings.items():
+            setattr(settings, name, value)
+        super(CompactAnalyticsTest, self).tearDown()
+
+    def track(self, now, refer, ip="10.0.0.1", slug="page"):
+        return sisyphus.analytics.compact_track((now, slug, refer, "Mozilla/5.0", ip, ()), self.cli, backoff_ttl=0)
+
+    def totals(self, slug):
+        "Views in each of slug's day, week and month hashes."
+        return sum(sum(int(x) for x in self.cli.hvals(key)) for key in sisyphus.analytics.compact_keys(slug))
+
+    def test_top_k(self):
+        "Past capacity, a new referrer replaces the least counted one and inherits its count."
+        now = 1300000000
+        for refer in ("one", "one", "one", "two", "three"):
+            self.track(now, refer)
+        self.assertEqual(self.cli.zrange(sisyphus.analytics.ANALYTICS_REFER_PAGE % "page", 0, -1, withscores=True),
+                         [("three", 2.0), ("one", 3.0)])
+        self.assertEqual(self.cli.zcard(sisyphus.analytics.ANALYTICS_REFER), 3)
+        self.track(now, "four")
+        self.assertEqual(self.cli.zrange(sisyphus.analytics.ANALYTICS_REFER, 0, -1, withscores=True),
+                         [("two", 1.0), ("four", 2.0), ("one", 3.0)])
+        # pageviews are counted exactly
+        self.assertEqual(self.cli.zscore(sisyphus.analytics.ANALYTICS_PAGEVIEW, "page"), 6)
+
+    def test_uniques(self):
+        "Unique visitors are counted per page and per day."
+        now = 1300000000
+        for ip in ("10.0.0.1", "10.0.0.2", "10.0.0.1", "10.0.0.3"):
+            self.track(now, "one", ip=ip)
+        self.assertEqual(self.cli.pfcount(sisyphus.analytics.ANALYTICS_UNIQUES_PAGE % "page"), 3)
+        day_key = sisyphus.analytics.ANALYTICS_UNIQUES_DAY % (now / sisyphus.analytics.DAY)
+        self.assertEqual(self.cli.pfcount(day_key), 3)
+        self.assertTrue(self.cli.ttl(day_key) > 0)
+
+    def test_fold(self):
+        "Folding old days into weeks and old weeks into months preserves totals and uniques."
+        day = sisyphus.analytics.DAY
+        now = 1300000000
+        for days_ago, views in ((400, 2), (100, 3), (1, 4)):
+            for x in xrange(views):
+                self.track(now - days_ago * day, "one", ip="10.0.0.%s" % x)
+        uniques = self.cli.pfcount(sisyphus.analytics.ANALYTICS_UNIQUES_PAGE % "page")
+        for slug in ("page", None):
+            self.assertEqual(self.totals(slug), 9)
+            self.assertEqual(sisyphus.analytics.fold_counters(slug, cli=self.cli, now=now), 3)
+            self.assertEqual(self.totals(slug), 9)
+            days_key, weeks_key, months_key = sisyphus.analytics.compact_keys(slug)
+            self.assertEqual(self.cli.hgetall(days_key), { str((now - day) / day): "4" })
+            self.assertEqual(self.cli.hgetall(weeks_key), { str((now - 100 * day) / day / 7): "3" })
+            old_week = (now - 400 * day) / day / 7
+            self.assertEqual(self.cli.hgetall(months_key), { str(sisyphus.analytics.month_bucket(old_week)): "2" })
+            self.assertEqual(sisyphus.analytics.fold_counters(slug, cli=self.cli, now=now), 0)
+        self.assertEqual(self.cli.pfcount(sisyphus.analytics.ANALYTICS_UNIQUES_PAGE % "page"), uniques)
+
+    def test_convert(self):
+        "Converting moves day buckets into the day hash and trims referrers to the top k."
+        self.cli.zadd(sisyphus.analytics.ANALYTICS_PAGEVIEW_PAGE_BUCKET % "page", 15000, 3, 15001, 4)
+        self.cli.zadd(sisyphus.analytics.ANALYTICS_REFER_PAGE % "page", "one", 1, "two", 5, "three", 3)
+        self.cli.zadd(sisyphus.analytics.ANALYTICS_PAGEVIEW_BUCKET, 15000, 30, 15001, 40)
+        for key in (sisyphus.analytics.ANALYTICS_REFER, sisyphus.analytics.ANALYTICS_USERAGENT):
+            self.cli.zadd(key, "one", 1, "two", 5, "three", 3, "four", 4)
+
+        sisyphus.analytics.convert_to_compact("page", cli=self.cli)
+        sisyphus.analytics.convert_to_compact(cli=self.cli)
+        self.assertEqual(self.cli.hgetall(sisyphus.analytics.ANALYTICS_DAYS_PAGE % "page"), { "15000": "3", "15001": "4" })
+        self.assertEqual(self.cli.hgetall(sisyphus.analytics.ANALYTICS_DAYS), { "15000": "30", "15001": "40" })
+        self.assertFalse(self.cli.exists(sisyphus.analytics.ANALYTICS_PAGEVIEW_PAGE_BUCKET % "page"))
+        self.assertFalse(self.cli.exists(sisyphus.analytics.ANALYTICS_PAGEVIEW_BUCKET))
+        self.assertEqual(self.cli.zrange(sisyphus.analytics.ANALYTICS_REFER_PAGE % "page", 0, -1), ["three", "two"])
+        for key in (sisyphus.analytics.ANALYTICS_REFER, sisyphus.analytics.ANALYTICS_USERAGENT):
+            self.assertEqual(self.cli.zrange(key, 0, -1), ["three", "four", "two"])
+
+
+class DashboardTest(ScratchTestCase):
+    "Dashboards precomputed by rollups."
+
+    def test_round_trip(self):
+        "A rolled up dashboard loads as the analytics it was computed from."
+        import datetime
+        now = 1300000000
+        for when, ip, refer in ((now, "10.0.0.1", "http://example.com/"),
+                                (now, "10.0.0.2", "http://example.org/"),
+                                (now - sisyphus.analytics.DAY, "10.0.0.1", "http://example.com/")):
+            request = RequestFactory().get("/page/", HTTP_USER_AGENT="Mozilla/5.0", HTTP_REFERER=refer, REMOTE_ADDR=ip)
+            self.assertTrue(sisyphus.analytics.track(request, { 'slug': "page", 'tags': [] }, self.cli, now=when))
+        self.assertEqual(sisyphus.analytics.rollup(cli=self.cli, now=now), 1)
+        generated = datetime.datetime.fromtimestamp(now)
+
+        site = sisyphus.analytics.load_dashboard(self.cli.get(sisyphus.analytics.ANALYTICS_DASHBOARD_SITE))
+        self.assertEqual(site, dict(sisyphus.analytics.site_analytics(cli=self.cli, now=now), generated=generated))
+        self.assertEqual(site['series']['total'], 3)
+        self.assertEqual(sum(y for x, y in site['recent_days']), 3)
+
+        page = sisyphus.analytics.load_dashboard(self.cli.get(sisyphus.analytics.ANALYTICS_DASHBOARD_PAGE % "page"))
+        expected = sisyphus.analytics.page_analytics({ 'slug': "page", 'pub_date': None }, cli=self.cli, now=now)
+        self.assertEqual(page, dict(expected, generated=generated))
+        self.assertEqual(page['views'], 3)
+
+
+class TrendingTest(ScratchTestCase):
+    "Decayed trending scores."
+
+    def ranking(self, key=None):
+        import sisyphus.models
+        return self.cli.zrevrange(key or sisyphus.models.PAGE_ZSET_BY_TREND, 0, -1)
+
+    def test_decay(self):
+        "Views count for half as much each half-life, so recent views outrank more older ones."
+        import sisyphus.models
+        import sisyphus.trending
+        half_life = sisyphus.trending.half_life()
+        now = sisyphus.trending.DEFAULT_EPOCH + 100 * half_life
+        for x in xrange(10):
+            sisyphus.trending.record_view({ 'slug': "old", 'tags': [] }, cli=self.cli, now=now - 2 * half_life)
+        for x in xrange(3):
+            sisyphus.trending.record_view({ 'slug': "recent", 'tags': [] }, cli=self.cli, now=now)
+        sisyphus.trending.record_view({ 'slug': "older", 'tags': [] }, cli=self.cli, now=now - 3 * half_life)
+        self.assertEqual(self.ranking(), ["recent", "old", "older"])
+        # 3 views now against 10 views worth 2.5 now
+        self.assertAlmostEqual(self.cli.zscore(sisyphus.models.PAGE_ZSET_BY_TREND, "recent") -
+                               self.cli.zscore(sisyphus.models.PAGE_ZSET_BY_TREND, "old"),
+                               math.log(3 / 2.5), places=6)
+
+    def test_renormalize(self):
+        "Moving to a new epoch shifts every score equally, leaving rankings and later views unchanged."
+        import sisyphus.models
+        import sisyphus.trending
+        half_life = sisyphus.trending.half_life()
+        now = sisyphus.trending.DEFAULT_EPOCH + 1000 * half_life
+        for i in xrange(20):
+            page = { 'slug': "page-%s" % i, 'tags': ["tag-%s" % (i % 3)] }
+            for x in xrange(i % 7 + 1):
+                sisyphus.trending.record_view(page, cli=self.cli, now=now - (i * 7919 % 50) * 3600)
+        self.cli.zadd(sisyphus.models.TAG_ZSET_BY_PAGES, "tag-0", 7, "tag-1", 7, "tag-2", 6)
+        keys = sisyphus.trending.trending_keys(self.cli)
+        before = dict((key, self.cli.zrevrange(key, 0, -1, withscores=True)) for key in keys)
+
+        self.assertEqual(sisyphus.trending.renormalize(cli=self.cli, now=now), 40)
+        shift = sisyphus.trending.rate() * (now - sisyphus.trending.DEFAULT_EPOCH)
+        for key in keys:
+            after = self.cli.zrevrange(key, 0, -1, withscores=True)
+            self.assertEqual([ x for x, y in after ], [ x for x, y in before[key] ])
+            for (x, old), (y, new) in zip(before[key], after):
+                self.assertAlmostEqual(old - shift, new, places=6)
+
+        # a view now weighs exactly one pageview against the new epoch
+        sisyphus.trending.record_view({ 'slug': "new", 'tags': [] }, cli=self.cli, now=now)
+        self.assertAlmostEqual(self.cli.zscore(sisyphus.models.PAGE_ZSET_BY_TREND, "new"), 0.0, places=6)
+
+    def test_coalesce(self):
+        "Coalesced updates score the same as applying each view in turn."
+        import sisyphus.trending
+        now = sisyphus.trending.DEFAULT_EPOCH + 86400
+        events = [ ("page", now + x, 0.0) for x in (0, 3600, 3600, 5 * 86400, 60) ]
+        for key in ("one_by_one", "coalesced"):
+            sisyphus.trending.apply_updates([(key, "page", now - 86400, sisyphus.trending.publish_weight())],
+                                            self.cli, mode='publish')
+        for member, timestamp, weight in events:
+            sisyphus.trending.apply_updates([("one_by_one", member, timestamp, weight)], self.cli)
+        coalesced = sisyphus.trending.coalesce([ ("coalesced",) + x for x in events ])
+        self.assertEqual(len(coalesced), 1)
+        sisyphus.trending.apply_updates(coalesced, self.cli)
+        self.assertAlmostEqual(self.cli.zscore("one_by_one", "page"), self.cli.zscore("coalesced", "page"), places=6)
+
+    def test_rebuild(self):
+        "Rebuilding from daily pageviews ranks pages by decayed publication and views."
+        import sisyphus.models
+        import sisyphus.analytics
+        import sisyphus.trending
+        day = sisyphus.analytics.DAY
+        now = (sisyphus.trending.DEFAULT_EPOCH / day + 1000) * day
+        pages = (("stale", now - 30 * day, { (now - 29 * day) / day: 500 }),
+                 ("fresh", now - 2 * day, { (now - day) / day: 20 }),
+                 ("unread", now - day, {}),
+                 )
+        for slug, pub_date, views in pages:
+            page = { 'slug': slug, 'title': slug, 'summary': "", 'html': "", 'tags': ["tag"],
+                     'pub_date': pub_date, 'edit_date': pub_date, 'published': True }
+            sisyphus.models.write_page(page, self.cli)
+            self.cli.zadd(sisyphus.models.PAGE_ZSET_BY_TIME, slug, pub_date)
+            for bucket, count in views.items():
+                self.cli.zadd(sisyphus.analytics.ANALYTICS_PAGEVIEW_PAGE_BUCKET % slug, bucket, count)
+        self.cli.zadd(sisyphus.models.TAG_ZSET_BY_PAGES, "tag", 3)
+
+        self.assertEqual(sisyphus.trending.rebuild(cli=self.cli, now=now), 3)
+        self.assertEqual(self.ranking(), ["fresh", "unread", "stale"])
+        self.assertEqual(self.ranking(sisyphus.models.TAG_PAGES_ZSET_BY_TREND % "tag"), ["fresh", "unread", "stale"])
+        r = sisyphus.trending.rate()
+        # published two days ago, and viewed 20 times at midday yesterday
+        expected = sisyphus.trending.logsumexp([ r * -2 * day + sisyphus.trending.publish_weight(),
+                                                 r * -day / 2 + math.log(20) ])
+        self.assertAlmostEqual(self.cli.zscore(sisyphus.models.PAGE_ZSET_BY_TREND, "fresh"), expected, places=6)
+        self.assertEqual(int(self.cli.hget(sisyphus.trending.TRENDING_EPOCHS, sisyphus.models.PAGE_ZSET_BY_TREND)), now)
+
+
+class RelatedTest(ScratchTestCase):
+    "Rebuilding related pages incrementally."
+
+    def setUp(self):
+        super(RelatedTest, self).setUp()
+        self.index_dir = tempfile.mkdtemp()
+        self.old_settings = (settings.WHOOSH_INDEXDIR,
+                             getattr(settings, 'RELATED_TOP_K', 20),
+                             getattr(settings, 'RELATED_TREND_WEIGHT', 0.2))
+        settings.WHOOSH_INDEXDIR = self.index_dir
+        settings.RELATED_TOP_K = 2
+        settings.RELATED_TREND_WEIGHT = 0.0
+        self.publish(("a", "x"), ("b", "x"), ("c", "x"), ("d", "y"), ("e", "y"))
+        import sisyphus.related
+        sisyphus.related.rebuild(cli=self.cli, full=True)
+        # lists rewritten by a rebuild lose this
+        self.cli.zadd(sisyphus.related.RELATED % "d", "untouched", 0)
+
+    def tearDown(self):
+        settings.WHOOSH_INDEXDIR, settings.RELATED_TOP_K, settings.RELATED_TREND_WEIGHT = self.old_settings
+        shutil.rmtree(self.index_dir)
+        super(RelatedTest, self).tearDown()
+
+    def publish(self, *slugs_and_tags):
+        import sisyphus.models
+        sisyphus.models.add_pages([ { 'slug': slug, 'title': slug, 'summary': "", 'html': "", 'tags': [tag],
+                                      'pub_date': 1300000000, 'published': True } for slug, tag in slugs_and_tags ],
+                                  cli=self.cli)
+
+    def related(self):
+        import sisyphus.related
+        return dict((x, self.cli.zrange(sisyphus.related.RELATED % x, 0, -1)) for x in "abcdefg")
+
+    def test_unpublished(self):
+        "An unpublished page's list is deleted, and its neighbours' lists no longer include it."
+        import sisyphus.models
+        import sisyphus.related
+        sisyphus.models.unpublish_page("c", cli=self.cli)
+        self.assertEqual(sisyphus.related.rebuild(cli=self.cli), 2)
+        related = self.related()
+        self.assertEqual(related['a'], ["b"])
+        self.assertEqual(related['b'], ["a"])
+        self.assertEqual(related['c'], [])
+        self.assertEqual(related['d'], ["untouched", "e"])
+        self.assertEqual(self.cli.scard(sisyphus.related.RELATED_DIRTY), 0)
+
+    def test_published(self):
+        "A new page's list is built, and merged into its neighbours' lists as a full rebuild would."
+        import sisyphus.related
+        self.publish(("g", "x"))
+        self.assertEqual(sisyphus.related.rebuild(cli=self.cli), 4)
+        related = self.related()
+        self.assertEqual(related['g'], ["b", "c"])
+        self.assertEqual(related['d'], ["untouched", "e"])
+        self.cli.zrem(sisyphus.related.RELATED % "d", "untouched")
+        sisyphus.related.rebuild(cli=self.cli, full=True)
+        self.assertEqual(self.related(), dict(related, d=["e"]))
+
+
+class ReindexTest(ScratchTestCase):
+    "Rebuilding the search index."
+
+    def setUp(self):
+        super(ReindexTest, self).setUp()
+        self.index_dir = tempfile.mkdtemp()
+        self.old_index_dir = settings.WHOOSH_INDEXDIR
+        settings.WHOOSH_INDEXDIR = self.index_dir
+
+    def tearDown(self):
+        settings.WHOOSH_INDEXDIR = self.old_index_dir
+        shutil.rmtree(self.index_dir)
+        super(ReindexTest, self).tearDown()
+
+    def found(self, query):
+        import sisyphus.models
+        summaries, total = sisyphus.models.search(query, cli=self.cli)
+        return sorted(x['slug'] for x in summaries)
+
+    def test_unpublished(self):
+        "A page unpublished without updating the index is dropped by a reindex."
+        import sisyphus.models
+        sisyphus.models.add_pages([ { 'slug': slug, 'title': slug, 'summary': "", 'html': "<p>needle</p>",
+                                      'tags': [], 'pub_date': 1300000000, 'published': True } for slug in ("kept", "gone") ],
+                                  cli=self.cli)
+        self.assertEqual(self.found("needle"), ["gone", "kept"])
+        # e.g. Redis restored from a snapshot taken before it was unpublished
+        self.cli.zrem(sisyphus.models.PAGE_ZSET_BY_TIME, "gone")
+        self.assertEqual(self.found("needle"), ["gone", "kept"])
+        self.assertEqual(sisyphus.models.reindex_pages(chunk_size=1, cli=self.cli), 1)
+        self.assertEqual(self.found("needle"), ["kept"])
+
+
+class DerivedKeyTest(ScratchTestCase):
+    "Single-flight recomputes of derived keys."
+
+    def setUp(self):
+        super(DerivedKeyTest, self).setUp()
+        self.builds = []
+
+    def build(self, key, cli):
+        self.builds.append(key)
+        cli.zadd(key, "page", 1)
+
+    def build_nothing(self, key, cli):
+        self.builds.append(key)
+
+    def expire(self, key):
+        "Leave key built, but due for a recompute."
+        import sisyphus.models
+        self.cli.zadd(key, "stale", 1)
+        self.cli.set(sisyphus.models.DERIVED_META % key, "%f:%f" % (1300000000, 0.1))
+
+    def test_held_lock(self):
+        "Others serve the stale value while one worker holds the lock."
+        import sisyphus.models
+        self.expire("derived")
+        self.cli.set(sisyphus.models.DERIVED_LOCK % "derived", "another worker")
+        before = sisyphus.models.derived_stats()
+        self.assertEqual(sisyphus.models.derived_key("derived", self.build, 60, cli=self.cli), "derived")
+        self.assertEqual(self.builds, [])
+        self.assertEqual(self.cli.zrange("derived", 0, -1), ["stale"])
+        self.assertEqual(sisyphus.models.derived_stats()['stale_served'], before['stale_served'] + 1)
+
+    def test_rebuilt_once(self):
+        "An expired key is rebuilt once, then served until it expires again."
+        import sisyphus.models
+        self.expire("derived")
+        for x in xrange(3):
+            sisyphus.models.derived_key("derived", self.build, 60, cli=self.cli)
+        self.assertEqual(self.builds, ["derived"])
+        self.assertEqual(self.cli.zrange("derived", 0, -1), ["page", "stale"])
+        self.assertFalse(self.cli.exists(sisyphus.models.DERIVED_LOCK % "derived"))
+
+    def test_empty_result(self):
+        "Builds which leave no key aren't repeated by every request."
+        import sisyphus.models
+        for x in xrange(3):
+            sisyphus.models.derived_key("empty", self.build_nothing, 60, cli=self.cli)
+        self.assertEqual(self.builds, ["empty"])
+        self.assertFalse(self.cli.exists("empty"))
+
+    def test_failed_holder(self):
+        "Waiters retry the build when the lock's holder releases it without a result."
+        import sisyphus.models
+        lock = sisyphus.models.DERIVED_LOCK % "derived"
+        self.cli.set(lock, "another worker")
+        before = sisyphus.models.derived_stats()
+        timer = threading.Timer(0.05, self.cli.delete, [lock])
+        timer.start()
+        try:
+            sisyphus.models.derived_key("derived", self.build, 60, cli=self.cli)
+        finally:
+            timer.cancel()
+        self.assertEqual(self.builds, ["derived"])
+        self.assertEqual(sisyphus.models.derived_stats()['lock_retries'], before['lock_retries'] + 1)
+
+    def test_recompute_meta(self):
+        "Recomputes record the key's expiry and how long they took."
+        import time
+        import sisyphus.models
+
+        def slow_build(key, cli):
+            time.sleep(0.05)
+            self.build(key, cli)
+
+        start = time.time()
+        sisyphus.models.recompute_derived("derived", slow_build, 60, self.cli)
+        expiry, delta = [ float(x) for x in self.cli.get(sisyphus.models.DERIVED_META % "derived").split(":") ]
+        self.assertTrue(0.05 <= delta < time.time() - start + 0.001)
+        self.assertTrue(start + delta + 60 <= expiry <= time.time() + 60)
+        stale_ttl = 60 + getattr(settings, 'DERIVED_KEY_STALE_TTL', 5 * 60)
+        self.assertTrue(stale_ttl - 2 <= self.cli.ttl("derived") <= stale_ttl)
+        self.assertTrue(stale_ttl - 2 <= self.cli.ttl(sisyphus.models.DERIVED_META % "derived") <= stale_ttl)
+
+
+def codec_formats():
+    "Every codec and compression installed here."
+    import sisyphus.codec
+    codecs = [ x[0] for x in sisyphus.codec.CODECS.values() if sisyphus.codec.AVAILABLE.get(x[0], True) ]
+    compressions = [ x[0] for x in sisyphus.codec.COMPRESSIONS.values() if sisyphus.codec.AVAILABLE.get(x[0], True) ]
+    return [ (x, y) for x in codecs for y in compressions ]
+
+class CodecTest(TestCase):
+    "Page encodings."
+
+    PAGE = { 'slug': "codec", 'title': u"Caf\xe9", 'summary': u"\u2603 summary", 'html': u"<p>caf\xe9 \u2603</p>" * 50,
+             'tags': ["python", "redis"], 'pub_date': 1300000000, 'edit_date': 1300000100, 'published': True }
+
+    def test_round_trip(self):
+        "Pages decode to what was encoded, whatever the format."
+        import sisyphus.codec
+        for codec, compression in codec_formats():
+            meta, body = sisyphus.codec.encode_page(self.PAGE, codec, compression)
+            self.assertEqual(sisyphus.codec.decode_page(meta, body), self.PAGE, "%s/%s" % (codec, compression))
+            self.assertEqual(sisyphus.codec.loads(sisyphus.codec.dumps({ 'tags': [] }, codec)), { 'tags': [] })
+            self.assertEqual(sisyphus.codec.decompress(sisyphus.codec.compress(u"", compression)), u"")
+
+    def test_legacy(self):
+        "Pages stored as plain JSON, body included, still decode."
+        import sisyphus.codec
+        self.assertEqual(sisyphus.codec.decode_page(json.dumps(self.PAGE), None), self.PAGE)
+
+    def test_unknown_format(self):
+        import sisyphus.codec
+        self.assertRaises(ValueError, sisyphus.codec.dumps, {}, 'pickle')
+        self.assertRaises(ValueError, sisyphus.codec.compress, u"", 'bz2')
+
+
+class MigratePagesTest(ScratchTestCase):
+    "Rewriting stored pages with another codec."
+
+    def test_migrate_legacy(self):
+        "A plain JSON page with no body key is read, then rewritten with each format."
+        import sisyphus.models
+        import sisyphus.codec
+        page = dict(CodecTest.PAGE)
+        self.cli.set(sisyphus.models.PAGE_STRING % page['slug'], json.dumps(page))
+        self.assertEqual(sisyphus.models.hydrate_pages([page['slug']], cli=self.cli, with_tag_counts=False), [page])
+        self.assertEqual(sisyphus.models.get_page_summary(page['slug'], cli=self.cli)['title'], page['title'])
+
+        for codec, compression in codec_formats():
+            self.assertEqual(sisyphus.models.reencode_pages(codec, compression, cli=self.cli), 1)
+            meta = self.cli.get(sisyphus.models.PAGE_STRING % page['slug'])
+            body = self.cli.get(sisyphus.models.PAGE_BODY % page['slug'])
+            self.assertEqual(meta[0], sisyphus.codec.lookup(sisyphus.codec.CODECS, codec)[0])
+            self.assertEqual(body[0], sisyphus.codec.lookup(sisyphus.codec.COMPRESSIONS, compression)[0])
+            self.assertTrue('html' not in sisyphus.codec.loads(meta))
+            self.assertEqual(sisyphus.models.hydrate_pages([page['slug']], cli=self.cli, with_tag_counts=False), [page])
+            summary = sisyphus.codec.loads(self.cli.get(sisyphus.models.PAGE_SUMMARY % page['slug']))
+            self.assertEqual(summary, sisyphus.models.page_summary(page))
+
+
+class SyncTest(ScratchTestCase):
+    "Syncing only the content files which changed."
+
+    def setUp(self):
+        super(SyncTest, self).setUp()
+        self.content_dir = tempfile.mkdtemp()
+        self.index_dir = tempfile.mkdtemp()
+        self.old_index_dir = settings.WHOOSH_INDEXDIR
+        settings.WHOOSH_INDEXDIR = self.index_dir
+        for subdir in ("edit", "publish"):
+            os.makedirs(os.path.join(self.content_dir, subdir))
+
+    def tearDown(self):
+        settings.WHOOSH_INDEXDIR = self.old_index_dir
+        shutil.rmtree(self.content_dir)
+        shutil.rmtree(self.index_dir)
+        super(SyncTest, self).tearDown()
+
+    def write(self, relpath, body):
+        slug = os.path.basename(relpath).split(".")[0]
+        with open(os.path.join(self.content_dir, relpath), 'w') as fout:
+            fout.write('"title": "%s",\n"slug": "%s",\n"summary": "",\n"tags": ["synced"],\n\n%s\n' % (slug, slug, body))
+        return os.path.join(self.content_dir, relpath)
+
+    def sync(self):
+        import sisyphus.management.commands.sync_sisyphus
+        return sisyphus.management.commands.sync_sisyphus.Command().sync(self.content_dir, workers=1, cli=self.cli)
+
+    def test_unchanged(self):
+        "Files unchanged since the last sync aren't loaded again."
+        import sisyphus.models
+        self.write("publish/one.html", "<p>One</p>")
+        self.assertEqual(self.sync()['added'], ["publish/one.html"])
+        page = sisyphus.models.get_page("one", cli=self.cli)
+        page['title'] = "Edited in Redis"
+        sisyphus.models.write_page(page, self.cli)
+
+        summary = self.sync()
+        self.assertEqual(summary['unchanged'], ["publish/one.html"])
+        self.assertEqual(summary['added'] + summary['changed'] + summary['removed'], [])
+        self.assertEqual(sisyphus.models.get_page("one", cli=self.cli)['title'], "Edited in Redis")
+
+    def test_sitemaps(self):
+        "Sitemaps are only rebuilt when a file changed, or on a full sync."
+        import sisyphus.sitemap
+        import sisyphus.management.commands.sync_sisyphus
+        self.write("publish/one.html", "<p>One</p>")
+        self.assertEqual(self.sync()['sitemaps'], (2, 1))
+        self.cli.delete(sisyphus.sitemap.SITEMAP_FILES, sisyphus.sitemap.SITEMAP % sisyphus.sitemap.SITEMAP_INDEX)
+
+        self.assertEqual(self.sync()['sitemaps'], None)
+        self.assertFalse(self.cli.exists(sisyphus.sitemap.SITEMAP_FILES))
+        self.assertFalse(self.cli.exists(sisyphus.sitemap.SITEMAP % sisyphus.sitemap.SITEMAP_INDEX))
+
+        command = sisyphus.management.commands.sync_sisyphus.Command()
+        self.assertEqual(command.sync(self.content_dir, full=True, workers=1, cli=self.cli)['sitemaps'], (2, 1))
+        self.assertTrue(self.cli.exists(sisyphus.sitemap.SITEMAP % sisyphus.sitemap.SITEMAP_INDEX))
+
+    def test_touched(self):
+        "Files whose modification time changed but whose content didn't aren't loaded again."
+        import sisyphus.models
+        import sisyphus.management.commands.sync_sisyphus
+        path = self.write("publish/one.html", "<p>One</p>")
+        self.sync()
+        mtime = int(os.stat(path).st_mtime) + 100
+        os.utime(path, (mtime, mtime))
+
+        summary = self.sync()
+        self.assertEqual(summary['unchanged'], ["publish/one.html"])
+        self.assertEqual(summary['changed'], [])
+        entry = json.loads(self.cli.hget(sisyphus.management.commands.sync_sisyphus.SYNC_MANIFEST, "publish/one.html"))
+        self.assertEqual(entry['mtime'], mtime)
+        self.assertEqual(entry['slug'], "one")
+
+        # the same size, but different content
+        self.write("publish/one.html", "<p>Two</p>")
+        os.utime(path, (mtime + 100, mtime + 100))
+        self.assertEqual(self.sync()['changed'], ["publish/one.html"])
+        self.assertEqual(sisyphus.models.get_page("one", cli=self.cli)['html'], u"<p>Two</p>")
+
+    def test_removed(self):
+        "Pages whose files were removed from publish/ are unpublished, and kept as drafts."
+        import sisyphus.models
+        self.write("publish/one.html", "<p>One</p>")
+        self.write("publish/two.html", "<p>Two</p>")
+        self.sync()
+        self.assertEqual(sisyphus.models.num_pages(cli=self.cli), 2)
+        os.remove(os.path.join(self.content_dir, "publish/two.html"))
+
+        summary = self.sync()
+        self.assertEqual(summary['removed'], ["publish/two.html"])
+        self.assertEqual(summary['unchanged'], ["publish/one.html"])
+        self.assertEqual(self.cli.zrange(sisyphus.models.PAGE_ZSET_BY_TIME, 0, -1), ["one"])
+        self.assertEqual(self.cli.zscore(sisyphus.models.TAG_PAGES_ZSET_BY_TIME % "synced", "two"), None)
+        self.assertFalse(sisyphus.models.get_page("two", cli=self.cli)['published'])
+        self.assertTrue(sisyphus.models.get_page("one", cli=self.cli)['published'])
+
+
+class RenderCacheTest(ScratchTestCase):
+    "The bounded cache of rendered Markdown."
+
+    def setUp(self):
+        super(RenderCacheTest, self).setUp()
+        self.old_max_bytes = getattr(settings, 'RENDER_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        settings.RENDER_CACHE_MAX_BYTES = 1024 * 1024
+
+    def tearDown(self):
+        settings.RENDER_CACHE_MAX_BYTES = self.old_max_bytes
+        super(RenderCacheTest, self).tearDown()
+
+    def cached(self):
+        import sisyphus.markup
+        sizes = dict((x, int(y)) for x, y in self.cli.hgetall(sisyphus.markup.RENDER_CACHE_SIZES).items())
+        self.assertEqual(int(self.cli.get(sisyphus.markup.RENDER_CACHE_BYTES) or 0), sum(sizes.values()))
+        self.assertEqual(sorted(self.cli.zrange(sisyphus.markup.RENDER_CACHE_LRU, 0, -1)), sorted(sizes))
+        for digest in sizes:
+            self.assertTrue(self.cli.exists(sisyphus.markup.RENDER_CACHE % digest))
+        return sizes
+
+    def test_evict(self):
+        "Eviction drops only as many least recently used renders as it must."
+        import sisyphus.markup
+        texts = ["one", "two", "three"]
+        one, two, three = [ sisyphus.markup.source_digest(x) for x in texts ]
+        sisyphus.markup.render_many(texts, workers=1, cli=self.cli)
+        self.cli.zadd(sisyphus.markup.RENDER_CACHE_LRU, one, 1, two, 2, three, 3)
+        sizes = self.cached()
+        self.assertEqual(sorted(sizes), sorted([one, two, three]))
+
+        sisyphus.markup.evict(sum(sizes.values()) - 1, self.cli)
+        self.assertEqual(sorted(self.cached()), sorted([two, three]))
+        self.assertFalse(self.cli.exists(sisyphus.markup.RENDER_CACHE % one))
+
+        # reading a render makes it the most recently used
+        sisyphus.markup.render_cached("two", cli=self.cli)
+        sisyphus.markup.evict(sizes[two], self.cli)
+        self.assertEqual(self.cached().keys(), [two])
+
+        sisyphus.markup.evict(0, self.cli)
+        self.assertEqual(self.cached(), {})
+
+    def test_stored_twice(self):
+        "A source rendered twice is counted once."
+        import sisyphus.models
+        import sisyphus.markup
+        html = sisyphus.markup.render_many(["same", "same"], workers=1, cli=self.cli)[0]
+        digest = sisyphus.markup.source_digest("same")
+        self.assertEqual(self.cached(), { digest: len(html.encode('utf-8')) })
+        # as stored by a concurrent render of the same source
+        sisyphus.models.lua_script(sisyphus.markup.STORE_SCRIPT)(
+            keys=[sisyphus.markup.RENDER_CACHE % digest, sisyphus.markup.RENDER_CACHE_SIZES, sisyphus.markup.RENDER_CACHE_BYTES],
+            args=[digest, html.encode('utf-8')], client=self.cli)
+        self.assertEqual(sisyphus.markup.render_cached("same", cli=self.cli), html)
+        self.assertEqual(self.cached(), { digest: len(html.encode('utf-8')) })
+
+
+class FeedsTest(ScratchTestCase):
+    "Regenerating only the feeds a written page appears in."
+
+    def setUp(self):
+        super(FeedsTest, self).setUp()
+        self.index_dir = tempfile.mkdtemp()
+        self.old_settings = (settings.WHOOSH_INDEXDIR, getattr(settings, 'FEED_LENGTH', 25))
+        settings.WHOOSH_INDEXDIR = self.index_dir
+        settings.FEED_LENGTH = 2
+        self.publish(("old", "x", 1300000000), ("older", "x", 1299000000), ("other", "y", 1300000100))
+        self.publish(("new", "x", 1300000200))
+
+    def tearDown(self):
+        settings.WHOOSH_INDEXDIR, settings.FEED_LENGTH = self.old_settings
+        shutil.rmtree(self.index_dir)
+        super(FeedsTest, self).tearDown()
+
+    def publish(self, *pages):
+        import sisyphus.models
+        sisyphus.models.add_pages([ { 'slug': slug, 'title': slug, 'summary': "", 'html': "<p>%s</p>" % slug,
+                                      'tags': [tag], 'pub_date': pub_date, 'published': True }
+                                    for slug, tag, pub_date in pages ], cli=self.cli)
+
+    def stored(self):
+        "Names of the feeds stored, as both RSS and Atom."
+        import sisyphus.feeds
+        prefix = sisyphus.feeds.FEED % ('rss', "")
+        names = set(x[len(prefix):] for x in self.cli.keys(sisyphus.feeds.FEED % ('rss', "*")))
+        self.assertEqual(names, set(x[len(sisyphus.feeds.FEED % ('atom', "")):]
+                                    for x in self.cli.keys(sisyphus.feeds.FEED % ('atom', "*"))))
+        return names
+
+    def clear(self):
+        import sisyphus.feeds
+        self.cli.delete(*self.cli.keys(sisyphus.feeds.FEED % ("*", "*")))
+
+    def test_changed_page(self):
+        "Changing a page regenerates its tags' feeds and the site feed, and no others."
+        import sisyphus.feeds
+        self.assertEqual(self.stored(), set(["site", "tag.x", "tag.y"]))
+        self.clear()
+        self.publish(("new", "x", 1300000200))
+        self.assertEqual(self.stored(), set(["site", "tag.x"]))
+        self.assertTrue("/new/" in zlib.decompress(self.cli.hget(sisyphus.feeds.FEED % ('rss', "tag.x"), 'gzip'),
+                                                       16 + zlib.MAX_WBITS))
+
+    def test_old_page(self):
+        "Changing a page too old to appear in a full feed leaves that feed alone."
+        self.clear()
+        self.publish(("older", "x", 1299000000))
+        self.assertEqual(self.stored(), set())
+        self.publish(("older", "y", 1299000000))
+        self.assertEqual(self.stored(), set(["tag.y"]))
+
+    def test_order(self):
+        "Tag feeds list the pages most recently added to the tag, newest first."
+        import sisyphus.feeds
+        feed = zlib.decompress(sisyphus.feeds.get_feed('rss', "tag.x", cli=self.cli)['gzip'], 16 + zlib.MAX_WBITS)
+        self.assertTrue(0 <= feed.index("/new/") < feed.index("/old/"))
+        self.assertTrue("/older/" not in feed)
+
+
+class SitemapTest(ScratchTestCase):
+    "Splitting sitemaps, and the index listing them."
+
+    def setUp(self):
+        super(SitemapTest, self).setUp()
+        import sisyphus.benchmarks
+        sisyphus.benchmarks.seed_corpus(self.cli, 5, num_tags=2, html_words=5)
+        self.sitemap_dir = tempfile.mkdtemp()
+        self.old_settings = (getattr(settings, 'SITEMAP_MAX_URLS', 50000), getattr(settings, 'SITEMAP_DIR', None))
+        settings.SITEMAP_MAX_URLS = 2
+        settings.SITEMAP_DIR = self.sitemap_dir
+
+    def tearDown(self):
+        settings.SITEMAP_MAX_URLS, settings.SITEMAP_DIR = self.old_settings
+        shutil.rmtree(self.sitemap_dir)
+        super(SitemapTest, self).tearDown()
+
+    def read(self, name):
+        import sisyphus.sitemap
+        return zlib.decompress(sisyphus.sitemap.get_sitemap(name, cli=self.cli)['gzip'], 16 + zlib.MAX_WBITS)
+
+    def test_split(self):
+        "Five pages and two tags make four sitemaps, each listed by the index."
+        import sisyphus.sitemap
+        self.assertEqual(sisyphus.sitemap.build(cli=self.cli), (7, 4))
+        self.assertEqual(self.cli.smembers(sisyphus.sitemap.SITEMAP_FILES), set(["index", "1", "2", "3", "4"]))
+        index = self.read("index")
+        for number in xrange(1, 5):
+            self.assertTrue("/sitemap-%s.xml</loc>" % number in index)
+            self.assertTrue(self.read(str(number)).count("<url>") <= 2)
+        self.assertTrue("/sitemap-5.xml" not in index)
+        self.assertEqual(sorted(os.listdir(self.sitemap_dir)),
+                         ["sitemap-1.xml.gz", "sitemap-2.xml.gz", "sitemap-3.xml.gz", "sitemap-4.xml.gz", "sitemap.xml.gz"])
+
+    def test_shrink(self):
+        "Sitemaps left over from a larger corpus are removed."
+        import sisyphus.models
+        import sisyphus.sitemap
+        sisyphus.sitemap.build(cli=self.cli)
+        self.cli.zremrangebyrank(sisyphus.models.PAGE_ZSET_BY_TIME, 0, 2)
+        self.cli.delete(sisyphus.models.TAG_ZSET_BY_PAGES)
+
+        self.assertEqual(sisyphus.sitemap.build(cli=self.cli), (2, 1))
+        self.assertEqual(self.cli.smembers(sisyphus.sitemap.SITEMAP_FILES), set(["index", "1"]))
+        for number in xrange(2, 5):
+            self.assertFalse(self.cli.exists(sisyphus.sitemap.SITEMAP % number))
+            self.assertEqual(sisyphus.sitemap.get_sitemap(str(number), cli=self.cli), None)
+        self.assertTrue("/sitemap-2.xml" not in self.read("index"))
+        self.assertEqual(sorted(os.listdir(self.sitemap_dir)), ["sitemap-1.xml.gz", "sitemap.xml.gz"])
+
+
+class ResponseCacheTest(ScratchTestCase):
+    "Caching whole responses, and answering conditional GETs."
+
+    def setUp(self):
+        super(ResponseCacheTest, self).setUp()
+        import sisyphus.benchmarks
+        import sisyphus.cache
+        sisyphus.benchmarks.seed_corpus(self.cli, 3, num_tags=2, html_words=10)
+        sisyphus.cache.response_cache().clear()
+
+    def edit(self, slug, html):
+        "Change a page's body without advancing the content version."
+        import sisyphus.models
+        page = sisyphus.models.get_page(slug, cli=self.cli)
+        page['tags'] = [ x[1] for x in page['tags'] ]
+        page['html'] = html
+        sisyphus.models.write_page(page, self.cli)
+
+    def test_content_version(self):
+        "Responses are served from cache until the content version advances."
+        import sisyphus.models
+        first = self.client.get("/page-0/")
+        self.assertEqual(first.status_code, 200)
+        self.edit("page-0", "<p>Edited</p>")
+        self.assertEqual(self.client.get("/page-0/").content, first.content)
+        sisyphus.models.bump_version(sisyphus.models.CONTENT_VERSION, cli=self.cli)
+        self.assertTrue("<p>Edited</p>" in self.client.get("/page-0/").content)
+
+    def test_query_parameters(self):
+        "Pages of a storylist are cached separately."
+        self.assertNotEqual(self.client.get("/list/recent/", { 'offset': 0, 'limit': 1 }).content,
+                            self.client.get("/list/recent/", { 'offset': 1, 'limit': 1 }).content)
+
+    def test_encoding(self):
+        "Clients get the best encoding they accept, or none."
+        import sisyphus.cache
+        plain = self.client.get("/page-0/")
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertEqual(plain['Vary'], 'Accept-Encoding')
+        gzipped = self.client.get("/page-0/", HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(gzipped.content, 16 + zlib.MAX_WBITS), plain.content)
+        self.assertEqual(gzipped['Content-Length'], str(len(gzipped.content)))
+        self.assertEqual(gzipped['ETag'], plain['ETag'])
+
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip;q=0.5, br;q=1.0")
+        self.assertEqual(sisyphus.cache.choose_encoding(request, { 'gzip': "", 'br': "" }), 'br')
+        self.assertEqual(sisyphus.cache.choose_encoding(request, { 'gzip': "" }), 'gzip')
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="identity")
+        self.assertEqual(sisyphus.cache.choose_encoding(request, { 'gzip': "" }), None)
+
+    def test_etag(self):
+        "A matching If-None-Match is answered with a 304."
+        etag = self.client.get("/page-0/")['ETag']
+        not_modified = self.client.get("/page-0/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, "")
+        self.assertEqual(not_modified['ETag'], etag)
+        self.assertEqual(self.client.get("/page-0/", HTTP_IF_NONE_MATCH='"other", %s' % etag).status_code, 304)
+        self.assertEqual(self.client.get("/page-0/", HTTP_IF_NONE_MATCH="*").status_code, 304)
+        self.assertEqual(self.client.get("/page-0/", HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_if_modified_since(self):
+        "If-Modified-Since is answered with a 304 unless the page changed since, and If-None-Match takes precedence."
+        last_modified = self.client.get("/page-0/")['Last-Modified']
+        self.assertEqual(self.client.get("/page-0/", HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        earlier = http_date(parse_http_date(last_modified) - 3600)
+        self.assertEqual(self.client.get("/page-0/", HTTP_IF_MODIFIED_SINCE=earlier).status_code, 200)
+        self.assertEqual(self.client.get("/page-0/", HTTP_IF_MODIFIED_SINCE=last_modified,
+                                         HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+
+class ExportTest(ScratchTestCase):
+    "Incremental static exports, on the synthetic corpus the export benchmark uses."
+
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        import sisyphus.benchmarks
+        import sisyphus.sitemap
+        sisyphus.benchmarks.seed_corpus(self.cli, 30, num_tags=5, html_words=5)
+        sisyphus.sitemap.build(cli=self.cli)
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super(ExportTest, self).tearDown()
+
+    def files(self):
+        "Exported files, relative to the export root, by modification time."
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files[os.path.relpath(path, self.root)] = os.stat(path).st_mtime
+        return files
+
+    def test_incremental(self):
+        "Only the dirty page and its neighbours, their tags' lists, the storylists, feeds and sitemaps are rewritten."
+        import sisyphus.models
+        import sisyphus.export
+        report = sisyphus.export.export(self.root, full=True, workers=1, cli=self.cli)
+        self.assertEqual(report['failed'], [])
+        for relpath in self.files():
+            os.utime(os.path.join(self.root, relpath), (1, 1))
+
+        sisyphus.export.mark_dirty(["page-10"], self.cli)
+        report = sisyphus.export.export(self.root, workers=1, cli=self.cli)
+        self.assertEqual(report['failed'], [])
+        rewritten = set(x for x, mtime in self.files().items() if mtime != 1)
+
+        tags = sisyphus.models.get_page_summary("page-10", cli=self.cli)['tags']
+        urls = [ ("/page-%s/" % x, 0) for x in xrange(8, 13) ] + [("/tags/", 0)]
+        for path in ("/", "/list/recent/", "/list/trending/"):
+            urls.extend(sisyphus.export.list_urls(path, 30))
+        for count, tag in tags:
+            total = self.cli.zcard(sisyphus.models.TAG_PAGES_ZSET_BY_TREND % tag)
+            urls.extend(sisyphus.export.list_urls("/tags/%s/" % tag, total))
+        expected = [ sisyphus.export.output_path(path, offset) for path, offset in urls ]
+        for path in ["/feeds/"] + [ "/feeds/tag/%s/" % tag for count, tag in tags ]:
+            expected.extend((path[1:] + "index.xml", path[1:] + "atom/index.xml"))
+        expected.extend(("sitemap.xml", "sitemap-1.xml"))
+        self.assertEqual(rewritten, set(expected) | set(x + ".gz" for x in expected))
+        self.assertEqual(self.cli.scard(sisyphus.export.EXPORT_DIRTY), 0)
+
+
+class ViewsTest(TestCase):
+    "Every view renders against a small synthetic corpus in BENCHMARK_REDIS_DB."
+
+    def test_views_respond(self):
+        import sisyphus.benchmarks
+        import sisyphus.models
+        pool = sisyphus.models._pool
+        try:
+            rows = sisyphus.benchmarks.bench_views(num_pages=30, num_tags=5, history_days=2, num_requests=2)
+        except ValueError, e:
+            self.skipTest(str(e))
+        except redis.exceptions.ConnectionError:
+            self.skipTest("Redis is unreachable")
+        for row in rows:
+            self.assertEqual(row['errors'], 0, "%s returned errors" % row['view'])
+        self.assertTrue(sisyphus.models._pool is pool, "the scratch database was left in use")
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
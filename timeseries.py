@@ -0,0 +1,133 @@
+"""
+Traffic series for the site, each tag and each page, bucketed for the
+last 60 minutes, the last 24 hours, the last 7 days, the last 4 weeks
+and lifespan.
+
+Each resolution of a series is a fixed-size ring buffer stored in a
+hash, so a series never grows: slot ``bucket % size`` holds a count in
+field ``c<slot>`` and the bucket it counts in ``b<slot>``. A slot still
+holding an older bucket is reset when it's next written, and views
+older than the bucket a slot holds fall outside the window and are
+dropped. Lifespan views are a plain counter.
+
+Increments are made by the Lua functions in ``LUA``, which tracking
+scripts include to update series in the same call as other counters.
+"""
+import time
+import datetime
+import sisyphus.models
+
+RESOLUTIONS = (('minute', 60, 60, "Last hour"),
+               ('hour', 60 * 60, 24, "Last day"),
+               ('day', 24 * 60 * 60, 7, "Last week"),
+               ('week', 7 * 24 * 60 * 60, 4, "Last four weeks"),
+               )
+SERIES = "series.%s.%s"
+SERIES_TOTAL = "series.%s.total"
+SERIES_PATTERN = "series.*"
+KEYS_PER_SERIES = len(RESOLUTIONS) + 1
+
+# series_incr(first, now, amount) adds amount to the series whose keys
+# start at KEYS[first]; series_incr_all(first, count, now, amount)
+# to count consecutive series.
+LUA = """
+local RESOLUTIONS = {%s}
+
+local function series_incr(first, now, amount)
+    for i, resolution in ipairs(RESOLUTIONS) do
+        local key = KEYS[first + i - 1]
+        local bucket = math.floor(now / resolution[1])
+        local slot = bucket %% resolution[2]
+        local stored = tonumber(redis.call('HGET', key, 'b' .. slot))
+        if stored == bucket then
+            redis.call('HINCRBY', key, 'c' .. slot, amount)
+        elseif not stored or stored < bucket then
+            -- views older than the slot's bucket are outside the window
+            redis.call('HMSET', key, 'b' .. slot, bucket, 'c' .. slot, amount)
+        end
+    end
+    redis.call('INCRBY', KEYS[first + #RESOLUTIONS], amount)
+end
+
+local function series_incr_all(first, count, now, amount)
+    for i = 0, count - 1 do
+        series_incr(first + i * %s, now, amount)
+    end
+end
+""" % (", ".join("{%s, %s}" % (x[1], x[2]) for x in RESOLUTIONS), KEYS_PER_SERIES)
+
+# KEYS: the keys of each series; ARGV: timestamp, amount
+INCR_SCRIPT = LUA + """
+series_incr_all(1, #KEYS / %s, tonumber(ARGV[1]), tonumber(ARGV[2]))
+return 1
+""" % KEYS_PER_SERIES
+
+def site_series():
+    return "site"
+
+def page_series(slug):
+    return "page.%s" % slug
+
+def tag_series(slug):
+    return "tag.%s" % slug
+
+def series_keys(names):
+    "Keys of the series in names, in the order the Lua functions expect."
+    keys = []
+    for name in names:
+        keys.extend(SERIES % (name, x[0]) for x in RESOLUTIONS)
+        keys.append(SERIES_TOTAL % name)
+    return keys
+
+def incr(names, now=None, amount=1, cli=None):
+    "Add amount views at now to each of the series in names."
+    cli = cli or sisyphus.models.redis_client()
+    now = now or int(time.time())
+    return sisyphus.models.lua_script(INCR_SCRIPT)(keys=series_keys(names), args=[now, amount], client=cli)
+
+def queue_read(pipeline, name):
+    "Queue the commands reading series name onto pipeline."
+    for key in series_keys([name]):
+        if key.endswith(".total"):
+            pipeline.get(key)
+        else:
+            pipeline.hgetall(key)
+
+def parse_read(results, now=None):
+    """
+    Convert the results of queue_read into the dense series at each
+    resolution, oldest first, as (name, title, [(datetime, views), ...]),
+    along with lifespan views.
+    """
+    now = now or int(time.time())
+    resolutions = []
+    for (name, seconds, size, title), slots in zip(RESOLUTIONS, results):
+        current = now // seconds
+        points = []
+        for bucket in xrange(current - size + 1, current + 1):
+            slot = bucket % size
+            views = int(slots.get('c%s' % slot, 0)) if slots.get('b%s' % slot) == str(bucket) else 0
+            points.append((datetime.datetime.fromtimestamp(bucket * seconds), views))
+        resolutions.append((name, title, points))
+    return { 'resolutions': resolutions, 'total': int(results[-1] or 0) }
+
+def read(name, now=None, cli=None):
+    "Read series name in one round trip."
+    cli = cli or sisyphus.models.redis_client()
+    pipeline = cli.pipeline(transaction=False)
+    queue_read(pipeline, name)
+    return parse_read(pipeline.execute(), now)
+
+def dump(series):
+    "Make series JSON serializable, with timestamps in place of datetimes."
+    return { 'total': series['total'],
+             'resolutions': [ (name, title, [ (int(time.mktime(x.timetuple())), y) for x, y in points ])
+                              for name, title, points in series['resolutions'] ],
+             }
+
+def load(series):
+    "Inverse of dump."
+    return { 'total': series['total'],
+             'resolutions': [ (name, title, [ (datetime.datetime.fromtimestamp(x), y) for x, y in points ])
+                              for name, title, points in series['resolutions'] ],
+             }
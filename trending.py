@@ -0,0 +1,200 @@
+"""
+Time-decayed trending scores.
+
+A page's trending score is the sum of its publication and each of its
+views, every one decaying by half each ``TRENDING_HALF_LIFE`` seconds.
+Since decay multiplies every score by the same factor, rankings only
+need scores relative to a fixed epoch, where an event at time t weighs
+``exp(rate * (t - epoch))``. Scores are stored as the logarithm of that
+sum, so they stay small and nothing ever needs rescanning as time
+passes: adding an event is a log-add-exp of its log weight into the
+stored score.
+
+The trending sorted sets (``pages_by_trend`` and ``tag_pages_by_trend.*``)
+each record the epoch their scores are relative to in ``TRENDING_EPOCHS``,
+defaulting to ``DEFAULT_EPOCH``. ``renormalize_trending`` moves them to a
+recent epoch, which keeps scores small, and ``rebuild_trending``
+recomputes them from publication dates and daily pageviews.
+"""
+import math
+import time
+from django.conf import settings
+import sisyphus.models
+import sisyphus.analytics
+
+TRENDING_EPOCHS = "trending.epochs"
+DEFAULT_EPOCH = 1300000000
+
+LUA = """
+local function logaddexp(a, b)
+    if a < b then
+        a, b = b, a
+    end
+    return a + math.log(1 + math.exp(b - a))
+end
+"""
+
+# KEYS: epochs hash, then the trending sorted sets
+# ARGV: rate, default epoch, mode, then (member, timestamp, log weight)
+#       per sorted set. In 'publish' mode scores are only set for new
+#       members, in 'add' mode events are added to existing scores.
+UPDATE_SCRIPT = LUA + """
+local rate, default_epoch, mode = tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3]
+for i = 2, #KEYS do
+    local key, j = KEYS[i], 3 * i - 2
+    local epoch = tonumber(redis.call('HGET', KEYS[1], key)) or default_epoch
+    local score = rate * (tonumber(ARGV[j + 1]) - epoch) + tonumber(ARGV[j + 2])
+    local old = redis.call('ZSCORE', key, ARGV[j])
+    if not old then
+        redis.call('ZADD', key, score, ARGV[j])
+    elseif mode == 'add' then
+        redis.call('ZADD', key, logaddexp(tonumber(old), score), ARGV[j])
+    end
+end
+return #KEYS - 1
+"""
+
+# KEYS: epochs hash, sorted set; ARGV: rate, default epoch, new epoch
+RENORMALIZE_SCRIPT = """
+local old = tonumber(redis.call('HGET', KEYS[1], KEYS[2])) or tonumber(ARGV[2])
+local shift = tonumber(ARGV[1]) * (tonumber(ARGV[3]) - old)
+local entries = redis.call('ZRANGE', KEYS[2], 0, -1, 'WITHSCORES')
+for i = 1, #entries, 2 do
+    redis.call('ZADD', KEYS[2], tonumber(entries[i + 1]) - shift, entries[i])
+end
+redis.call('HSET', KEYS[1], KEYS[2], ARGV[3])
+return #entries / 2
+"""
+
+def half_life():
+    return getattr(settings, 'TRENDING_HALF_LIFE', 3 * 24 * 60 * 60)
+
+def rate():
+    "Decay rate per second."
+    return math.log(2) / half_life()
+
+def publish_weight():
+    "Log weight of publication, in pageviews."
+    return math.log(getattr(settings, 'TRENDING_PUBLISH_WEIGHT', 20))
+
+def logsumexp(values):
+    top = max(values)
+    return top + math.log(sum(math.exp(x - top) for x in values))
+
+def trend_keys(page):
+    "The trending sorted sets page is ranked in."
+    tags = [ x[1] if isinstance(x, (list, tuple)) else x for x in page['tags'] ]
+    return [sisyphus.models.PAGE_ZSET_BY_TREND] + [ sisyphus.models.TAG_PAGES_ZSET_BY_TREND % x for x in tags ]
+
+def view_updates(page, now=None):
+    "List the (key, member, timestamp, log weight) updates for a pageview."
+    now = now or int(time.time())
+    return [ (key, page['slug'], now, 0.0) for key in trend_keys(page) ]
+
+def publish_updates(page):
+    "List the updates ranking a newly published page in its trending sets."
+    return [ (key, page['slug'], page['pub_date'], publish_weight()) for key in trend_keys(page) ]
+
+def publish_score(pub_date):
+    "Score of a page published at pub_date and not yet viewed, relative to DEFAULT_EPOCH."
+    return rate() * (pub_date - DEFAULT_EPOCH) + publish_weight()
+
+def coalesce(updates):
+    "Combine updates to the same key and member into one, at the latest timestamp."
+    grouped = {}
+    for key, member, timestamp, weight in updates:
+        grouped.setdefault((key, member), []).append((timestamp, weight))
+    coalesced = []
+    r = rate()
+    for (key, member), events in grouped.items():
+        latest = max(x[0] for x in events)
+        coalesced.append((key, member, latest, logsumexp([ r * (x - latest) + w for x, w in events ])))
+    return coalesced
+
+def apply_updates(updates, cli, mode='add', batch_size=1000):
+    "Apply updates with the update script, on cli or a pipeline."
+    script = sisyphus.models.lua_script(UPDATE_SCRIPT)
+    for i in xrange(0, len(updates), batch_size):
+        batch = updates[i:i+batch_size]
+        args = [rate(), DEFAULT_EPOCH, mode]
+        for key, member, timestamp, weight in batch:
+            args.extend((member, timestamp, repr(weight)))
+        script(keys=[TRENDING_EPOCHS] + [ x[0] for x in batch ], args=args, client=cli)
+
+def record_view(page, cli=None, now=None):
+    "Add a pageview to page's trending scores, in one round trip."
+    cli = cli or sisyphus.models.redis_client()
+    apply_updates(view_updates(page, now), cli)
+
+def publish(page, cli):
+    "Rank a newly published page, leaving scores of pages already ranked alone."
+    apply_updates(publish_updates(page), cli, mode='publish')
+
+def trending_keys(cli):
+    "All trending sorted sets."
+    keys = [sisyphus.models.PAGE_ZSET_BY_TREND]
+    keys.extend(sisyphus.models.TAG_PAGES_ZSET_BY_TREND % x for x in cli.zrange(sisyphus.models.TAG_ZSET_BY_PAGES, 0, -1))
+    return keys
+
+def renormalize(cli=None, now=None):
+    """
+    Move every trending sorted set to an epoch of now, one set at a
+    time, returning the number of scores shifted.
+    """
+    cli = cli or sisyphus.models.redis_client()
+    now = now or int(time.time())
+    script = sisyphus.models.lua_script(RENORMALIZE_SCRIPT)
+    shifted = 0
+    for key in trending_keys(cli):
+        shifted += script(keys=[TRENDING_EPOCHS, key], args=[rate(), DEFAULT_EPOCH, now], client=cli)
+    return shifted
+
+def daily_views(slugs, cli):
+    "Map each slug to its [(day bucket, views)], from whichever analytics storage is in use."
+    pipeline = cli.pipeline(transaction=False)
+    for slug in slugs:
+        if sisyphus.analytics.compact_analytics():
+            pipeline.hgetall(sisyphus.analytics.ANALYTICS_DAYS_PAGE % slug)
+        else:
+            pipeline.zrange(sisyphus.analytics.ANALYTICS_PAGEVIEW_PAGE_BUCKET % slug, 0, -1, withscores=True)
+    views = {}
+    for slug, days in zip(slugs, pipeline.execute()):
+        items = days.items() if isinstance(days, dict) else days
+        views[slug] = [ (int(x), int(y)) for x, y in items if int(y) > 0 ]
+    return views
+
+def rebuild(cli=None, now=None, chunk_size=1000):
+    """
+    Recompute every published page's trending scores from its
+    publication date and daily pageviews, relative to an epoch of now,
+    returning the number of pages ranked.
+    """
+    cli = cli or sisyphus.models.redis_client()
+    now = now or int(time.time())
+    r = rate()
+    scores = {}
+    slugs = cli.zrange(sisyphus.models.PAGE_ZSET_BY_TIME, 0, -1)
+    for i in xrange(0, len(slugs), chunk_size):
+        pages = sisyphus.models.hydrate_summaries(slugs[i:i+chunk_size], cli=cli, with_tag_counts=False)
+        views = daily_views([ x['slug'] for x in pages ], cli)
+        for page in pages:
+            events = [ r * (page['pub_date'] - now) + publish_weight() ]
+            # count each day's views at midday
+            events.extend(r * (day * sisyphus.analytics.DAY + sisyphus.analytics.DAY / 2 - now) + math.log(count)
+                          for day, count in views[page['slug']])
+            score = logsumexp(events)
+            for key in trend_keys(page):
+                scores.setdefault(key, {})[page['slug']] = score
+
+    pipeline = cli.pipeline()
+    for key in set(trending_keys(cli)) - set(scores):
+        pipeline.delete(key)
+    for key, members in scores.items():
+        pipeline.delete(key)
+        for member, score in members.items():
+            pipeline.zadd(key, member, score)
+    pipeline.delete(TRENDING_EPOCHS)
+    pipeline.hmset(TRENDING_EPOCHS, dict((x, now) for x in set(trending_keys(cli)) | set(scores)))
+    pipeline.incr(sisyphus.models.CACHE_VERSION % sisyphus.models.TRAFFIC_VERSION)
+    pipeline.execute()
+    return len(slugs)
@@ -1,9 +1,13 @@
 from django.conf.urls.defaults import *
-import sisyphus.sitemap
 
 urlpatterns = patterns('',
-    (r'^sitemap\.xml$', 'django.contrib.sitemaps.views.sitemap', {'sitemaps': sisyphus.sitemap.SITEMAPS}),
+    (r'^sitemap\.xml$', 'sisyphus.views.sitemap'),
+    (r'^sitemap-(?P<number>\d+)\.xml$', 'sisyphus.views.sitemap'),
     (r'^search/$', 'sisyphus.views.search'),
+    (r'^_stats/$', 'sisyphus.views.stats'),
+    (r'^_track/(?P<slug>.+?)/$', 'sisyphus.views.track_beacon'),
+    (r'^feeds/atom/$', 'sisyphus.views.feed', {'kind': 'atom'}),
+    (r'^feeds/tag/(?P<tag_slug>[^/]+)/atom/$', 'sisyphus.views.tag_feed', {'kind': 'atom'}),
     (r'^feeds/tag/(?P<tag_slug>.*)$', 'sisyphus.views.tag_feed'),
     (r'^feeds/(?P<feed_url>.*)$', 'sisyphus.views.feed'),
     (r'^tags/(?P<slug>[a-zA-Z0-9\-_]+)/$', 'sisyphus.views.tag_list'),
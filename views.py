@@ -5,7 +5,15 @@ from django.template import RequestContext
 from django.conf import settings
 import sisyphus.models
 import sisyphus.analytics
-import django.utils.feedgenerator
+import sisyphus.loader
+import sisyphus.cache
+import sisyphus.sitemap
+import sisyphus.feeds
+import sisyphus.export
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 STORY_LIST_KEYS = { 'recent': sisyphus.models.PAGE_ZSET_BY_TIME,
                     'trending': sisyphus.models.PAGE_ZSET_BY_TREND,
@@ -16,38 +24,37 @@ STORY_LIST_TITLES = { 'recent': "Recent pages",
                       }
 TAG_LIST_TITLE = "Pages tagged with %s"
 
-def tag_feed(request, tag_slug):
-    "Return RSS feed for a given tag."
-    tag_slug = tag_slug.rstrip("/")
-    cli = sisyphus.models.redis_client()
-    key = sisyphus.models.TAG_PAGES_ZSET_BY_TREND % tag_slug
-    page_dicts = sisyphus.models.get_pages(limit=25, key=key, cli=cli)
-    return generate_feed(request, page_dicts, cli)
+STORYLIST_SCOPES = { sisyphus.models.PAGE_ZSET_BY_TIME: (sisyphus.models.CONTENT_VERSION,),
+                     sisyphus.models.PAGE_ZSET_BY_TREND: (sisyphus.models.CONTENT_VERSION,
+                                                          sisyphus.models.TRAFFIC_VERSION),
+                     }
 
-def feed(request, feed_url):
-    "Return RSS feed of recent pages."
-    cli = sisyphus.models.redis_client()
-    page_dicts = sisyphus.models.get_pages(limit=25, cli=cli)
-    return generate_feed(request, page_dicts, cli)
+def last_modified(pages):
+    "Latest timestamp at which any of pages was published or edited."
+    return max([ x.get('edit_date', x['pub_date']) for x in pages ] or [None])
 
-def generate_feed(request, page_dicts, cli):
-    page_dicts = [ sisyphus.models.convert_pub_date_to_datetime(x) for x in page_dicts ]
-    f = django.utils.feedgenerator.Rss201rev2Feed(
-        title=settings.RSS_TITLE,
-        link=settings.RSS_LINK,
-        description=settings.RSS_DESC,
-        language=settings.RSS_LANG,
-        author_name=settings.RSS_AUTHOR,
-        feed_url=settings.RSS_FEED_URL,
-        )
-    cli = sisyphus.models.redis_client()
-    for page in page_dicts:
-        f.add_item(title=page['title'],
-                   link="http://%s/%s/" % (settings.DOMAIN, page['slug']),
-                   pubdate=page['pub_date'],
-                   description=page['html'],
-                   )
-    return HttpResponse(f.writeString('UTF-8'), mimetype="application/rss+xml")
+def tag_feed(request, tag_slug, kind='rss'):
+    "Return the RSS or Atom feed for a given tag."
+    return feed_response(request, sisyphus.feeds.tag_feed(tag_slug.rstrip("/")), kind)
+
+def feed(request, feed_url=None, kind='rss'):
+    "Return the RSS or Atom feed of recent pages."
+    return feed_response(request, sisyphus.feeds.SITE_FEED, kind)
+
+def feed_response(request, name, kind):
+    "Serve a precomputed feed."
+    stored = sisyphus.feeds.get_feed(kind, name)
+    if stored is None:
+        raise Http404
+    content_type = "application/atom+xml" if kind == 'atom' else "application/rss+xml"
+    return sisyphus.cache.stored_response(request, stored, content_type)
+
+def sitemap(request, number=None):
+    "Serve the precomputed sitemap index, or one of the sitemaps it lists."
+    stored = sisyphus.sitemap.get_sitemap(number or sisyphus.sitemap.SITEMAP_INDEX)
+    if stored is None:
+        raise Http404
+    return sisyphus.cache.stored_response(request, stored, sisyphus.sitemap.SITEMAP_CONTENT_TYPE)
 
 def about_module(cli=None):
     "An 'About Me' module."
@@ -62,37 +69,84 @@ def about_module(cli=None):
     """
     return { 'title':'Will Larson', 'html':html }
 
-def storylist_module(key, title, more_link=None, limit=3, cli=None, page=None):
-    cli = cli or sisyphus.models.redis_client()
+def request_loader(request, cli=None):
+    "Create a loader for request, reusing the cache versions cache_response read."
+    return sisyphus.loader.RequestLoader(cli, versions=getattr(request, 'cache_versions', None))
+
+def module_key(name, args, scopes, loader):
+    cache = sisyphus.cache.module_cache()
+    return cache.key(name, args, scopes, loader.versions())
+
+def cached_module(name, args, scopes, builder, loader):
+    "Retrieve a module payload from the module cache, building it on a miss."
+    cache = sisyphus.cache.module_cache()
+    return cache.get_or_build(module_key(name, args, scopes, loader), builder, cli=loader.cli)
+
+def want_default_modules(loader, page=None, limit=3):
+    "Declare the data the nav bar and default_modules will read."
     limit = limit + 1 if page else limit
-    objects = sisyphus.models.get_pages(limit=limit, key=key, cli=cli)
+    cache = sisyphus.cache.module_cache()
+    if loader.cache_versions is None:
+        # without the versions, fetch the lists with them rather than wait a round trip
+        loader.want_versions()
+    for key, scopes in STORYLIST_SCOPES.items():
+        if loader.cache_versions is None or module_key(key, (limit,), scopes, loader) not in cache:
+            loader.want_list(key, limit)
+    loader.want_tags(getattr(settings,'NUM_TAGS_NAV', 8))
+
+def want_page_modules(loader, page, limit=3):
+    "Declare the data the modules for a published page will read."
+    want_default_modules(loader, page, limit)
+    loader.want_nearby(page, 2)
+    loader.want_similar(page, limit)
+    loader.want_views(page['slug'])
+
+def storylist_pages(key, limit, loader):
+    "Retrieve titles and slugs of the first limit pages in key, through the module cache."
+    scopes = STORYLIST_SCOPES.get(key, sisyphus.models.CACHE_VERSION_SCOPES)
+    def build():
+        return [ {'slug': x['slug'], 'title': x['title']} for x in loader.pages(key, limit) ]
+    return cached_module(key, (limit,), scopes, build, loader)
+
+def storylist_module(key, title, more_link=None, limit=3, cli=None, page=None, loader=None):
+    loader = loader or sisyphus.loader.RequestLoader(cli)
     if page and 'slug' in page:
+        objects = storylist_pages(key, limit + 1, loader)
         objects = [ x for x in objects if x['slug'] != page['slug'] ][:limit]
+    else:
+        objects = storylist_pages(key, limit, loader)
 
     return { 'title': title, 'pages': objects, 'more_link': more_link }
 
-def trending_module(limit=3, page=None, cli=None):
+def trending_module(limit=3, page=None, cli=None, loader=None):
     "Create default trending module."
     return storylist_module(sisyphus.models.PAGE_ZSET_BY_TREND,
                             "Popular",
                             "/list/trending/",
                             limit=limit,
-                            page=page)
+                            cli=cli,
+                            page=page,
+                            loader=loader)
 
-def site_analytics_module(cli=None):
+def site_analytics_module(cli=None, loader=None):
     "Create site analytics module."
-    data = sisyphus.analytics.abbreviated_site_analytics(cli=cli, max_results=3)
-    more_link = "<a href=\"/analytics/\">More&hellip;</a>"
-    html = "<ul class=\"list-unstyled\">%s<li>%s</li></ul>" % ("".join("<li>%s (%s)</li>" % (x,y) for x,y in data), more_link)
-    return { 'title': 'Top Referrers', 'html':html }
-
-def page_analytics_module(limit=3, page=None, cli=None):
+    loader = loader or sisyphus.loader.RequestLoader(cli)
+    def build():
+        data = sisyphus.analytics.abbreviated_site_analytics(cli=loader.cli, max_results=3)
+        more_link = "<a href=\"/analytics/\">More&hellip;</a>"
+        html = "<ul class=\"list-unstyled\">%s<li>%s</li></ul>" % ("".join("<li>%s (%s)</li>" % (x,y) for x,y in data), more_link)
+        return { 'title': 'Top Referrers', 'html':html }
+    return cached_module('site_analytics', (), (sisyphus.models.TRAFFIC_VERSION,), build, loader)
+
+def page_analytics_module(limit=3, page=None, cli=None, loader=None):
     "Create page analytics module."
     try:
-        data = sisyphus.analytics.page_analytics(page, cli=cli, num_refs=0, days_back=0)
-        lis = [("Views", data['views'])]
-        if data['avg_daily_views']:
-            lis.append(("Daily Views", data['avg_daily_views']))
+        loader = loader or sisyphus.loader.RequestLoader(cli)
+        views = loader.page_views(page['slug'])
+        avg_daily_views = sisyphus.analytics.average_daily_views(views, page['pub_date'])
+        lis = [("Views", views)]
+        if avg_daily_views:
+            lis.append(("Daily Views", avg_daily_views))
         more_link = "<a href=\"/analytics/%s/\">More&hellip;</a>" % (page['slug'],)
         html = "<ul class=\"list-unstyled\">%s<li>%s</li></ul>" % ("".join("<li>%s: %s</li>" % li for li in lis), more_link)
         return { 'title': 'Page Analytics', 'html':html }
@@ -100,70 +154,83 @@ def page_analytics_module(limit=3, page=None, cli=None):
         return None
 
 def tags_list(request):
-    cli = sisyphus.models.redis_client()
-
-    # 'nav_tags': sisyphus.models.tags(limit=getattr(settings,'NUM_TAGS_NAV', 8), cli=cli),
+    loader = request_loader(request)
+    want_default_modules(loader, limit=5)
+    loader.want_tags(1000)
+    loader.load()
 
-    tags = sisyphus.models.tags(limit=1000, cli=cli)
+    tags = loader.tags(1000)
     context = {'tags': tags,
                'html_title':"Tags ordered by number of pages",
                'nav_tags': tags[:getattr(settings,'NUM_TAGS_NAV', 8)],
-               'modules': default_modules(None, limit=5, cli=cli)
+               'modules': default_modules(None, limit=5, loader=loader)
                }
     return render_to_response('sisyphus/tag_list.html', context, context_instance=RequestContext(request))
 
-def tags_module(offset=0, limit=10, cli=None):
+def tags_module(offset=0, limit=10, cli=None, loader=None):
     "Create module for tags."
-    tags = sisyphus.models.tags(offset, limit, cli=cli)
-    html = ['<ul class="tags nav nav-pills nav-stacked">'] + \
-        [ '<li><a href="/tags/%s/"><span class="badge pull-right">%s</span>%s</a></li>' % (x,y,x) for x,y in tags ] + \
-        ['<li><a href="/tags/">More&hellip;</a></li>', '</ul>']
-    return { 'title': 'Tags', 'html':'\n'.join(html) }
-
-def recent_module(limit=3, page=None, cli=None):
+    loader = loader or sisyphus.loader.RequestLoader(cli)
+    def build():
+        tags = loader.tags(offset + limit)[offset:]
+        html = ['<ul class="tags nav nav-pills nav-stacked">'] + \
+            [ '<li><a href="/tags/%s/"><span class="badge pull-right">%s</span>%s</a></li>' % (x,y,x) for x,y in tags ] + \
+            ['<li><a href="/tags/">More&hellip;</a></li>', '</ul>']
+        return { 'title': 'Tags', 'html':'\n'.join(html) }
+    return cached_module('tags', (offset, limit), (sisyphus.models.CONTENT_VERSION,), build, loader)
+
+def recent_module(limit=3, page=None, cli=None, loader=None):
     "Create default trending module."
     return storylist_module(sisyphus.models.PAGE_ZSET_BY_TIME,
                             "Recent",
                             "/list/recent/",
                             limit=limit,
-                            page=page)
+                            cli=cli,
+                            page=page,
+                            loader=loader)
 
-def context_module(page, limit=2, cli=None):
+def context_module(page, limit=2, cli=None, loader=None):
     "Module contains stories surrounding."
-    pages = sisyphus.models.get_nearby_pages(page, limit, cli=cli)
+    loader = loader or sisyphus.loader.RequestLoader(cli)
+    previous_pages, next_pages = loader.nearby(page, limit)
     before = None
     after = None
-    if pages[:limit]:
-        before = {"title":"Previous", "pages":reversed(pages[:limit])}
-    if pages[limit+1:]:
-        after = {"title":"Next", "pages":pages[limit+1:]}
+    if previous_pages:
+        before = {"title":"Previous", "pages":previous_pages}
+    if next_pages:
+        after = {"title":"Next", "pages":next_pages}
     return (before, after)
 
-def similar_pages_module(page, limit=3, cli=None):
+def similar_pages_module(page, limit=3, cli=None, loader=None):
     """
     Find stories which have a high overlap of tags with this one,
     then also sort by those articles' trending scores.
     """
-    pages = sisyphus.models.similar_pages(page, limit=limit, cli=cli)
+    loader = loader or sisyphus.loader.RequestLoader(cli)
+    pages = loader.similar(page, limit)
     if pages:
         more_link = '/similar/%s/' % page['slug'] if len(pages) >= limit else None
         return {'title': 'Similar', 'pages':pages, 'more_link':more_link}
     else:
         return None
 
-def default_modules(page, extras=[], limit=3, cli=None):
+def default_modules(page, extras=[], limit=3, cli=None, loader=None):
     ""
+    loader = loader or sisyphus.loader.RequestLoader(cli)
     modules = [(0.75, about_module(cli=cli)),
-               (0.5, trending_module(limit=limit, page=page, cli=cli)),
-               (0.25, recent_module(limit=limit, page=page, cli=cli)),
+               (0.5, trending_module(limit=limit, page=page, loader=loader)),
+               (0.25, recent_module(limit=limit, page=page, loader=loader)),
                ]
     modules += extras
     active_modules = [ (x,y) for x,y in modules if y ]
     active_modules.sort(reverse=True)
     return [ y for x,y in active_modules ]
 
+@sisyphus.cache.cache_response
 def render_list(request, key, base_url, title, cli=None):
-    cli = sisyphus.models.redis_client()
+    cli = cli or sisyphus.models.redis_client()
+    loader = request_loader(request, cli)
+    want_default_modules(loader, limit=5)
+    loader.want_tags(3)
     try:
         offset = int(request.GET.get('offset', 0))
     except ValueError:
@@ -173,26 +240,30 @@ def render_list(request, key, base_url, title, cli=None):
     except ValueError:
         limit = 10
 
-    page_dicts = sisyphus.models.get_pages(offset=offset, limit=limit, key=key, cli=cli)
+    page_dicts = sisyphus.models.get_summaries(offset=offset, limit=limit, key=key, cli=cli)
+    modified = last_modified(page_dicts)
     page_dicts = [ sisyphus.models.convert_pub_date_to_datetime(x) for x in page_dicts ]
     total_pages = sisyphus.models.num_pages(key=key, cli=cli)
     per_page = 10
     pages = [ x for x in range(0, total_pages, per_page)]
 
-    extra_modules = [(0.3, tags_module(limit=3, cli=cli))]
+    loader.load()
+    extra_modules = [(0.3, tags_module(limit=3, loader=loader))]
         
     context = {'pages': page_dicts,
                'pager_show': (len(page_dicts) >= per_page) or offset > per_page,
                'pager_offset': offset,
-               'nav_tags': sisyphus.models.tags(limit=getattr(settings,'NUM_TAGS_NAV', 8), cli=cli),
+               'nav_tags': loader.tags(getattr(settings,'NUM_TAGS_NAV', 8)),
                'pager_next': offset + per_page,
                'pager_prev': offset - per_page,
                'pager_remaining': offset + per_page < total_pages,
                'pager_pages': pages,
                'html_title': STORY_LIST_TITLES.get(title, TAG_LIST_TITLE % title),
-               'modules': default_modules(None, extra_modules, limit=5, cli=cli),
+               'modules': default_modules(None, extra_modules, limit=5, loader=loader),
                }
-    return render_to_response('sisyphus/page_list.html', context, context_instance=RequestContext(request))
+    response = render_to_response('sisyphus/page_list.html', context, context_instance=RequestContext(request))
+    response.last_modified = modified
+    return response
 
 def tag_list(request, slug):
     "Retrieve stories within a tag."
@@ -202,9 +273,11 @@ def tag_list(request, slug):
 
 def similar_list(request, slug, cli=None):
     "List of stories similar to this one."
-    cli = sisyphus.models.redis_client()
-    page = sisyphus.models.get_page(slug, cli=cli)
-    key = sisyphus.models.ensure_similar_pages_key(page, cli=cli)
+    cli = cli or sisyphus.models.redis_client()
+    page = sisyphus.models.get_page_summary(slug, cli=cli)
+    if page is None:
+        raise Http404
+    key = sisyphus.models.similar_pages_key(page, cli=cli)
     return render_list(request, key, "/similar/%s/" % slug, "Similar to %s" % page['title'], cli=cli)
 
 def story_list(request, list_type, cli=None):
@@ -217,10 +290,14 @@ def story_list(request, list_type, cli=None):
 
 def analytics(request):
     cli = sisyphus.models.redis_client()
-    extra_modules = [(0.3, tags_module(limit=3, cli=cli))]
+    loader = request_loader(request, cli)
+    want_default_modules(loader)
+    loader.want_tags(3)
+    loader.load()
+    extra_modules = [(0.3, tags_module(limit=3, loader=loader))]
     context = { 'domain': settings.DOMAIN,
-                'modules': default_modules(None, extra_modules, cli=cli),
-                'analytics': sisyphus.analytics.site_analytics(cli=cli),
+                'modules': default_modules(None, extra_modules, loader=loader),
+                'analytics': sisyphus.analytics.cached_site_analytics(cli=cli),
                 'ana_min_page_pv': settings.MIN_PAGE_PV,
                 'ana_min_ref_pv': settings.MIN_PAGE_REF_PV,
                 'ana_min_useragent': settings.MIN_USERAGENT,
@@ -235,12 +312,15 @@ def page_analytics(request, slug):
     cli = sisyphus.models.redis_client()
     object = sisyphus.models.get_page(slug, cli=cli)
     if object and object['published']:
+        loader = request_loader(request, cli)
+        want_page_modules(loader, object)
+        loader.load()
         object = sisyphus.models.convert_pub_date_to_datetime(object)
         extra_modules = []
         if object['published']:
             sisyphus.models.track(request, object, cli=cli)
-            before_mod, after_mod = context_module(object, cli=cli)
-            extra_modules = [(0.7, similar_pages_module(object, cli=cli)),
+            before_mod, after_mod = context_module(object, loader=loader)
+            extra_modules = [(0.7, similar_pages_module(object, loader=loader)),
                              (0.71, before_mod),
                              (0.73, after_mod),
                              ]
@@ -248,9 +328,9 @@ def page_analytics(request, slug):
         context = { 'page': object,
                     'domain': settings.DOMAIN,
                     'twitter_username': settings.TWITTER_USERNAME,
-                    'nav_tags': sisyphus.models.tags(limit=getattr(settings,'NUM_TAGS_NAV', 8), cli=cli),
-                    'modules': default_modules(object, extra_modules, cli=cli),
-                    'analytics': sisyphus.analytics.page_analytics(object, cli=cli),
+                    'nav_tags': loader.tags(getattr(settings,'NUM_TAGS_NAV', 8)),
+                    'modules': default_modules(object, extra_modules, loader=loader),
+                    'analytics': sisyphus.analytics.cached_page_analytics(object, cli=cli),
                     'ana_max_results': settings.MAX_ANALYTICS_RESULTS,
                     'ana_min_page_ref_pv':settings.MIN_PAGE_REF_PV,
                     }
@@ -258,18 +338,28 @@ def page_analytics(request, slug):
     else:
         raise Http404
 
+@sisyphus.cache.cache_response
 def page(request, slug):
-    "Render a page."
+    """
+    Render a page. Views of published pages are tracked by
+    cache_response, so they are counted for cached responses too.
+    """
     cli = sisyphus.models.redis_client()
     object = sisyphus.models.get_page(slug, cli=cli)
     if object:
+        loader = request_loader(request, cli)
+        if object['published']:
+            want_page_modules(loader, object)
+        else:
+            want_default_modules(loader, object)
+        loader.load()
+        modified = last_modified([object])
         object = sisyphus.models.convert_pub_date_to_datetime(object)
         extra_modules = []
         if object['published']:
-            sisyphus.models.track(request, object, cli=cli)
-            before_mod, after_mod = context_module(object, cli=cli)
-            extra_modules = [(0.73, similar_pages_module(object, cli=cli)),
-                             (0.74, page_analytics_module(page=object, cli=cli)),
+            before_mod, after_mod = context_module(object, loader=loader)
+            extra_modules = [(0.73, similar_pages_module(object, loader=loader)),
+                             (0.74, page_analytics_module(page=object, loader=loader)),
                              (0.71, before_mod),
                              (0.72, after_mod),
                              ]
@@ -277,14 +367,36 @@ def page(request, slug):
         context = { 'page': object,
                     'domain': settings.DOMAIN,
                     'twitter_username': settings.TWITTER_USERNAME,
-                    'nav_tags': sisyphus.models.tags(limit=getattr(settings,'NUM_TAGS_NAV', 8), cli=cli),
-                    'modules': default_modules(object, extra_modules, cli=cli),
+                    'nav_tags': loader.tags(getattr(settings,'NUM_TAGS_NAV', 8)),
+                    'modules': default_modules(object, extra_modules, loader=loader),
                     'disqus_shortname': settings.DISQUS_SHORTNAME,
+                    'track_beacon': sisyphus.export.is_export(request),
                     }
-        return render_to_response('sisyphus/page_detail.html', context, context_instance=RequestContext(request))
+        response = render_to_response('sisyphus/page_detail.html', context, context_instance=RequestContext(request))
+        response.last_modified = modified
+        if object['published']:
+            response.track_page = { 'slug': object['slug'], 'tags': object['tags'] }
+        return response
     else:
         raise Http404
 
+# a transparent 1x1 GIF
+BEACON_GIF = 'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+
+def track_beacon(request, slug):
+    """
+    Track a view of a page served from the static export, which
+    passes the page's referrer as the r parameter.
+    """
+    page = sisyphus.models.get_page_summary(slug)
+    if page is None or not page['published']:
+        raise Http404
+    request.META['HTTP_REFERER'] = request.GET.get('r', '')
+    sisyphus.models.track(request, { 'slug': page['slug'], 'tags': page['tags'] })
+    response = HttpResponse(BEACON_GIF, mimetype="image/gif")
+    response['Cache-Control'] = 'no-cache, no-store'
+    return response
+
 def frontpage(request):
     "Render frontpage."
     return story_list(request, "recent")
@@ -292,18 +404,47 @@ def frontpage(request):
 def search(request):
     "Search against blog."
     cli = sisyphus.models.redis_client()
+    loader = request_loader(request, cli)
+    want_default_modules(loader)
+    per_page = 10
+    try:
+        offset = max(int(request.GET.get('offset', 0)), 0)
+    except ValueError:
+        offset = 0
     pages = []
+    total = 0
     query = ''
     if 'q' in request.GET:
         query = request.GET['q']
-        search_resp = sisyphus.models.search(query, cli=cli)
-        if search_resp:
-            pages = [ sisyphus.models.convert_pub_date_to_datetime(x) for x in search_resp ]
+        pages, total = sisyphus.models.search(query, offset=offset, limit=per_page, cli=cli)
+        pages = [ sisyphus.models.convert_pub_date_to_datetime(x) for x in pages ]
     extra_modules = []
     context = { 'pages': pages,
                 'query': query,
-                'html_title': "%s pages match \"%s\"" % (len(pages), query),
-                'nav_tags': sisyphus.models.tags(limit=getattr(settings,'NUM_TAGS_NAV', 8), cli=cli),
-                'modules': default_modules(None, extra_modules, cli=cli),
+                'html_title': "%s pages match \"%s\"" % (total, query),
+                'pager_show': total > per_page,
+                'pager_query': query,
+                'pager_offset': offset,
+                'pager_next': offset + per_page,
+                'pager_prev': offset - per_page,
+                'pager_remaining': offset + per_page < total,
+                'pager_pages': range(0, total, per_page),
+                'nav_tags': loader.tags(getattr(settings,'NUM_TAGS_NAV', 8)),
+                'modules': default_modules(None, extra_modules, loader=loader),
                     }
     return render_to_response('sisyphus/search.html', context, context_instance=RequestContext(request))
+
+def stats(request):
+    "Report connection pool, cache and analytics buffer usage as JSON."
+    if request.META.get('REMOTE_ADDR') not in getattr(settings, 'INTERNAL_IPS', ()):
+        raise Http404
+    data = { 'redis_pool': sisyphus.models.pool_stats(),
+             'module_cache': sisyphus.cache.module_cache().stats(),
+             'response_cache': sisyphus.cache.response_cache().stats(),
+             'derived_keys': sisyphus.models.derived_stats(),
+             }
+    if getattr(settings, 'TRENDING_BUFFERED', True):
+        data['trend_buffer'] = sisyphus.models.trend_buffer().stats()
+    if getattr(settings, 'ANALYTICS_BUFFERED', False):
+        data['analytics_buffer'] = sisyphus.analytics.event_buffer().stats()
+    return HttpResponse(json.dumps(data), mimetype="application/json")